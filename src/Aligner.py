@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Aligner backends used by RefMasker to find the homologies between References. Each
+            backend builds a database from a subject fasta file and searches query fasta files
+            against it, producing BlastHit objects
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from collections import OrderedDict
+
+# Local imports
+from FileUtils import file_checksum
+from MergedFasta import best_query_hits
+from BlastPlus import makeblastdb, run_blastn, parse_hit, exec_version
+from ExactMatcher import ExactMatcher
+
+#~~~~~~~ HELPER FUNCTIONS ~~~~~~~#
+
+def fasta_ids (fasta):
+    """ Return the set of sequence ids of a fasta file, the id being the first word of the header """
+    with open(fasta, "r") as fp:
+        return set([line[1:].split()[0] for line in fp if line.startswith(">")])
+
+def get_aligner (name, **options):
+    """
+    Create an aligner backend from its name
+    @param options Options of the backend. Options not used by the backend are ignored
+    """
+    assert name in ALIGNERS, "Authorized values for aligner: {}".format(", ".join(ALIGNERS))
+    return ALIGNERS[name](**options)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class AlignerDb(object):
+    """
+    Base class of the databases built by aligner backends. A database is used with the context
+    manager to remove its temporary files. Subclasses implement search, that yields the hits of
+    a query fasta file. Calling the database returns the list of hits, as expected by BlastPool.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def __call__ (self, query_path, best_query_hit=False):
+        """
+        Search a query fasta file against the database
+        @param best_query_hit If True only the best hit of each query sequence is returned
+        @return A list of BlastHit objects
+        """
+        hit_list = list(self.search(query_path))
+        return best_query_hits(hit_list) if best_query_hit else hit_list
+
+    def search (self, query_path):
+        """ Generator of the BlastHit objects of a query fasta file """
+        raise NotImplementedError
+
+    def close (self):
+        """ Remove the temporary files of the database """
+        pass
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class Aligner(object):
+    """
+    Base class of the aligner backends. Subclasses implement database, and version if their
+    results depend on an external program or file, since the version is part of the keys of the
+    blast cache.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    NAME = ""
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def database (self, fasta, checksum=None, temp_root=None, subject_sizes=None):
+        """
+        Build a database from a subject fasta file
+        @param checksum Checksum of the fasta file, allowing to reuse cached databases if not None
+        @param temp_root Directory where temporary database files are created (default = system
+        temporary directory)
+        @param subject_sizes Dict of the size of the subject Reference of each sequence id, for a
+        fasta file merging several subject References. The e-values of the hits are then scaled
+        as if each subject Reference was searched alone. Ignored by the backends without e-values
+        @return An AlignerDb object
+        """
+        raise NotImplementedError
+
+    def version (self):
+        return self.NAME
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class BlastDb(AlignerDb):
+    """
+    Blast database searched by blastn, the hits being parsed from its output as they are written.
+    The database is either taken from the database cache or created in a temporary directory
+    removed when the database is closed
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def __init__ (self, aligner, db_path, temp_dir=None, subject_sizes=None):
+        """
+        @param aligner BlastAligner object holding the blastn options
+        @param db_path Path and basename of an existing blast database
+        @param temp_dir Temporary directory of the database, removed at closing. None for the
+        databases of the database cache
+        @param subject_sizes Dict of the size of the subject Reference of each sequence id of a
+        database merging several subject References
+        """
+        self.aligner = aligner
+        self.db_path = db_path
+        self.temp_dir = temp_dir
+        self.subject_sizes = subject_sizes
+
+    def search (self, query_path):
+        if not self.subject_sizes:
+            return run_blastn(query_path, self.db_path, self.aligner.blastn_exec,
+                self.aligner.blast_task, self.aligner.evalue)
+        return self._search_merged(query_path)
+
+    def close (self):
+        if self.temp_dir:
+            rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def _search_merged (self, query_path):
+        """
+        Search a database merging several subject References. E-values are proportional to the
+        size of the database: blastn computes them with the size of the smallest subject, then
+        they are scaled to the size of the subject of each hit and filtered again. All the subject
+        sequences are reported since the limit of blastn would be shared by the subjects. The
+        scaling is an approximation: the length adjustment of blastn depends on the number of
+        sequences of the whole database, so hits close to the cutoff may differ from a search
+        of the subject alone
+        """
+        dbsize = min(self.subject_sizes.values())
+        for hit in run_blastn(query_path, self.db_path, self.aligner.blastn_exec,
+            self.aligner.blast_task, self.aligner.evalue, dbsize, len(self.subject_sizes)):
+            hit.evalue = float(hit.evalue)*self.subject_sizes[hit.s_id]/dbsize
+            if hit.evalue <= self.aligner.evalue:
+                yield hit
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class BlastAligner(Aligner):
+    """
+    BLAST+ backend. Databases are taken from the database cache if one is given, or else created
+    with makeblastdb in a temporary directory for each subject
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    NAME = "blastn"
+
+    def __init__ (self, blastn_exec="", makeblastdb_exec="", blast_task="dc-megablast", evalue=1,
+        db_cache=None, **options):
+        """
+        @param db_cache BlastDbCache object or None to create a temporary database per subject
+        """
+        self.blastn_exec = blastn_exec
+        self.makeblastdb_exec = makeblastdb_exec
+        self.blast_task = blast_task
+        self.evalue = evalue
+        self.db_cache = db_cache
+
+    def database (self, fasta, checksum=None, temp_root=None, subject_sizes=None):
+        if self.db_cache and checksum:
+            return BlastDb(self, self.db_cache.get_db(fasta, checksum), None, subject_sizes)
+
+        temp_dir = mkdtemp(dir=temp_root)
+        try:
+            db_path = makeblastdb(fasta, path.join(temp_dir, "db"), self.makeblastdb_exec)
+        except:
+            rmtree(temp_dir, ignore_errors=True)
+            raise
+        return BlastDb(self, db_path, temp_dir, subject_sizes)
+
+    def version (self):
+        return exec_version(self.blastn_exec or "blastn")
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class ExactDb(AlignerDb):
+    """
+    K-mer index of the subject sequences used to find exact matches. The index is not pickled
+    with the database sent to the BlastPool workers: each worker process indexes the subject
+    once and keeps the index of the last subject searched
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    # Index of the last subject searched by a worker process, by fasta path and minimal length
+    _worker_index = {}
+
+    def __init__ (self, fasta, min_length):
+        self.fasta = fasta
+        self.min_length = min_length
+        self.matcher = ExactMatcher(fasta, min_length)
+
+    def __getstate__ (self):
+        return {"fasta": self.fasta, "min_length": self.min_length}
+
+    def __setstate__ (self, state):
+        self.__dict__.update(state)
+        key = (self.fasta, self.min_length)
+        if key not in ExactDb._worker_index:
+            ExactDb._worker_index.clear()
+            ExactDb._worker_index[key] = ExactMatcher(self.fasta, self.min_length)
+        self.matcher = ExactDb._worker_index[key]
+
+    def search (self, query_path):
+        return iter(self.matcher(query_path))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class ExactAligner(Aligner):
+    """ Built-in backend finding the exact matches longer than min_match_length """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    NAME = "exact"
+
+    def __init__ (self, min_match_length=100, **options):
+        self.min_match_length = min_match_length
+
+    def database (self, fasta, checksum=None, temp_root=None, subject_sizes=None):
+        return ExactDb(fasta, self.min_match_length)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class FakeDb(AlignerDb):
+    """ Subject sequence ids used to select the planted homologies """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def __init__ (self, fasta, homology_file):
+        self.subject_ids = fasta_ids(fasta)
+        self.homology_file = homology_file
+
+    def search (self, query_path):
+        query_ids = fasta_ids(query_path)
+        with open(self.homology_file, "r") as fp:
+            for line in fp:
+                fields = line.split()
+                if fields and not line.startswith("#") and fields[0] in query_ids and \
+                    fields[1] in self.subject_ids:
+                    yield parse_hit(line)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class FakeAligner(Aligner):
+    """
+    Deterministic backend returning homologies planted in a sidecar file, to run and benchmark the
+    whole pipeline without BLAST+. The file follows the blastn tabular format (-outfmt 6), with
+    one homology per line: query id, subject id, identity, length, mismatches, gaps, query start,
+    query end, subject start, subject end, evalue, bit score and optionally the query sequence.
+    A homology is returned when its query id is in the query file and its subject id is in the
+    subject file, in the order of the sidecar file. Lines starting with # are ignored.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    NAME = "fake"
+
+    def __init__ (self, homology_file="", **options):
+        assert homology_file and path.isfile(homology_file), \
+            "A valid homology_file is required by the fake aligner"
+        self.homology_file = path.abspath(homology_file)
+
+    def database (self, fasta, checksum=None, temp_root=None, subject_sizes=None):
+        return FakeDb(fasta, self.homology_file)
+
+    def version (self):
+        return "{} {}".format(self.NAME, file_checksum(self.homology_file))
+
+# Aligner backends by name
+ALIGNERS = OrderedDict([(aligner.NAME, aligner) for aligner in
+    [BlastAligner, ExactAligner, FakeAligner]])
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to write BGZF compressed files with a pool of compression
+            threads, readable by any gzip reader and randomly accessible with their .gzi index
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import zlib
+from struct import pack
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Maximal number of uncompressed bytes per block, as in samtools
+BLOCK_SIZE = 65280
+# Gzip header with the BC extra subfield giving the size of the block, followed by the size
+BLOCK_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00"
+    "\x00\x00\x00\x00\x00\x00")
+# Extension of the index files, appended to the name of the compressed file
+GZI_EXT = ".gzi"
+
+#~~~~~~~ BLOCK COMPRESSION ~~~~~~~#
+
+def compress_block (data, level=6):
+    """
+    Compress data in a single BGZF block. zlib releases the GIL so that several blocks can be
+    compressed at the same time by threads
+    @param data String of at most BLOCK_SIZE bytes
+    @param level zlib compression level
+    @return The BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data)+compressor.flush()
+    return "".join([BLOCK_HEADER, pack("<H", len(BLOCK_HEADER)+len(cdata)+9), cdata,
+        pack("<II", zlib.crc32(data) & 0xffffffff, len(data))])
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class BgzfWriter(object):
+    """
+    Write only file object compressing the data in BGZF blocks with a pool of threads. The blocks
+    are written in order and at most a few blocks per thread are waiting to be written so that
+    the memory used is bounded. The .gzi index of the block offsets can be written at closing.
+    Use with the context manager to close the file
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, bgzf_path, threads=1, level=6, gzi=False):
+        """
+        @param bgzf_path Path of the compressed file to write
+        @param threads Number of compression threads
+        @param level zlib compression level
+        @param gzi If True the .gzi index is written next to the compressed file
+        """
+        self.bgzf_path = bgzf_path
+        self.threads = threads
+        self.level = level
+        self.gzi_path = bgzf_path+GZI_EXT if gzi else None
+
+        self.handle = open(bgzf_path, "wb")
+        self.pool = ThreadPool(threads)
+        self._buffer = []
+        self._n_buffer = 0
+        self._pending = deque()
+        # Uncompressed and compressed offsets of the blocks written
+        self._offset = 0
+        self._block_list = []
+
+    # Enter and exit are defined to use the context manager "with"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close(abort=type is not None)
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def write (self, data):
+        """ Add data to the file, compressing the full blocks """
+        self._buffer.append(data)
+        self._n_buffer += len(data)
+        if self._n_buffer >= BLOCK_SIZE:
+            data = "".join(self._buffer)
+            n_full = len(data)//BLOCK_SIZE*BLOCK_SIZE
+            for start in xrange(0, n_full, BLOCK_SIZE):
+                self._submit(data[start:start+BLOCK_SIZE])
+            self._buffer = [data[n_full:]]
+            self._n_buffer = len(self._buffer[0])
+
+    def tell (self):
+        """ Uncompressed offset of the next byte written """
+        return self._offset+self._n_buffer
+
+    def close (self, abort=False):
+        """
+        Compress the remaining data, write the end of file block and the .gzi index
+        @param abort If True the pending blocks are discarded
+        """
+        if self.handle.closed:
+            return
+        try:
+            if not abort:
+                if self._n_buffer:
+                    self._submit("".join(self._buffer))
+                while self._pending:
+                    self._write_block()
+                self.handle.write(EOF_BLOCK)
+                if self.gzi_path:
+                    self._write_gzi()
+        finally:
+            self.pool.terminate()
+            self.handle.close()
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _submit (self, data):
+        self._pending.append((self.pool.apply_async(compress_block, (data, self.level)), len(data)))
+        self._offset += len(data)
+        # Write the oldest blocks when enough blocks are waiting
+        while len(self._pending) > 2*self.threads:
+            self._write_block()
+
+    def _write_block (self):
+        result, size = self._pending.popleft()
+        block = result.get()
+        u_offset = self._block_list[-1][1]+self._block_list[-1][2] if self._block_list else 0
+        self._block_list.append((self.handle.tell(), u_offset, size))
+        self.handle.write(block)
+
+    def _write_gzi (self):
+        """ Write the compressed and uncompressed offsets of all the blocks except the first one """
+        with open(self.gzi_path, "wb") as gzi:
+            gzi.write(pack("<Q", max(0, len(self._block_list)-1)))
+            for c_offset, u_offset, size in self._block_list[1:]:
+                gzi.write(pack("<QQ", c_offset, u_offset))
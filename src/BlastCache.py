@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to store blast results on disk and reuse them across runs
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import cPickle
+from os import path, makedirs, listdir, remove, rename, utime, getpid
+from hashlib import sha1
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class BlastCache(object):
+    """
+    Content addressed cache of blast hit lists stored as pickle files in a directory. Keys are
+    computed from the checksums of the query and subject fasta files and from the blast parameters
+    so that a cached result is reused only if it would be identical to a new blast. The total size
+    of the cache is capped and the least recently used entries are removed first.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    EXT = ".hits.pkl"
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, cache_dir, max_size=1024):
+        """
+        @param cache_dir Path to the directory where cached results are stored. Created if needed
+        @param max_size Maximal size of the cache in Mb
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size*1048576)
+        self.n_hit = 0
+        self.n_miss = 0
+
+        if not path.isdir(self.cache_dir):
+            makedirs(self.cache_dir)
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def key (self, *fields):
+        """ Compute a cache key from a list of fields (checksums, parameters and versions) """
+        return sha1("\t".join([str(field) for field in fields])).hexdigest()
+
+    def has (self, key):
+        """ True if a hit list is stored for a key, without loading it """
+        return path.isfile(self._entry_path(key))
+
+    def get (self, key):
+        """
+        Return the hit list stored for a key or None if the key is not in the cache. The access
+        time of the entry is updated to keep track of the least recently used entries
+        """
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as fp:
+                hit_list = cPickle.load(fp)
+        # Missing entry or entry corrupted by an interrupted run
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            self.n_miss += 1
+            return None
+
+        utime(entry, None)
+        self.n_hit += 1
+        return hit_list
+
+    def put (self, key, hit_list):
+        """
+        Store a hit list for a key. The entry is first written in a temporary file then renamed to
+        never expose partially written entries. Old entries are evicted if the cache is too large
+        """
+        entry = self._entry_path(key)
+        temp_entry = "{}.{}.tmp".format(entry, getpid())
+        with open(temp_entry, "wb") as fp:
+            cPickle.dump(hit_list, fp, cPickle.HIGHEST_PROTOCOL)
+        rename(temp_entry, entry)
+        self.evict()
+
+    def evict (self):
+        """ Remove the least recently used entries until the cache size is below max_size """
+        entry_list = []
+        for name in listdir(self.cache_dir):
+            if name.endswith(self.EXT):
+                entry = path.join(self.cache_dir, name)
+                try:
+                    entry_list.append((path.getmtime(entry), path.getsize(entry), entry))
+                # Entry removed by another process in the meantime
+                except OSError:
+                    continue
+
+        total_size = sum([size for mtime, size, entry in entry_list])
+        for mtime, size, entry in sorted(entry_list):
+            if total_size <= self.max_size:
+                break
+            try:
+                remove(entry)
+            except OSError:
+                pass
+            total_size -= size
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _entry_path (self, key):
+        return path.join(self.cache_dir, key+self.EXT)
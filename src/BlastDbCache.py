@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to store blast databases on disk and reuse them across runs
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import json
+from os import path, makedirs, listdir, rename, utime, getpid
+from shutil import rmtree
+from hashlib import sha1
+from time import time
+from socket import gethostname
+
+# Local imports
+from BlastPlus import makeblastdb, exec_version
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class BlastDbCache(object):
+    """
+    Cache of blast databases stored in a directory. Each database is created in its own entry
+    directory named after the checksum of the fasta file and the version of makeblastdb. A manifest
+    listing the database files and their sizes is written once the database is complete and is used
+    to verify the integrity of the entry before reusing it. Interrupted builds, corrupted entries
+    and entries unused for more than max_age days are removed when the cache is opened.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    MANIFEST = "manifest.json"
+    DB_NAME = "db"
+    TMP = ".tmp."
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, cache_dir, makeblastdb_exec="makeblastdb", max_age=30):
+        """
+        @param cache_dir Path to the directory where databases are stored. Created if needed
+        @param makeblastdb_exec Path to the makeblastdb executable
+        @param max_age Number of days after which an unused database is removed
+        """
+        self.cache_dir = cache_dir
+        self.makeblastdb_exec = makeblastdb_exec or "makeblastdb"
+        self.max_age = max_age
+        self.version = exec_version(self.makeblastdb_exec)
+
+        if not path.isdir(self.cache_dir):
+            makedirs(self.cache_dir)
+
+        self.clean_stale()
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def get_db (self, fasta, checksum):
+        """
+        Return the path of a valid database for a fasta file. The database is created and added to
+        the cache if it is not already present
+        @param fasta Path to the fasta file
+        @param checksum Checksum of the content of the fasta file
+        @return Path and basename of the database files
+        """
+        entry = path.join(self.cache_dir, sha1("{}\t{}".format(checksum, self.version)).hexdigest())
+
+        if self._is_valid(entry):
+            print ("   * Reuse cached blast database")
+            utime(entry, None)
+            return path.join(entry, self.DB_NAME)
+
+        # Remove an invalid entry, then build the database in a temporary directory and rename it
+        # once complete so that other processes never see a partial database
+        if path.isdir(entry):
+            rmtree(entry)
+
+        print ("   * Create a blast database in the cache")
+        temp_entry = "{}{}{}.{}".format(entry, self.TMP, gethostname(), getpid())
+        makedirs(temp_entry)
+        try:
+            makeblastdb(fasta, path.join(temp_entry, self.DB_NAME), self.makeblastdb_exec)
+            self._write_manifest(temp_entry, checksum)
+            rename(temp_entry, entry)
+        except OSError:
+            # The same database may have been completed by another process in the meantime
+            rmtree(temp_entry, ignore_errors=True)
+            if not self._is_valid(entry):
+                raise
+        except:
+            rmtree(temp_entry, ignore_errors=True)
+            raise
+
+        return path.join(entry, self.DB_NAME)
+
+    def clean_stale (self):
+        """
+        Remove interrupted builds, entries failing the integrity check and entries not used for
+        more than max_age days
+        """
+        now = time()
+        for name in listdir(self.cache_dir):
+            entry = path.join(self.cache_dir, name)
+            if not path.isdir(entry):
+                continue
+            # Temporary entries are only removed after a day since they may be in use
+            if self.TMP in name:
+                stale = now - path.getmtime(entry) > 86400
+            else:
+                stale = not self._is_valid(entry) or now - path.getmtime(entry) > self.max_age*86400
+            if stale:
+                rmtree(entry, ignore_errors=True)
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _write_manifest (self, entry, checksum):
+        """ List the files of a database entry with their sizes """
+        manifest = {
+            "checksum": checksum,
+            "version": self.version,
+            "files": {name: path.getsize(path.join(entry, name)) for name in listdir(entry)}}
+        with open(path.join(entry, self.MANIFEST), "w") as fp:
+            json.dump(manifest, fp)
+
+    def _is_valid (self, entry):
+        """ Verify that all the files listed in the manifest of an entry exist with the right size """
+        try:
+            with open(path.join(entry, self.MANIFEST), "r") as fp:
+                manifest = json.load(fp)
+            for name, size in manifest["files"].items():
+                if path.getsize(path.join(entry, name)) != size:
+                    return False
+            return bool(manifest["files"])
+        except (IOError, OSError, ValueError, KeyError):
+            return False
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to call blast+ executables on existing blast databases
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
+
+# Local imports
+from pyBlast.BlastHit import BlastHit
+
+# Tabular output format parsed by parse_hit
+OUTFMT = "6 std qseq"
+
+#~~~~~~~ HELPER FUNCTIONS ~~~~~~~#
+
+def exec_version (executable):
+    """
+    Return the first line of the version string of a blast+ executable or an empty string if the
+    version cannot be determined
+    """
+    try:
+        stdout, stderr = Popen([executable, "-version"], stdout=PIPE, stderr=PIPE).communicate()
+        return stdout.partition("\n")[0].strip()
+    except OSError:
+        return ""
+
+def makeblastdb (fasta, db_path, makeblastdb_exec="makeblastdb"):
+    """
+    Create a nucleotide blast database from a fasta file
+    @param fasta Path to the fasta file
+    @param db_path Path and basename of the database files to create
+    @return db_path
+    """
+    cmd = [makeblastdb_exec or "makeblastdb", "-in", fasta, "-dbtype", "nucl", "-out", db_path]
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode:
+        raise Exception ("Error while creating the blast database of {}\n{}".format(fasta, stderr))
+    return db_path
+
+def blastn_cmd (query_path, db_path, blastn_exec="blastn", task="dc-megablast", evalue=1,
+    dbsize=0, max_target_seqs=0):
+    """
+    Return the blastn command line as a list of arguments
+    @param dbsize Size of the database used to compute the e-values. 0 for the actual size
+    @param max_target_seqs Maximal number of subject sequences reported per query sequence. 0 for
+    the default of blastn
+    """
+    cmd = [blastn_exec or "blastn", "-task", task, "-evalue", str(evalue), "-outfmt", OUTFMT,
+        "-query", query_path, "-db", db_path]
+    if dbsize:
+        cmd.extend(["-dbsize", str(dbsize)])
+    if max_target_seqs:
+        cmd.extend(["-max_target_seqs", str(max_target_seqs)])
+    return cmd
+
+def parse_hit (line):
+    """ Create a BlastHit object from a line of blastn tabular output """
+    fields = line.split()
+    return BlastHit (
+        q_id = fields[0],
+        s_id = fields[1],
+        identity = fields[2],
+        length = fields[3],
+        mis = fields[4],
+        gap = fields[5],
+        q_start = fields[6],
+        q_end = fields[7],
+        s_start = fields[8],
+        s_end = fields[9],
+        evalue = fields[10],
+        bscore = fields[11],
+        q_seq = fields[12] if len(fields) > 12 else "")
+
+def run_blastn (query_path, db_path, blastn_exec="blastn", task="dc-megablast", evalue=1,
+    dbsize=0, max_target_seqs=0):
+    """
+    Blast a query fasta file against an existing blast database. The tabular output is parsed
+    line by line from the stdout pipe as blastn writes it, so that hits are never all held in
+    memory. blastn is killed if the generator is closed before the end of the output
+    @param dbsize, max_target_seqs Options of blastn_cmd
+    @return A generator of BlastHit objects
+    """
+    cmd = blastn_cmd(query_path, db_path, blastn_exec, task, evalue, dbsize, max_target_seqs)
+
+    # stderr is written in a file so that blastn never blocks on a full stderr pipe
+    with TemporaryFile() as stderr:
+        proc = Popen(cmd, stdout=PIPE, stderr=stderr)
+        try:
+            # readline is used since file iteration reads ahead by large blocks in python 2
+            for line in iter(proc.stdout.readline, ""):
+                if line.strip():
+                    yield parse_hit(line)
+            proc.stdout.close()
+
+            if proc.wait():
+                stderr.seek(0)
+                raise Exception ("Error while running blastn on {}\n{}".format(
+                    query_path, stderr.read()))
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to run several blastn jobs in parallel
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from multiprocessing import Pool
+
+#~~~~~~~ WORKER SIDE ~~~~~~~#
+
+def _blast_worker (job):
+    """
+    Blast a single query file against the database of the job and return the hit list. The
+    database object is pickled with each job, so that a pool created before the databases can
+    serve all of them
+    """
+    blastn, query_path, blast_kwargs = job
+    return blastn(query_path=query_path, **blast_kwargs)
+
+#~~~~~~~ MAIN PROCESS SIDE ~~~~~~~#
+
+def blast_pool (n_workers):
+    """
+    Create a pool of worker processes shared by the calls of blast_query_list. The pool should be
+    created by the main thread before any other thread is started, since forking a process from a
+    thread only copies that thread
+    @param n_workers Number of worker processes
+    @return A multiprocessing Pool object, or None if n_workers <= 1
+    """
+    return Pool(processes=n_workers) if n_workers > 1 else None
+
+def blast_query_list (blastn, query_path_list, n_workers=1, callback=None, pool=None,
+    **blast_kwargs):
+    """
+    Blast a list of query fasta files against the database of an aligner backend
+    @param blastn AlignerDb object (or pyBlast.Blastn like callable) of the subject database
+    @param query_path_list List of paths to query fasta files
+    @param n_workers Number of blastn jobs to run at the same time. 1 = serial execution
+    @param callback Function called with the index of the query and its hit list as soon as each
+    result is available, following the order of query_path_list
+    @param pool Pool created by blast_pool and shared with other calls. The jobs then run in the
+    processes of the pool, whatever n_workers > 1. If None a pool of n_workers processes is
+    created for the call
+    @param blast_kwargs Options passed to each call of the database (best_query_hit)
+    @return A list of hit lists in the same order as query_path_list, whatever the order in which
+    the jobs finished, so that the results do not depend on the number of workers
+    """
+    n_workers = min(n_workers, len(query_path_list))
+
+    hit_lists = []
+
+    # Serial execution in the current process
+    if n_workers <= 1:
+        for j, query_path in enumerate(query_path_list):
+            hit_lists.append(blastn(query_path=query_path, **blast_kwargs))
+            if callback:
+                callback(j, hit_lists[-1])
+        return hit_lists
+
+    # Parallel execution in a pool of worker processes. imap preserves the order of the jobs
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(processes=n_workers)
+    job_list = [(blastn, query_path, blast_kwargs) for query_path in query_path_list]
+    try:
+        for j, hit_list in enumerate(pool.imap(_blast_worker, job_list, chunksize=1)):
+            hit_lists.append(hit_list)
+            if callback:
+                callback(j, hit_list)
+        if own_pool:
+            pool.close()
+    except:
+        if own_pool:
+            pool.terminate()
+        raise
+    finally:
+        if own_pool:
+            pool.join()
+
+    return hit_lists
@@ -35,9 +35,23 @@ summary_report = True
 # Output a detailed report including all blast hit coordinates and evalue
 detailed_report = True
 
-# Gzip fasta output (BOOLEAN)
+# Gzip fasta output in BGZF format, with .fai and .gzi indexes for samtools (BOOLEAN)
 compress_output : True
 
+# Number of bases per line of the masked fasta files, 0 to write each sequence on a single line
+# (INTEGER >= 0). Default = 60
+line_width : 60
+
+# Write the masked fasta files by copying the reference files and overwriting only the masked
+# bases in the copies. Faster for references made of a few large sequences. The headers and the
+# line width of the reference files are kept and line_width is ignored. Requires compress_output
+# = False (BOOLEAN). Default = False
+inplace_masking : False
+
+# Directory where the completed steps of the run are recorded. An interrupted run can be resumed
+# with the --resume option. Leave empty to disable the checkpoints (STRING)
+run_dir :
+
 ###################################################################################################
 [Blast]
 
@@ -60,6 +74,127 @@ evalue : 0.1
 # 'rmblastn'. Default = dc-megablast
 blast_task = dc-megablast
 
+# Number of blastn processes running at the same time against each subject reference. The output
+# is identical whatever the number of workers (INTEGER > 0). Default = 1
+blast_workers : 1
+
+# Strategy used to find the homologies between references (STRING). Default = pairwise
+#   * pairwise = 1 blast database per subject reference and 1 blastn per pair of references
+#   * batch = 1 blast database per subject reference and a single blastn of all the references
+#     listed before the subject, merged in a single query file
+#   * all_vs_all = for each reference, 1 blast database merging all the references listed after
+#     it and a single blastn of the reference against it. Faster with many references. E values
+#     are scaled to the size of each subject reference, but the length adjustment of blastn
+#     depends on the whole database, so hits close to the E value cutoff may differ from the
+#     pairwise mode
+blast_mode : pairwise
+
+# Program used to find the homologies (STRING). Default = blastn
+#   * blastn = blastn with the options above
+#   * exact = built-in search of the exact matches longer than min_match_length on both strands.
+#     No blast executable is required. Faster for closely related sequences such as constructs
+#     and vectors, but homologies with mismatches or gaps are split or missed
+#   * fake = homologies planted in homology_file, to test or benchmark the pipeline without blast
+aligner : blastn
+
+# Minimal length of the exact matches found by the exact aligner (INTEGER > 0). Default = 100
+min_match_length : 100
+
+# File of the homologies returned by the fake aligner, in blastn tabular format (-outfmt 6). A
+# homology is returned when its query and subject sequence ids are found in the query and subject
+# references (STRING)
+homology_file :
+
+# In pairwise and all_vs_all modes, query sequences longer than chunk_size bases are split in
+# overlapping windows blasted in parallel by the blast workers. 0 to disable the splitting
+# (INTEGER >= 0). Default = 0
+chunk_size : 0
+
+# Number of bases shared by consecutive windows. Should be longer than the longest expected hit
+# (INTEGER >= 0 and < chunk_size). Default = 10000
+chunk_overlap : 10000
+
+# In pairwise mode, search each query reference against the subject masked with the hits of the
+# queries listed before it, by rebuilding the database after each query reference with new hits.
+# Regions already masked are not searched again, which reduces the blast work with repetitive
+# references, but homologies overlapping masked regions may be shorter (BOOLEAN). Default = False
+progressive_masking : False
+
+###################################################################################################
+[Prefilter]
+
+# Options to skip the blast of pairs of references sharing no sequence. The minimizers of each
+# reference (smallest k-mers of each window of consecutive k-mers) are compared before blasting.
+# Divergent homologies sharing no exact k-mer may be missed
+
+# Minimal number of minimizers shared by 2 references to blast them. 0 to disable the prefilter
+# (INTEGER >= 0). Default = 0
+min_shared_minimizers : 0
+
+# Length of the k-mers (0 < INTEGER <= 32). Default = 15
+kmer_size : 15
+
+# Number of consecutive k-mers in which a minimizer is selected (INTEGER > 0). Default = 10
+window_size : 10
+
+# Directory where the sketches are saved to be reused by the next runs. Leave empty to save them
+# in the db_cache_dir, or only for the current run if there is no database cache (STRING)
+sketch_dir :
+
+# Save the sketches next to the fasta files instead, if sketch_dir is empty (BOOLEAN).
+# Default = False
+sketch_with_fasta : False
+
+###################################################################################################
+[Pipeline]
+
+# Each subject reference is processed by 3 tasks: build its blast database, blast the references
+# listed before it against the database, then mask and write it. The tasks of different subject
+# references run at the same time, starting by the largest references. The results do not depend
+# on these options
+
+# Number of blast databases created at the same time (INTEGER > 0). Default = 1
+db_jobs : 1
+
+# Number of subject references blasted at the same time. Each one uses blast_workers blastn
+# processes (INTEGER > 0). Default = 1
+blast_jobs : 1
+
+# Number of masked references written at the same time (INTEGER > 0). Default = 1
+write_jobs : 1
+
+# Number of threads compressing each masked reference written when compress_output is True
+# (INTEGER > 0). Default = 1
+compress_threads : 1
+
+###################################################################################################
+[Cache]
+
+# Options to reuse the results of previous runs. Cached results are only reused if the content of
+# the fasta files, the blast parameters and the blast version are unchanged
+
+# Directory where blast results are stored to be reused by the next runs. Leave empty to disable
+# the cache (STRING)
+result_cache_dir :
+
+# Maximal size of the blast result cache in Mb. The least recently used results are removed first
+# (FLOAT > 0). Default = 1024
+result_cache_size : 1024
+
+# Directory where the blast databases of subject references are stored to be reused by the next
+# runs. Leave empty to create a new database for each run (STRING)
+db_cache_dir :
+
+# Number of days after which an unused blast database is removed from the cache (FLOAT > 0).
+# Default = 30
+db_cache_max_age : 30
+
+# Directory where the reference fasta files are staged (decompressed and indexed) to be reused by
+# the next runs. Entries unused for db_cache_max_age days are removed. In distributed mode, it must
+# be readable by the workers of all hosts. Leave empty to stage the files for the current run only
+# (STRING)
+stage_cache_dir :
+
 ###################################################################################################
 # REFERENCE DEFINITION
 
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to find long exact matches between References without
+            calling blast
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from collections import OrderedDict
+from string import maketrans
+
+# Local imports
+from MergedFasta import best_query_hits
+from pyBlast.BlastHit import BlastHit
+
+# Translation table to complement DNA sequences
+COMPLEMENT = maketrans("ACGTNacgtn", "TGCANtgcan")
+
+#~~~~~~~ HELPER FUNCTIONS ~~~~~~~#
+
+def read_fasta (fasta):
+    """
+    Read all the sequences of a fasta file in uppercase
+    @return An OrderedDict of sequences by id, the id being the first word of the header as in blast
+    """
+    seq_dict = OrderedDict()
+    name = None
+    with open(fasta, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].partition(" ")[0]
+                seq_dict[name] = []
+            elif name is not None:
+                seq_dict[name].append(line.upper())
+    return OrderedDict([(name, "".join(line_list)) for name, line_list in seq_dict.items()])
+
+def reverse_complement (seq):
+    return seq[::-1].translate(COMPLEMENT)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class ExactMatcher(object):
+    """
+    In-process replacement of Blastn finding the exact matches longer than a minimal length
+    between query sequences and the sequences of a subject fasta file, on both strands. K-mers of
+    the subject are indexed every step positions, with step chosen so that every match of the
+    minimal length contains an indexed k-mer. Each query k-mer found in the index is extended
+    into a maximal exact match, skipping the k-mers already covered by a previous match on the
+    same diagonal. Matches are returned as BlastHit objects with blast coordinates and have the
+    same call interface as pyBlast.Blastn so that masking and reports are unchanged.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    # Maximal length of the indexed k-mers
+    MAX_KMER = 20
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, ref_path, min_length=100):
+        """
+        Index the subject fasta file
+        @param ref_path Path to the subject fasta file
+        @param min_length Minimal length of the exact matches
+        """
+        assert min_length > 0, "The minimal length of matches should be > 0"
+        self.ref_path = ref_path
+        self.min_length = min_length
+        self.kmer = min(self.MAX_KMER, min_length)
+        self.step = min_length-self.kmer+1
+
+        self.subject_dict = read_fasta(ref_path)
+        self.index = {}
+        for s_id, s_seq in self.subject_dict.items():
+            for pos in xrange(0, len(s_seq)-self.kmer+1, self.step):
+                kmer = s_seq[pos:pos+self.kmer]
+                if "N" not in kmer:
+                    self.index.setdefault(kmer, []).append((s_id, pos))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def __call__ (self, query_path, blastn_exec=None, task=None, evalue=None, best_query_hit=False):
+        """
+        Find the exact matches between the sequences of a query fasta file and the subject. The
+        blast options are accepted for compatibility and ignored
+        @return A list of BlastHit objects
+        """
+        hit_list = []
+        for q_id, q_seq in read_fasta(query_path).items():
+            hit_list.extend(self._find_matches(q_id, q_seq, "+"))
+            hit_list.extend(self._find_matches(q_id, reverse_complement(q_seq), "-"))
+
+        return best_query_hits(hit_list) if best_query_hit else hit_list
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _find_matches (self, q_id, q_seq, strand):
+        """
+        Find the maximal exact matches of a query sequence given on one strand
+        @param q_seq Query sequence, reverse complemented if strand is "-"
+        """
+        hit_list = []
+        q_len = len(q_seq)
+        # End of the last match found on each diagonal
+        covered_dict = {}
+
+        for q_pos in xrange(q_len-self.kmer+1):
+            for s_id, s_pos in self.index.get(q_seq[q_pos:q_pos+self.kmer], []):
+                diagonal = (s_id, s_pos-q_pos)
+                if covered_dict.get(diagonal, -1) > q_pos:
+                    continue
+
+                # Extend the seed into a maximal exact match
+                s_seq = self.subject_dict[s_id]
+                start, end = 0, self.kmer
+                while q_pos+end < q_len and s_pos+end < len(s_seq) and \
+                    q_seq[q_pos+end] == s_seq[s_pos+end] != "N":
+                    end += 1
+                while q_pos+start > 0 and s_pos+start > 0 and \
+                    q_seq[q_pos+start-1] == s_seq[s_pos+start-1] != "N":
+                    start -= 1
+
+                covered_dict[diagonal] = q_pos+end
+                if end-start >= self.min_length:
+                    hit_list.append(self._make_hit(q_id, s_id, q_seq[q_pos+start:q_pos+end],
+                        q_pos+start, q_pos+end, s_pos+start, s_pos+end, q_len, strand))
+
+        return hit_list
+
+    def _make_hit (self, q_id, s_id, match, q_start, q_end, s_start, s_end, q_len, strand):
+        """
+        Create a BlastHit from 0-based half-open coordinates. As in blast, query coordinates are
+        given on the forward strand and the subject coordinates are reversed for minus strand hits
+        """
+        length = q_end-q_start
+        if strand == "-":
+            q_start, q_end = q_len-q_end, q_len-q_start
+            match = reverse_complement(match)
+            s_start, s_end = s_end, s_start+1
+        else:
+            s_start, s_end = s_start+1, s_end
+
+        return BlastHit (
+            q_id = q_id,
+            s_id = s_id,
+            identity = 100.0,
+            length = length,
+            mis = 0,
+            gap = 0,
+            q_start = q_start+1,
+            q_end = q_end,
+            s_start = s_start,
+            s_end = s_end,
+            evalue = 0.0,
+            bscore = float(length),
+            q_seq = match)
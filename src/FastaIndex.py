@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions and classes for RefMasker to index fasta files with samtools compatible
+            .fai indexes and to read their sequences from a memory map of the file
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from os import path
+from mmap import mmap, ACCESS_READ
+
+# Third party import
+import numpy as np
+
+# Extension of the index files, appended to the name of the fasta file
+FAI_EXT = ".fai"
+
+#~~~~~~~ FAI INDEX ~~~~~~~#
+
+def fai_path (fasta):
+    return fasta+FAI_EXT
+
+def is_current (fasta, fai=None):
+    """ True if the index exists and was written after the last modification of the fasta file """
+    fai = fai or fai_path(fasta)
+    return path.isfile(fai) and path.getmtime(fai) >= path.getmtime(fasta)
+
+def build_fai (fasta, fai=None):
+    """
+    Scan a fasta file and write its index in the samtools .fai format: name, length, offset of the
+    first base, number of bases per line and number of bytes per line of each sequence. All the
+    lines of a sequence except the last one must have the same length
+    @param fasta Path to an uncompressed fasta file
+    @param fai Path of the index file to write (default = fasta path + .fai)
+    @return The list of (name, length, offset, line_bases, line_width) entries of the index
+    """
+    fai = fai or fai_path(fasta)
+    entry_list = []
+    entry = None
+    offset = 0
+
+    with open(fasta, "rb") as fp:
+        for line in fp:
+            if line.startswith(">"):
+                if entry:
+                    entry_list.append(_fai_entry(entry))
+                name = line[1:].split(None, 1)
+                if not name:
+                    raise ValueError("Sequence without name in {}".format(fasta))
+                # Name, length, offset, line_bases, line_width and end of sequence flag
+                entry = [name[0], 0, offset+len(line), 0, 0, False]
+
+            elif entry is None:
+                if line.strip():
+                    raise ValueError("{} does not start with a fasta header".format(fasta))
+
+            else:
+                n_bases = len(line.rstrip("\r\n"))
+                if n_bases and entry[5]:
+                    raise ValueError("Different line length in sequence {} of {}".format(
+                        entry[0], fasta))
+                if not entry[1]:
+                    entry[3], entry[4] = n_bases, len(line)
+                elif n_bases > entry[3]:
+                    raise ValueError("Different line length in sequence {} of {}".format(
+                        entry[0], fasta))
+                # A line shorter than the first one can only be the last line of the sequence
+                entry[5] = not n_bases or n_bases < entry[3] or len(line) != entry[4]
+                entry[1] += n_bases
+
+            offset += len(line)
+
+    if entry:
+        entry_list.append(_fai_entry(entry))
+
+    return write_fai(fai, entry_list)
+
+def _fai_entry (entry):
+    # Empty sequences have no line
+    return tuple(entry[0:5]) if entry[1] else (entry[0], 0, entry[2], 0, 0)
+
+def write_fai (fai, entry_list):
+    """
+    Write a samtools .fai index
+    @param entry_list List of (name, length, offset, line_bases, line_width) entries
+    @return The list of entries
+    """
+    with open(fai, "w") as fp:
+        for entry in entry_list:
+            fp.write("{}\t{}\t{}\t{}\t{}\n".format(*entry))
+    return entry_list
+
+def read_fai (fai):
+    """
+    Read a samtools .fai index
+    @return The list of (name, length, offset, line_bases, line_width) entries of the index
+    """
+    entry_list = []
+    with open(fai, "r") as fp:
+        for line in fp:
+            field = line.rstrip("\r\n").split("\t")
+            entry_list.append(tuple([field[0]]+[int(i) for i in field[1:5]]))
+    return entry_list
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class FastaRecord(object):
+    """
+    Sequence of a fasta file read from a memory map of the file through its .fai entry. Slices
+    return strings of bases without the line terminators and the views method gives access to
+    the bases of each line of a slice without copying them
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, view, name, length, offset, line_bases, line_width):
+        """
+        @param view Memoryview of the bytes of the whole fasta file
+        @param name, length, offset, line_bases, line_width Fields of the .fai entry
+        """
+        self.view = view
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PROPERTIES AND MAGIC~~~~~~~#
+
+    def __len__ (self):
+        return self.length
+
+    def __str__ (self):
+        return self[0:self.length]
+
+    def __getitem__ (self, key):
+        """ Return the bases of a slice or of a single position as a string """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return str(self)[key]
+            return "".join([view.tobytes() for view in self.views(start, stop)])
+
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("Position out of the sequence {}".format(self.name))
+        return self[key:key+1]
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def file_offset (self, pos):
+        """ Position in the fasta file of a position of the sequence """
+        return self.offset + (pos//self.line_bases)*self.line_width + pos%self.line_bases
+
+    def views (self, start=0, stop=None):
+        """
+        Iterate over the bases of a slice of the sequence, line by line, as memoryviews of the
+        memory mapped fasta file
+        @param start Start position of the slice (0-based)
+        @param stop End position of the slice, excluded (default = end of the sequence)
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        while start < stop:
+            line_stop = min(stop, (start//self.line_bases+1)*self.line_bases)
+            pos = self.file_offset(start)
+            yield self.view[pos:pos+line_stop-start]
+            start = line_stop
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class FastaStore(object):
+    """
+    Read only access to the sequences of an uncompressed fasta file by name. The file is indexed
+    once in the samtools .fai format, reusing an existing index if it is up to date, then memory
+    mapped so that opening a large file costs only the scan of the index and the pages of the
+    sequences actually read
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, fasta, fai=None):
+        """
+        @param fasta Path to an uncompressed fasta file
+        @param fai Path of the index file, created if needed (default = fasta path + .fai)
+        """
+        self.fasta = fasta
+        self.fai = fai or fai_path(fasta)
+
+        if is_current(self.fasta, self.fai):
+            entry_list = read_fai(self.fai)
+        else:
+            entry_list = build_fai(self.fasta, self.fai)
+
+        # The map is closed once the store and all its records are deleted
+        if path.getsize(self.fasta):
+            with open(self.fasta, "rb") as fp:
+                view = memoryview(np.frombuffer(mmap(fp.fileno(), 0, access=ACCESS_READ),
+                    dtype=np.uint8))
+        else:
+            view = memoryview(np.empty(0, dtype=np.uint8))
+
+        self.record_list = [FastaRecord(view, *entry) for entry in entry_list]
+        self.record_dict = dict([(record.name, record) for record in self.record_list])
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PROPERTIES AND MAGIC~~~~~~~#
+
+    def __len__ (self):
+        return len(self.record_list)
+
+    def __getitem__ (self, name):
+        return self.record_dict[name]
+
+    def __iter__ (self):
+        return iter(self.keys())
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def keys (self):
+        """ Names of the sequences in the order of the file """
+        return [record.name for record in self.record_list]
+
+    def items (self):
+        """ List of (name, FastaRecord) in the order of the file, including duplicated names """
+        return [(record.name, record) for record in self.record_list]
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions and classes for RefMasker to write masked fasta sequences by blocks of
+            bounded size, in lines of fixed width, or to mask them in place in a copy of the source
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from os import path
+from mmap import mmap
+from shutil import copyfileobj
+
+# Third party import
+import numpy as np
+
+# Local imports
+from MaskEngine import MASK_CHAR, merge_intervals
+
+# Maximal number of bases read from the source or written at once
+WRITE_BLOCK = 1048576
+# Block of masking characters allocated once and sliced for each masked interval
+MASK_BLOCK = MASK_CHAR*WRITE_BLOCK
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class WrappedWriter(object):
+    """
+    Write the bases of a sequence received by blocks of any size in lines of a fixed width. The
+    line break of a full line is only written when the next bases are received so that the last
+    line is never followed by an empty line
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, handle, line_width=0):
+        """
+        @param handle File object open for writing
+        @param line_width Number of bases per line. 0 to write the sequence on a single line
+        """
+        self.handle = handle
+        self.line_width = line_width
+        # Number of bases written in the current line
+        self.column = 0
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def write (self, bases):
+        """ Write a block of bases, following the bases already written """
+        if not bases:
+            return
+        if not self.line_width:
+            self.handle.write(bases)
+            return
+
+        # Fill the current line then cut the remaining bases in full lines
+        first = self.line_width-self.column
+        line_list = [bases[:first]]
+        line_list.extend([bases[i:i+self.line_width] for i in xrange(first, len(bases),
+            self.line_width)])
+        self.handle.write("\n".join(line_list))
+        self.column = self.column+len(bases) if len(line_list) == 1 else len(line_list[-1])
+
+#~~~~~~~ WRITING ~~~~~~~#
+
+def write_sequence (handle, name, seq_record, start_array=(), end_array=(), line_width=0):
+    """
+    Write a sequence in fasta format, masked with a list of intervals. Unmasked regions are read
+    from the source record and masked regions are written from a block of masking characters,
+    never more than WRITE_BLOCK bases at once, so that the memory used does not depend on the
+    length of the sequence
+    @param handle File object open for writing
+    @param name Name of the sequence written in the header
+    @param seq_record Source sequence supporting len and slicing
+    @param start_array Array of the start positions of the intervals to mask
+    @param end_array Array of the end positions of the intervals to mask
+    @param line_width Number of bases per line. 0 to write the sequence on a single line
+    @return The .fai entry of the sequence, with the offset given by the tell method of the handle
+    """
+    handle.write(">{}\n".format(name))
+    writer = WrappedWriter(handle, line_width)
+    seq_len = len(seq_record)
+    offset = handle.tell()
+    start_array, end_array = merge_intervals(start_array, end_array)
+
+    pos = 0
+    for start, end in zip(start_array.tolist()+[seq_len], end_array.tolist()+[seq_len]):
+        for block_start in xrange(pos, start, WRITE_BLOCK):
+            writer.write(seq_record[block_start:min(block_start+WRITE_BLOCK, start)])
+        for block_start in xrange(start, end, WRITE_BLOCK):
+            writer.write(MASK_BLOCK[:min(WRITE_BLOCK, end-block_start)])
+        pos = end
+
+    handle.write("\n")
+
+    # Index entry of the sequence as written
+    if not seq_len:
+        return (name, 0, offset, 0, 0)
+    line_bases = line_width or seq_len
+    return (name, seq_len, offset, line_bases, line_bases+1)
+
+#~~~~~~~ IN PLACE MASKING ~~~~~~~#
+
+def mask_fasta_copy (fasta, dst, interval_list):
+    """
+    Copy a fasta file by blocks then mask intervals of its sequences in place in a memory map of
+    the copy. The positions of the intervals are translated in file offsets with the .fai entries
+    of the sequences, so that only the masked bytes are written. The headers and the line layout
+    of the source file are kept
+    @param fasta Path to the uncompressed source fasta file
+    @param dst Path of the masked fasta file to create
+    @param interval_list List of (FastaRecord, start_array, end_array) of the sequences to mask
+    @return The path of the masked fasta file
+    """
+    with open(fasta, "rb") as in_handle:
+        with open(dst, "wb") as out_handle:
+            copyfileobj(in_handle, out_handle, WRITE_BLOCK)
+
+    if not path.getsize(dst):
+        return dst
+
+    with open(dst, "r+b") as fp:
+        file_map = mmap(fp.fileno(), 0)
+        byte_array = np.frombuffer(file_map, dtype=np.uint8)
+        for record, start_array, end_array in interval_list:
+            start_array, end_array = merge_intervals(start_array, end_array)
+            for start, end in zip(start_array.tolist(), end_array.tolist()):
+                _mask_file_range(byte_array, record, start, end)
+
+        # The array has to be released before the map is closed
+        del byte_array
+        file_map.flush()
+        file_map.close()
+
+    return dst
+
+def _mask_file_range (byte_array, record, start, end):
+    """ Mask the bytes of an interval of a sequence, line by line through a 2D view of the lines """
+    line_bases, line_width = record.line_bases, record.line_width
+    first_line, last_line = start//line_bases, (end-1)//line_bases
+
+    if first_line == last_line:
+        byte_array[record.file_offset(start):record.file_offset(end-1)+1] = ord(MASK_CHAR)
+        return
+
+    # Partial first and last lines, then the full lines between them without line terminators
+    byte_array[record.file_offset(start):
+        record.file_offset((first_line+1)*line_bases-1)+1] = ord(MASK_CHAR)
+    byte_array[record.file_offset(last_line*line_bases):record.file_offset(end-1)+1] = ord(MASK_CHAR)
+    if last_line > first_line+1:
+        line_array = byte_array[record.offset+(first_line+1)*line_width:
+            record.offset+last_line*line_width].reshape(-1, line_width)
+        line_array[:, :line_bases] = ord(MASK_CHAR)
@@ -11,9 +11,10 @@
 """
 
 # Standard library imports
-from os import access, R_OK, path
+from os import access, R_OK, path, link
 from gzip import open as gopen
-from shutil import copy
+from shutil import copy, copyfileobj
+from hashlib import sha1
 
 #~~~~~~~ PREDICATES ~~~~~~~#
 
@@ -52,10 +53,19 @@ def rm_blank (name, replace=""):
     Blanks at extremities are always removed and nor replaced """
     return replace.join(name.split())
 
+def file_checksum (fp, block_size=1048576):
+    """ Return the SHA1 hexdigest of the content of a file read by blocks """
+    checksum = sha1()
+    with open(fp, "rb") as handle:
+        for block in iter(lambda: handle.read(block_size), ""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
 #~~~~~~~ FILE MANIPULATION ~~~~~~~#
 
-def gunzip (src, dst):
+def gunzip (src, dst, buffer_size=1048576):
     """
+    Decompress a file by blocks of bounded size so that it is never loaded in memory
     @param source Path of the input compressed file
     @param destination Path to a directory or a file where source will be extracted. If destination
     is a directory, the file will be extracted into and automatically renamed.
@@ -69,7 +79,7 @@ def gunzip (src, dst):
     with gopen(src, 'rb') as in_handle:
         with open(dst, "wb") as out_handle:
         # Write input file in output file
-            out_handle.write (in_handle.read())
+            copyfileobj(in_handle, out_handle, buffer_size)
 
     return dst
 
@@ -87,3 +97,23 @@ def cp (src, dst):
     copy(src, dst)
 
     return dst
+
+def link_or_copy (src, dst):
+    """
+    Create a hard link of a file, or copy it if the link cannot be created (other file system,
+    file system without hard links or permission denied)
+    @param source Path of the input file
+    @param destination Path to a directory or a file where source will be linked. If destination
+    is a directory, the file will be linked into and automatically renamed.
+    @return The path of the destination file
+    """
+    # Generate a automatic name in the directory from the source file name
+    if path.isdir(dst):
+        dst = path.join(dst, file_name(src))
+
+    try:
+        link(src, dst)
+    except OSError:
+        copy(src, dst)
+
+    return dst
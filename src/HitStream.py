@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to run several searches at the same time and to stream
+            their hits by batches as soon as they are parsed
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import sys
+from threading import Thread, BoundedSemaphore, Event
+from Queue import Queue, Full
+
+# Number of hits sent at once to the consumer
+BATCH_SIZE = 10000
+
+# Number of batches waiting in the queue of a search before its producer thread blocks
+MAX_BATCHES = 4
+
+# Time in seconds between two checks of the stop signal by a blocked producer thread
+POLL_TIME = 0.5
+
+#~~~~~~~ PRODUCER SIDE ~~~~~~~#
+
+def _put (queue, item, stop):
+    """ Put an item in a bounded queue unless the stream is stopped. Return False if stopped """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=POLL_TIME)
+            return True
+        except Full:
+            continue
+    return False
+
+def _produce (db, query_path, queue, slots, stop):
+    """ Run a search and put its hits by batches in its queue, followed by None """
+    try:
+        search = db.search(query_path)
+        batch = []
+        for hit in search:
+            batch.append(hit)
+            if len(batch) == BATCH_SIZE:
+                if not _put(queue, batch, stop):
+                    # Closing a generator of blastn hits kills the blastn process
+                    if hasattr(search, "close"):
+                        search.close()
+                    return
+                batch = []
+        if batch:
+            _put(queue, batch, stop)
+        _put(queue, None, stop)
+    except Exception:
+        _put(queue, sys.exc_info(), stop)
+    finally:
+        slots.release()
+
+#~~~~~~~ CONSUMER SIDE ~~~~~~~#
+
+def stream_query_list (db, query_path_list, n_workers=1, callback=None):
+    """
+    Search a list of query fasta files against a database with at most n_workers searches
+    running at the same time, each one in its own thread. The hits are passed to the callback by
+    batches as soon as they are parsed, following the order of query_path_list, so that the
+    results do not depend on the number of workers. A search blocks when MAX_BATCHES batches are
+    waiting, which bounds the number of hits held in memory whatever the size of the results.
+    Searches are started in the order of query_path_list, so the search consumed is always
+    running or completed
+    @param db AlignerDb object of the subject database, whose search method yields the hits
+    @param query_path_list List of paths to query fasta files
+    @param n_workers Number of searches running at the same time
+    @param callback Function called with the index of the query and each batch of hits
+    @return The number of hits found for each query, in the same order as query_path_list
+    """
+    queue_list = [Queue(maxsize=MAX_BATCHES) for _ in query_path_list]
+    slots = BoundedSemaphore(n_workers)
+    stop = Event()
+
+    def launch():
+        for query_path, queue in zip(query_path_list, queue_list):
+            slots.acquire()
+            if stop.is_set():
+                slots.release()
+                return
+            thread = Thread(target=_produce, args=(db, query_path, queue, slots, stop))
+            thread.daemon = True
+            thread.start()
+
+    launcher = Thread(target=launch)
+    launcher.daemon = True
+    launcher.start()
+
+    n_hit_list = [0]*len(query_path_list)
+    try:
+        for j, queue in enumerate(queue_list):
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                # Exception raised in the producer thread
+                if isinstance(item, tuple):
+                    raise item[0], item[1], item[2]
+                n_hit_list[j] += len(item)
+                if callback:
+                    callback(j, item)
+    finally:
+        # Stop the remaining searches in case of error
+        stop.set()
+
+    return n_hit_list
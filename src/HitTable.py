@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to store the blast hits of a Sequence in typed columns
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from collections import OrderedDict
+
+# Third party import
+import numpy as np
+
+# Local imports
+from pyBlast.BlastHit import BlastHit
+
+#~~~~~~~ HELPER FUNCTIONS ~~~~~~~#
+
+def subject_intervals (hit_list, s_id, s_len):
+    """
+    Validate a batch of hits found in a subject sequence and return their subject coordinates,
+    normalized so that start < end whatever the orientation
+    @param s_id Name of the subject sequence
+    @param s_len Length of the subject sequence
+    @return The arrays of start and end positions and of the reverse orientation flags of the hits
+    """
+    # Hit cannot have borders outside the sequence size
+    s_start = np.array([hit.s_start for hit in hit_list], dtype=np.int64)
+    s_end = np.array([hit.s_end for hit in hit_list], dtype=np.int64)
+    if (s_start > s_len).any() or (s_end > s_len).any():
+        raise ValueError, ("Invalid hit: Outside of sequence borders")
+    if any([hit.s_id != s_id for hit in hit_list]):
+        raise ValueError, ("Invalid hit: hit subject name does not match Sequence name")
+
+    # Reverse coordinates of the subject if the orientation of read is negative
+    s_reverse = np.array([hit.s_orient == "-" for hit in hit_list], dtype=np.bool_)
+    return np.where(s_reverse, s_end, s_start), np.where(s_reverse, s_start, s_end), s_reverse
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class HitRecord(object):
+    """
+    Light record of a single hit read from a HitTable, with the attributes of a BlastHit whose
+    coordinates were normalized by the Sequence
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    __slots__ = ["q_id", "s_id", "identity", "length", "mis", "gap", "q_start", "q_end", "s_start",
+        "s_end", "evalue", "bscore", "q_orient", "s_orient"]
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def blast_hit (self):
+        """ Rebuild a BlastHit with the normalized coordinates of the record """
+        hit = BlastHit (
+            q_id = self.q_id,
+            s_id = self.s_id,
+            identity = self.identity,
+            length = self.length,
+            mis = self.mis,
+            gap = self.gap,
+            # Blast coordinates giving the orientation of the query and of the subject
+            q_start = self.q_end if self.q_orient == "-" else self.q_start+1,
+            q_end = self.q_start+1 if self.q_orient == "-" else self.q_end,
+            s_start = self.s_end if self.s_orient == "-" else self.s_start+1,
+            s_end = self.s_start+1 if self.s_orient == "-" else self.s_end,
+            evalue = self.evalue,
+            bscore = self.bscore)
+        hit.q_start, hit.q_end = self.q_start, self.q_end
+        hit.s_start, hit.s_end = self.s_start, self.s_end
+        return hit
+
+    def get_report (self, full=False):
+        return self.blast_hit().get_report(full=full)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class HitTable(object):
+    """
+    Columnar storage of the hits of a single subject Sequence in typed numpy arrays, using a few
+    tens of bytes per hit instead of a BlastHit object. Hits are added by batches, validated and
+    normalized with vectorized operations so that start < end whatever the orientation. Query ids
+    are stored as indexes in the list of query names. The sequence of the query is not kept.
+    Indexing and iteration return HitRecord objects for the reports.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    COLUMNS = OrderedDict([
+        ("s_start", np.int64),
+        ("s_end", np.int64),
+        ("s_reverse", np.bool_),
+        ("q_index", np.int32),
+        ("q_start", np.int64),
+        ("q_end", np.int64),
+        ("q_reverse", np.bool_),
+        ("identity", np.float64),
+        ("evalue", np.float64),
+        ("bscore", np.float64),
+        ("length", np.int32),
+        ("mis", np.int32),
+        ("gap", np.int32)])
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, s_id, s_len):
+        """
+        @param s_id Name of the subject Sequence
+        @param s_len Length of the subject Sequence
+        """
+        self.s_id = s_id
+        self.s_len = s_len
+        self.q_names = []
+        self.q_index = {}
+        # Column arrays of each batch, concatenated when the columns are read
+        self._batches = []
+        self._n_hit = 0
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PROPERTIES AND MAGIC~~~~~~~#
+
+    def __len__ (self):
+        return self._n_hit
+
+    def __getitem__ (self, i):
+        columns = self.columns()
+        row = dict([(name, columns[name][i].item()) for name in self.COLUMNS])
+        return HitRecord (
+            q_id = self.q_names[row["q_index"]],
+            s_id = self.s_id,
+            identity = row["identity"],
+            length = row["length"],
+            mis = row["mis"],
+            gap = row["gap"],
+            q_start = row["q_start"],
+            q_end = row["q_end"],
+            s_start = row["s_start"],
+            s_end = row["s_end"],
+            evalue = row["evalue"],
+            bscore = row["bscore"],
+            q_orient = "-" if row["q_reverse"] else "+",
+            s_orient = "-" if row["s_reverse"] else "+")
+
+    def __iter__ (self):
+        for i in xrange(self._n_hit):
+            yield self[i]
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def append (self, hit_list):
+        """
+        Validate and add a batch of BlastHit objects. Either all the hits are added or none
+        @param hit_list A list of BlastHit objects found in the subject Sequence
+        @return The arrays of the normalized subject start and end positions of the hits
+        """
+        if not hit_list:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        s_start, s_end, s_reverse = subject_intervals(hit_list, self.s_id, self.s_len)
+
+        batch = {
+            "s_start": s_start,
+            "s_end": s_end,
+            "s_reverse": s_reverse,
+            "q_reverse": np.array([hit.q_orient == "-" for hit in hit_list], dtype=np.bool_),
+            "q_index": np.array([self._query_index(hit.q_id) for hit in hit_list], dtype=np.int32)}
+        for name in ["identity", "evalue", "bscore", "length", "mis", "gap"]:
+            batch[name] = np.array([getattr(hit, name) for hit in hit_list], dtype=self.COLUMNS[name])
+
+        # Reverse coordinates of the query if its orientation is negative
+        q_start = np.array([hit.q_start for hit in hit_list], dtype=np.int64)
+        q_end = np.array([hit.q_end for hit in hit_list], dtype=np.int64)
+        batch["q_start"] = np.where(batch["q_reverse"], q_end, q_start)
+        batch["q_end"] = np.where(batch["q_reverse"], q_start, q_end)
+
+        self._batches.append(batch)
+        self._n_hit += len(hit_list)
+        return s_start, s_end
+
+    def columns (self):
+        """ Return a dict of the column arrays of all the hits, in the order they were added """
+        if len(self._batches) != 1:
+            self._batches = [dict([(name, np.concatenate([batch[name] for batch in self._batches]
+                if self._batches else np.empty(0, dtype=dtype))) for name, dtype in self.COLUMNS.items()])]
+        return self._batches[0]
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _query_index (self, q_id):
+        if q_id not in self.q_index:
+            self.q_index[q_id] = len(self.q_names)
+            self.q_names.append(q_id)
+        return self.q_index[q_id]
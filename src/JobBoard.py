@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to share blast jobs between processes running on several
+            hosts through a run directory on a shared file system
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import json
+import errno
+from os import path, makedirs, listdir, remove, rename, getpid, kill
+from os import open as os_open, write as os_write, close as os_close
+from os import O_CREAT, O_EXCL, O_WRONLY
+from shutil import rmtree
+from tempfile import mkdtemp
+from itertools import groupby
+from socket import gethostname
+from time import sleep
+
+# Local imports
+from RunJournal import RunJournal
+from BlastDbCache import BlastDbCache
+from StageCache import StageCache
+from Aligner import get_aligner
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class JobBoard(object):
+    """
+    Board of the blast jobs of a distributed run stored in its run directory. The coordinator
+    writes a manifest listing the References staged in the run directory, the blast parameters and
+    the (subject, query) pairs to blast. Any number of workers started on hosts sharing the run
+    directory claim the jobs by creating a lock file with O_CREAT|O_EXCL, then write the hit list
+    of each job in the hit directory of the run journal. A job is completed once its hit file
+    exists. Locks left by dead workers of the same host are removed automatically; locks of dead
+    workers on other hosts have to be removed by hand to release their jobs. Fasta files staged
+    in a stage cache that the worker cannot read are staged again from their source file.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    MANIFEST = "manifest.json"
+    LOCK_DIR = "locks"
+
+    # Time in seconds between two checks of the jobs claimed by other workers
+    POLL_TIME = 10
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, run_dir):
+        """
+        @param run_dir Path to the run directory shared by the coordinator and the workers
+        """
+        self.run_dir = run_dir
+        self.manifest = path.join(run_dir, self.MANIFEST)
+        self.lock_dir = path.join(run_dir, self.LOCK_DIR)
+        self.hit_dir = path.join(run_dir, RunJournal.HIT_DIR)
+        # Temporary stage cache of the worker, created if needed
+        self.stage_cache = None
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def write_manifest (self, params, reference_list, job_list):
+        """
+        Write the manifest of a distributed run and remove the locks of a previous run
+        @param params Dict of the blast parameters used by the workers
+        @param reference_list List of the References, staged in a directory shared by all hosts
+        or in a stage cache. The source fasta files are listed to stage them again on the hosts
+        that cannot read the stage cache
+        @param job_list List of dicts with the index of the subject and of the query Reference and
+        the name of the hit file of each job
+        """
+        if not path.isdir(self.lock_dir):
+            makedirs(self.lock_dir)
+        for name in listdir(self.lock_dir):
+            remove(path.join(self.lock_dir, name))
+
+        manifest = {
+            "params": params,
+            "references": [{"name": ref.name, "fasta": path.abspath(ref.fasta),
+                "source_fasta": path.abspath(ref.source_fasta),
+                "search_fasta": path.abspath(ref.search_fasta) if ref.search_fasta else "",
+                "search_checksum": ref.search_checksum if ref.search_fasta else "",
+                "checksum": ref.checksum} for ref in reference_list],
+            "jobs": job_list}
+
+        temp_manifest = "{}.{}.tmp".format(self.manifest, getpid())
+        with open(temp_manifest, "w") as fp:
+            json.dump(manifest, fp, indent=2)
+        rename(temp_manifest, self.manifest)
+
+    def load_manifest (self):
+        assert path.isfile(self.manifest), "No job manifest in {}".format(self.run_dir)
+        with open(self.manifest, "r") as fp:
+            return json.load(fp)
+
+    def is_done (self, job):
+        return path.isfile(path.join(self.hit_dir, job["hit_file"]))
+
+    def n_left (self):
+        """ Number of jobs of the manifest not completed yet """
+        return len([job for job in self.load_manifest()["jobs"] if not self.is_done(job)])
+
+    def work (self):
+        """
+        Claim and run the jobs of the manifest that are neither completed nor claimed by another
+        worker. The blast database of a subject Reference is kept while the worker runs jobs of
+        this subject
+        @return The number of jobs completed by this worker
+        """
+        manifest = self.load_manifest()
+        params = manifest["params"]
+        ref_list = manifest["references"]
+        n_done = 0
+
+        try:
+            for s, job_group in groupby(manifest["jobs"], key=lambda job: job["subject"]):
+                blastn = None
+                try:
+                    for job in job_group:
+                        if self.is_done(job) or not self.claim(job):
+                            continue
+                        try:
+                            subject, query = ref_list[s], ref_list[job["query"]]
+                            print (" * Blast \"{}\" against \"{}\"".format(query["name"],
+                                subject["name"]))
+                            if blastn is None:
+                                blastn = self._blast_db(params, subject).__enter__()
+
+                            hit_list = blastn (
+                                query_path = self._local_fasta(query, "fasta"),
+                                best_query_hit = params["best_query_hit"])
+
+                            RunJournal.dump_hits(path.join(self.hit_dir, job["hit_file"]),
+                                hit_list)
+                            n_done += 1
+                        finally:
+                            self.release(job)
+                finally:
+                    if blastn is not None:
+                        blastn.__exit__(None, None, None)
+        finally:
+            # Fasta files staged again by this worker are removed
+            if self.stage_cache:
+                rmtree(self.stage_cache.cache_dir)
+                self.stage_cache = None
+
+        return n_done
+
+    def wait (self):
+        """
+        Work on the available jobs until all the jobs of the manifest are completed, waiting for
+        the jobs claimed by other workers. Jobs released by failed workers are run again
+        """
+        while True:
+            self.work()
+            n_left = self.n_left()
+            if not n_left:
+                return
+            print (" * Wait for {} job(s) claimed by other workers".format(n_left))
+            sleep(self.POLL_TIME)
+
+    def claim (self, job):
+        """ Create the lock file of a job. Return False if the job is claimed by another worker """
+        lock = self._lock_path(job)
+        try:
+            fd = os_open(lock, O_CREAT|O_EXCL|O_WRONLY)
+        except OSError as E:
+            if E.errno != errno.EEXIST or not self._is_stale(lock):
+                return False
+            # Remove the lock of a dead worker and try again once
+            self.release(job)
+            try:
+                fd = os_open(lock, O_CREAT|O_EXCL|O_WRONLY)
+            except OSError:
+                return False
+
+        os_write(fd, "{}\t{}\n".format(gethostname(), getpid()))
+        os_close(fd)
+
+        # The job may have been completed between the check and the claim
+        if self.is_done(job):
+            self.release(job)
+            return False
+        return True
+
+    def release (self, job):
+        try:
+            remove(self._lock_path(job))
+        except OSError:
+            pass
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _lock_path (self, job):
+        return path.join(self.lock_dir, job["hit_file"]+".lock")
+
+    def _is_stale (self, lock):
+        """ True if a lock was created by a process of the current host that does not exist anymore """
+        try:
+            with open(lock, "r") as fp:
+                host, pid = fp.read().split()
+            if host != gethostname():
+                return False
+            kill(int(pid), 0)
+            return False
+        except (IOError, ValueError):
+            # Lock being written or removed in the meantime
+            return False
+        except OSError as E:
+            return E.errno == errno.ESRCH
+
+    def _blast_db (self, params, subject):
+        """
+        Return the database of the subject Reference built by the aligner backend, from the fasta
+        file of the Sequences that are not excluded from the searches
+        """
+        if params["db_cache_dir"]:
+            db_cache = BlastDbCache(params["db_cache_dir"], params["makeblastdb_exec"],
+                params["db_cache_max_age"])
+        else:
+            db_cache = None
+        aligner = get_aligner(params["aligner"], db_cache=db_cache, **params)
+        return aligner.database(self._local_fasta(subject, "search_fasta"),
+            subject["search_checksum"])
+
+    def _local_fasta (self, reference, key):
+        """
+        Return a fasta file of a Reference of the manifest readable by this worker. A staged fasta
+        file missing on this host, on a disk of the coordinator, is staged again from its source
+        file in the temporary stage cache of the worker. Staged files are named after the checksum
+        of their content, so a staged file found at the same path has the same content
+        @param key Key of the fasta file in the record of the Reference (fasta or search_fasta)
+        """
+        fasta = reference[key]
+        if path.isfile(fasta):
+            return fasta
+
+        # Only the staged file can be restaged, the other files are in the run directory
+        assert fasta == reference["fasta"], "{} cannot be read from {}".format(fasta,
+            gethostname())
+        if not self.stage_cache:
+            self.stage_cache = StageCache(mkdtemp())
+        staged, checksum = self.stage_cache.stage(reference["source_fasta"])
+        assert checksum == reference["checksum"], "{} was modified during the run".format(
+            reference["source_fasta"])
+        return staged
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to merge the hit intervals of a sequence and to mask
+            them with numpy slices
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Third party import
+import numpy as np
+
+# Character used to mask the sequences
+MASK_CHAR = "N"
+
+#~~~~~~~ INTERVAL UNION ~~~~~~~#
+
+def merge_intervals (start_array, end_array):
+    """
+    Merge half-open intervals overlapping or separated by a single base. Intervals are sorted by
+    start and a new merged interval begins where the start is greater than the running maximum of
+    the previous ends plus 1
+    @param start_array Array of the start positions of the intervals
+    @param end_array Array of the end positions of the intervals, with end > start
+    @return The arrays of the start and end positions of the merged intervals, sorted by start
+    """
+    start_array = np.asarray(start_array, dtype=np.int64)
+    end_array = np.asarray(end_array, dtype=np.int64)
+    if not len(start_array):
+        return start_array, end_array
+
+    order = start_array.argsort(kind="mergesort")
+    start_array = start_array[order]
+    max_end_array = np.maximum.accumulate(end_array[order])
+
+    # Index of the first interval of each merged interval
+    first = np.flatnonzero(np.concatenate(([True], start_array[1:] > max_end_array[:-1]+1)))
+    # The end of a merged interval is the running maximum before the next merged interval
+    last = np.concatenate((first[1:]-1, [len(start_array)-1]))
+
+    return start_array[first], max_end_array[last]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class IntervalSet(object):
+    """
+    Set of the disjoint intervals of a sequence to mask, stored in two sorted arrays. Intervals
+    added are buffered and merged with the set once the buffer is as large as the set, so that
+    the memory and the time used depend on the number of distinct masked regions rather than on
+    the number of intervals added.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    # Minimal number of buffered intervals before a merge
+    MIN_BUFFER = 1000
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self):
+        self.start_array = np.empty(0, dtype=np.int64)
+        self.end_array = np.empty(0, dtype=np.int64)
+        self._buffer = []
+        self._n_buffer = 0
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PROPERTIES AND MAGIC~~~~~~~#
+
+    def __len__ (self):
+        """ Number of disjoint intervals of the set """
+        self._merge()
+        return len(self.start_array)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def add (self, start_array, end_array):
+        """ Add a batch of half-open intervals to the set """
+        self._buffer.append((np.asarray(start_array, dtype=np.int64),
+            np.asarray(end_array, dtype=np.int64)))
+        self._n_buffer += len(self._buffer[-1][0])
+        if self._n_buffer >= max(self.MIN_BUFFER, len(self.start_array)):
+            self._merge()
+
+    def n_bases (self):
+        """ Number of bases covered by the intervals of the set """
+        start_array, end_array = self.intervals()
+        return int((end_array-start_array).sum())
+
+    def intervals (self):
+        """ Return the arrays of the start and end positions of the intervals, sorted by start """
+        self._merge()
+        return self.start_array, self.end_array
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _merge (self):
+        if not self._buffer:
+            return
+        self.start_array, self.end_array = merge_intervals(
+            np.concatenate([self.start_array]+[start for start, end in self._buffer]),
+            np.concatenate([self.end_array]+[end for start, end in self._buffer]))
+        self._buffer = []
+        self._n_buffer = 0
+
+#~~~~~~~ MASKING ~~~~~~~#
+
+def mask_sequence (seq, start_array, end_array):
+    """
+    Mask the bases of a sequence covered by a list of intervals. The merged intervals are masked
+    one slice at a time over a copy of the sequence, without any temporary array of the length of
+    the sequence
+    @param seq Sequence string
+    @param start_array Array of the start positions of the intervals
+    @param end_array Array of the end positions of the intervals
+    @return The masked sequence string and the number of bases masked
+    """
+    start_array, end_array = merge_intervals(start_array, end_array)
+    if not len(start_array):
+        return str(seq), 0
+
+    buffer = bytearray(seq)
+    base_array = np.frombuffer(buffer, dtype=np.uint8)
+
+    for start, end in zip(start_array.tolist(), end_array.tolist()):
+        base_array[start:end] = ord(MASK_CHAR)
+
+    return str(buffer), int((end_array-start_array).sum())
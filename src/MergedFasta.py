@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to merge several References in a single fasta file and
+            to attribute the blast hits found with a merged file to their original References
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from collections import OrderedDict
+
+# Separator between the reference index prefix and the original sequence id
+SEP = "__"
+
+# Maximal size of the blocks read when copying fasta files
+BUFFER_SIZE = 1048576
+
+#~~~~~~~ SEQUENCE IDS ~~~~~~~#
+
+def merged_id (index, seq_id):
+    """ Prefix a sequence id with the index of its reference """
+    return "{}{}{}".format(index, SEP, seq_id)
+
+def split_merged_id (seq_id):
+    """ Return the reference index and the original sequence id from a prefixed sequence id """
+    index, _, seq_id = seq_id.partition(SEP)
+    return int(index), seq_id
+
+#~~~~~~~ FASTA MERGING ~~~~~~~#
+
+def write_merged_fasta (reference_list, dst, index_list=None, search=False):
+    """
+    Write the fasta files of several References in a single fasta file where the id of each
+    sequence is prefixed by the index of its Reference. Files are copied by blocks of bounded size
+    so that long single line sequences are never loaded in memory
+    @param reference_list List of Reference objects to merge
+    @param dst Path of the merged fasta file to create
+    @param index_list Indexes used as prefix for each Reference (default = position in the list)
+    @param search If True the fasta files searched are merged, without the excluded Sequences
+    @return The path of the merged fasta file
+    """
+    if index_list is None:
+        index_list = range(len(reference_list))
+
+    with open(dst, "w") as out_handle:
+        for index, reference in zip(index_list, reference_list):
+            prefix = merged_id(index, "")
+            line_start = True
+
+            with open(reference.search_fasta if search else reference.fasta, "r") as in_handle:
+                for block in iter(lambda: in_handle.readline(BUFFER_SIZE), ""):
+                    if line_start and block.startswith(">"):
+                        block = ">" + prefix + block[1:].lstrip()
+                    out_handle.write(block)
+                    line_start = block.endswith("\n")
+
+            # Ensure that the next reference starts on a new line
+            if not line_start:
+                out_handle.write("\n")
+
+    return dst
+
+#~~~~~~~ HIT DEMULTIPLEXING ~~~~~~~#
+
+def demultiplex_query_hits (hit_list, index_list):
+    """
+    Sort hits obtained with a merged query file by query Reference and restore the original query
+    sequence ids
+    @param hit_list List of BlastHit objects with prefixed query ids
+    @param index_list Indexes of the References in the merged query file
+    @return A list of hit lists in the same order as index_list
+    """
+    hit_dict = OrderedDict([(index, []) for index in index_list])
+    for hit in hit_list:
+        index, hit.q_id = split_merged_id(hit.q_id)
+        hit_dict[index].append(hit)
+    return hit_dict.values()
+
+
+def best_query_hits (hit_list):
+    """
+    Keep only the hit with the highest bit score for each query sequence. The bit score is used
+    rather than the e-value since it does not depend on the size of the database or of the query,
+    so that the hits of query chunks and of merged databases can be compared. Among hits with the
+    same bit score the first one of hit_list is kept, which for a blastn output is the first
+    reported. The order of the retained hits in hit_list is preserved
+    """
+    best_dict = OrderedDict()
+    for hit in hit_list:
+        if hit.q_id not in best_dict or float(hit.bscore) > float(best_dict[hit.q_id].bscore):
+            best_dict[hit.q_id] = hit
+    best_set = set(id(hit) for hit in best_dict.values())
+    return [hit for hit in hit_list if id(hit) in best_set]
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to compute minimizer sketches of References, used to skip
+            the blast of pairs of References sharing no sequence
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import cPickle
+from os import path, rename, getpid
+from array import array
+
+# Third party import
+import numpy as np
+
+# Version of the hashes stored in the sketch files. Files of another version are computed again
+SKETCH_VERSION = 2
+
+# Maximal length of the k-mers, encoded with 2 bits per base in 64 bits integers
+MAX_K = 32
+
+# Maximal number of k-mers hashed at once, so that the memory used does not depend on the length
+# of the sequences
+KMER_BLOCK = 1048576
+
+# 2 bits code of the bases in the alphabetical order, preserving the order of the k-mers. Ambiguous
+# bases are coded 4
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate("ACGT"):
+    BASE_CODE[ord(base)] = BASE_CODE[ord(base.lower())] = code
+
+#~~~~~~~ SKETCHING ~~~~~~~#
+
+def sequence_minimizers (seq, k=15, w=10, minimizer_set=None):
+    """
+    Compute the minimizers of a DNA sequence. For each window of w consecutive k-mers the k-mer
+    with the smallest hash is retained. K-mers are canonical (smallest of the k-mer and its
+    reverse complement) so that the sketch does not depend on the strand. K-mers overlapping
+    ambiguous bases are ignored. K-mers are hashed and windows are scanned with numpy, by blocks
+    of KMER_BLOCK k-mers of each stretch of unambiguous bases
+    @param seq DNA sequence string
+    @param k Length of the k-mers, at most MAX_K
+    @param minimizer_set Set to which the hashes of minimizers are added (default = new set)
+    @return The set of the hashes of minimizers
+    """
+    assert 0 < k <= MAX_K, "k-mers are limited to {} bases".format(MAX_K)
+    if minimizer_set is None:
+        minimizer_set = set()
+
+    code_array = BASE_CODE[np.frombuffer(seq, dtype=np.uint8)]
+
+    # Start and end of the stretches of unambiguous bases
+    acgt_array = np.concatenate(([False], code_array < 4, [False]))
+    bound_array = np.flatnonzero(acgt_array[1:] != acgt_array[:-1]).reshape(-1, 2)
+
+    for start, end in bound_array.tolist():
+        n_kmer = end-start-k+1
+        if n_kmer <= 0:
+            continue
+        # The k-mers of the windows starting in a block, a stretch shorter than a window being a
+        # single window
+        for block_start in xrange(0, max(1, n_kmer-w+1), KMER_BLOCK):
+            block_end = min(n_kmer, block_start+KMER_BLOCK+w-1)
+            hash_array = kmer_hashes(code_array[start+block_start:start+block_end+k-1], k)
+            minimizer_set.update(window_minima(hash_array, w).tolist())
+
+    return minimizer_set
+
+def kmer_hashes (code_array, k):
+    """
+    Return the 32 bits hashes of the canonical k-mers of a stretch of unambiguous bases. The 2 bits
+    codes of the k-mers and of their reverse complements are computed in k vector operations,
+    then mixed with the finalizer of splitmix64
+    @param code_array Array of the 2 bits codes of the bases
+    @return An array of hashes, one per k-mer
+    """
+    n_kmer = len(code_array)-k+1
+    fwd_array = np.zeros(n_kmer, dtype=np.uint64)
+    rc_array = np.zeros(n_kmer, dtype=np.uint64)
+    for i in range(k):
+        base_array = code_array[i:i+n_kmer].astype(np.uint64)
+        fwd_array = (fwd_array << np.uint64(2)) | base_array
+        rc_array |= (np.uint64(3)-base_array) << np.uint64(2*i)
+
+    x = np.minimum(fwd_array, rc_array)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x >> np.uint64(32)
+
+def window_minima (hash_array, w):
+    """
+    Return the minimum of each window of w consecutive hashes, or the minimum of all the hashes if
+    there are less than w. The minima of windows of doubling size are computed until the largest
+    power of 2 not above w, then each window of w hashes is covered by 2 of these windows
+    """
+    if len(hash_array) < w:
+        return hash_array.min(keepdims=True)
+
+    span = 1
+    while span*2 <= w:
+        hash_array = np.minimum(hash_array[:-span], hash_array[span:])
+        span *= 2
+    return np.minimum(hash_array[:len(hash_array)-(w-span)], hash_array[w-span:])
+
+def reference_sketch (reference, k=15, w=10):
+    """ Return the set of minimizers of all the sequences of a Reference """
+    minimizer_set = set()
+    for seq in reference.seq_dict.values():
+        sequence_minimizers(str(seq.seq_record), k, w, minimizer_set)
+    return minimizer_set
+
+#~~~~~~~ SKETCH FILES ~~~~~~~#
+
+def sketch_path (fasta, sketch_dir="", k=15, w=10):
+    """
+    Return the path of the sketch file of a fasta file, in sketch_dir or next to the fasta file
+    """
+    return path.join(sketch_dir or path.dirname(path.abspath(fasta)),
+        "{}.k{}w{}.sketch".format(path.basename(fasta), k, w))
+
+def save_sketch (sketch_file, minimizer_set, checksum):
+    """
+    Save a sketch as a sorted array of 32 bits hashes with the checksum of the fasta file
+    @return False if the file cannot be written
+    """
+    temp_file = "{}.{}.tmp".format(sketch_file, getpid())
+    try:
+        with open(temp_file, "wb") as fp:
+            cPickle.dump({"checksum": checksum, "version": SKETCH_VERSION,
+                "minimizers": array("I", sorted(minimizer_set))}, fp, cPickle.HIGHEST_PROTOCOL)
+        rename(temp_file, sketch_file)
+        return True
+    except (IOError, OSError):
+        return False
+
+def load_sketch (sketch_file, checksum):
+    """
+    Load a sketch file
+    @return The set of minimizers or None if the file is missing, corrupted, was computed from
+    a different fasta file or by another version of the hashes
+    """
+    try:
+        with open(sketch_file, "rb") as fp:
+            sketch = cPickle.load(fp)
+        if sketch["checksum"] == checksum and sketch.get("version") == SKETCH_VERSION:
+            return set(sketch["minimizers"])
+    except (IOError, EOFError, KeyError, cPickle.UnpicklingError):
+        pass
+    return None
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper functions for RefMasker to split large query References in overlapping chunks
+            that can be blasted in parallel, and to merge back the hits found with the chunks
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+from os import path, makedirs
+
+# Separator between the original sequence id and the offset of the chunk in the sequence
+CHUNK_SEP = "__chunk"
+
+# Maximal length of sequence read at once when writing chunks
+BUFFER_SIZE = 1048576
+
+#~~~~~~~ SEQUENCE IDS ~~~~~~~#
+
+def chunk_id (seq_id, offset):
+    """ Add the offset of a chunk to the original sequence id """
+    return "{}{}{}".format(seq_id, CHUNK_SEP, offset)
+
+def split_chunk_id (seq_id):
+    """ Return the original sequence id and the offset of the chunk from a chunk id """
+    seq_id, _, offset = seq_id.rpartition(CHUNK_SEP)
+    return seq_id, int(offset)
+
+#~~~~~~~ CHUNKING ~~~~~~~#
+
+def chunk_windows (seq_len, chunk_size, overlap):
+    """
+    Return the list of (start, end) windows of length chunk_size covering a sequence, where each
+    window overlaps the previous one by overlap bases
+    """
+    step = chunk_size-overlap
+    window_list = []
+    start = 0
+    while True:
+        end = min(start+chunk_size, seq_len)
+        window_list.append((start, end))
+        if end >= seq_len:
+            return window_list
+        start += step
+
+def needs_chunking (reference, chunk_size):
+    """ True if at least one sequence of the Reference is longer than chunk_size """
+    return chunk_size > 0 and any([len(seq) > chunk_size for seq in reference.seq_dict.values()])
+
+def write_chunks (reference, dst_dir, chunk_size, overlap):
+    """
+    Split the sequences of a Reference longer than chunk_size in overlapping windows written each
+    in its own fasta file. Shorter sequences are written together in an additional file. All
+    sequence ids are suffixed by the offset of the chunk to allow translating hit coordinates
+    @param reference Reference object to split
+    @param dst_dir Directory where chunk files are written. Created if needed
+    @param chunk_size Length of the windows
+    @param overlap Number of bases shared by consecutive windows. Should be larger than the
+    longest expected hit
+    @return The list of paths of the chunk files
+    """
+    assert 0 <= overlap < chunk_size, "The chunk overlap should be smaller than the chunk size"
+
+    if not path.isdir(dst_dir):
+        makedirs(dst_dir)
+
+    chunk_list = []
+    short_list = []
+
+    for n, seq in enumerate(reference.seq_dict.values()):
+        if len(seq) <= chunk_size:
+            short_list.append(seq)
+            continue
+
+        # Files are named after the index of the sequence since sequence ids may contain any char
+        for start, end in chunk_windows(len(seq), chunk_size, overlap):
+            chunk_path = path.join(dst_dir, "seq{}_{}.fa".format(n, start))
+            with open(chunk_path, "w") as fp:
+                _write_window(fp, seq, start, end)
+            chunk_list.append(chunk_path)
+
+    if short_list:
+        chunk_path = path.join(dst_dir, "short_sequences.fa")
+        with open(chunk_path, "w") as fp:
+            for seq in short_list:
+                _write_window(fp, seq, 0, len(seq))
+        chunk_list.append(chunk_path)
+
+    return chunk_list
+
+def _write_window (fp, seq, start, end):
+    """ Write a window of a Sequence in an open fasta file, reading it by blocks """
+    fp.write(">{}\n".format(chunk_id(seq.name, start)))
+    for block_start in range(start, end, BUFFER_SIZE):
+        fp.write(str(seq.seq_record[block_start:min(block_start+BUFFER_SIZE, end)]))
+    fp.write("\n")
+
+#~~~~~~~ HIT MERGING ~~~~~~~#
+
+def merge_chunk_hits (hit_lists, reference, chunk_size):
+    """
+    Translate the query coordinates of hits found with chunks back to the original sequences and
+    remove the duplicated hits found in the overlap zones. Hits found twice are kept once, and
+    hits truncated by the border of a chunk are removed if they are contained in a hit found with
+    the neighbouring chunk
+    @param hit_lists List of hit lists obtained with each chunk file
+    @param reference Reference object that was split in chunks
+    @param chunk_size Length of the windows used to split the Reference
+    @return A single list of hits with original query ids and coordinates
+    """
+    hit_list = []
+    truncated_list = []
+    hit_set = set()
+
+    for hit in [hit for chunk_hit_list in hit_lists for hit in chunk_hit_list]:
+        hit.q_id, offset = split_chunk_id(hit.q_id)
+        hit.q_start += offset
+        hit.q_end += offset
+
+        key = (hit.q_id, hit.s_id, hit.q_start, hit.q_end, hit.s_start, hit.s_end)
+        if key in hit_set:
+            continue
+        hit_set.add(key)
+        hit_list.append(hit)
+
+        # A hit reaching a border of its chunk that is not a border of the sequence
+        seq_len = len(reference.seq_dict[hit.q_id])
+        chunk_end = min(offset+chunk_size, seq_len)
+        q_min, q_max = min(hit.q_start, hit.q_end), max(hit.q_start, hit.q_end)
+        if (offset > 0 and q_min <= offset) or (chunk_end < seq_len and q_max >= chunk_end):
+            truncated_list.append(hit)
+
+    # Remove the truncated hits contained in another hit between the same sequences
+    removed_set = set()
+    for hit in truncated_list:
+        for other in hit_list:
+            if other is not hit and id(other) not in removed_set and _contains(other, hit):
+                removed_set.add(id(hit))
+                break
+
+    return [hit for hit in hit_list if id(hit) not in removed_set]
+
+def _contains (hit1, hit2):
+    """ True if hit1 contains hit2 on both the query and the subject """
+    return (hit1.q_id == hit2.q_id and hit1.s_id == hit2.s_id and
+        min(hit1.q_start, hit1.q_end) <= min(hit2.q_start, hit2.q_end) and
+        max(hit1.q_start, hit1.q_end) >= max(hit2.q_start, hit2.q_end) and
+        min(hit1.s_start, hit1.s_end) <= min(hit2.s_start, hit2.s_end) and
+        max(hit1.s_start, hit1.s_end) >= max(hit2.s_start, hit2.s_end))
@@ -18,20 +18,38 @@ try:
     import ConfigParser
     import optparse
     import sys
-    from os import R_OK, access
+    from os import R_OK, access, path, makedirs, remove
+    from shutil import rmtree
+    from tempfile import mkdtemp
     from time import time
+    from functools import partial
+    from threading import Lock
     from collections import OrderedDict
     from datetime import datetime
 
     # Third party import
-    import pyfasta # mandatory for fasta reading in the reference class
+    import numpy # mandatory for the storage of the hits and the fasta reading
 
     # Local imports
-    from FileUtils import is_readable_file, rm_blank
+    from FileUtils import is_readable_file, rm_blank, file_checksum
     from Conf_file import write_example_conf
     from Reference import Reference
+    from BlastPool import blast_query_list, blast_pool
+    from HitStream import stream_query_list
+    from BlastCache import BlastCache
+    from BlastDbCache import BlastDbCache
+    from StageCache import StageCache
+    from RunJournal import RunJournal
+    from QueryChunker import needs_chunking, write_chunks, merge_chunk_hits
+    from TaskScheduler import TaskScheduler
+    from JobBoard import JobBoard
+    from MinimizerSketch import reference_sketch, sketch_path, save_sketch, load_sketch
+    from Aligner import get_aligner, ALIGNERS
+    from MaskEngine import IntervalSet
+    from HitTable import subject_intervals
+    from MergedFasta import (write_merged_fasta, merged_id, split_merged_id,
+        demultiplex_query_hits, best_query_hits)
     from pyBlast.BlastHit import BlastHit
-    from pyBlast.Blastn import Blastn
 
 except ImportError as E:
     print (E)
@@ -53,7 +71,10 @@ class RefMasker(object):
     #~~~~~~~CLASS FIELDS~~~~~~~#
 
     VERSION = "RefMasker 0.1"
-    USAGE = "Usage: %prog -c Conf.txt [-i -h]"
+    USAGE = ("Usage: %prog -c Conf.txt [-i -r -h] [--incremental PREV_RUN_DIR] [--distributed] "
+        "[--dry-run]\n"
+        "       %prog --worker RUN_DIR")
+    BLAST_MODES = ["pairwise", "batch", "all_vs_all"]
 
     #~~~~~~~CLASS METHODS~~~~~~~#
 
@@ -69,15 +90,56 @@ class RefMasker(object):
             help= "Path to the configuration file [Mandatory]")
         optparser.add_option('-i', dest="init_conf", action='store_true',
             help= "Generate an example configuration file and exit [Facultative]")
+        optparser.add_option('-r', '--resume', dest="resume", action='store_true',
+            help= "Resume an interrupted run from the journal of its run directory [Facultative]")
+
+        optparser.add_option('--incremental', dest="incremental", metavar="PREV_RUN_DIR",
+            help= "Reuse the results of a previous run whose references are the first references "
+            "of the configuration file and only process the references appended after them "
+            "[Facultative]")
+
+        optparser.add_option('--distributed', dest="distributed", action='store_true',
+            help= "Write the blast jobs in the run directory to share them with workers started "
+            "with --worker on hosts sharing the run directory, then mask the references once all "
+            "jobs are completed [Facultative]")
+
+        optparser.add_option('--dry-run', dest="dry_run", action='store_true',
+            help= "Find and report the bases to mask and write them in a bed file per reference "
+            "instead of the masked fasta files [Facultative]")
+
+        optparser.add_option('--worker', dest="worker", metavar="RUN_DIR",
+            help= "Run the blast jobs of the distributed run of RUN_DIR then exit [Facultative]")
 
         # Parse arguments
         options, args = optparser.parse_args()
 
-        return RefMasker(options.conf_file, options.init_conf)
+        if options.worker:
+            self.run_worker(options.worker)
+            sys.exit(0)
+
+        return RefMasker(options.conf_file, options.init_conf, options.resume, options.incremental,
+            options.distributed, options.dry_run)
+
+    @classmethod
+    def run_worker (self, run_dir):
+        """
+        Run the blast jobs of a distributed run that are not claimed by another worker
+        """
+        print ("Start a RefMasker worker on {}".format(run_dir))
+        start_time = time()
+        try:
+            n_done = JobBoard(run_dir).work()
+            print ("\n{} blast job(s) completed in {}s".format(n_done, round(time()-start_time, 3)))
+
+        except Exception as E:
+            print ("ERROR during execution of RefMasker worker")
+            print (E.message)
+            sys.exit(1)
 
     #~~~~~~~FONDAMENTAL METHODS~~~~~~~#
 
-    def __init__(self, conf_file=None, init_conf=None):
+    def __init__(self, conf_file=None, init_conf=None, resume=False, incremental=None,
+        distributed=False, dry_run=False):
         """
         Initialization function, parse options from configuration file and verify their values.
         All self.variables are initialized explicitly in init.
@@ -107,6 +169,22 @@ class RefMasker(object):
             self.summary_report = cp.getboolean("Output", "summary_report")
             self.detailed_report = cp.getboolean("Output", "detailed_report")
             self.compress_output = cp.getboolean("Output", "compress_output")
+            self.line_width = self._get_option(cp, "Output", "line_width", 60, cp.getint)
+            assert self.line_width >= 0, "Authorized values for line_width: int >= 0"
+            self.inplace_masking = self._get_option(
+                cp, "Output", "inplace_masking", False, cp.getboolean)
+            assert not (self.inplace_masking and self.compress_output), \
+                "inplace_masking requires compress_output = False"
+            self.run_dir = self._get_option(cp, "Output", "run_dir", "")
+            self.resume = resume
+            assert self.run_dir or not self.resume, "A run_dir is required to resume a run"
+            self.incremental = incremental
+            assert self.run_dir or not self.incremental, "A run_dir is required in incremental mode"
+            assert not self.incremental or path.isdir(self.incremental), \
+                "{} is not a valid run directory".format(self.incremental)
+            self.distributed = distributed
+            assert self.run_dir or not self.distributed, "A run_dir is required in distributed mode"
+            self.dry_run = dry_run
 
             print(" * Parse Blast options")
             # Blast parameters section
@@ -116,8 +194,115 @@ class RefMasker(object):
             self.best_query_hit = cp.getboolean("Blast", "best_query_hit")
             self.evalue = cp.getfloat("Blast", "evalue")
             assert self.evalue > 0, "Authorized values for evalue: float > 0"
+            self.blast_workers = self._get_option(cp, "Blast", "blast_workers", 1, cp.getint)
+            assert self.blast_workers > 0, "Authorized values for blast_workers: int > 0"
+            self.blast_mode = self._get_option(cp, "Blast", "blast_mode", "pairwise")
+            assert self.blast_mode in self.BLAST_MODES, "Authorized values for blast_mode: {}".format(
+                ", ".join(self.BLAST_MODES))
+            self.aligner = self._get_option(cp, "Blast", "aligner", "blastn")
+            assert self.aligner in ALIGNERS, "Authorized values for aligner: {}".format(
+                ", ".join(ALIGNERS))
+            self.min_match_length = self._get_option(cp, "Blast", "min_match_length", 100, cp.getint)
+            assert self.min_match_length > 0, "Authorized values for min_match_length: int > 0"
+            self.homology_file = self._get_option(cp, "Blast", "homology_file", "")
+            self.chunk_size = self._get_option(cp, "Blast", "chunk_size", 0, cp.getint)
+            assert self.chunk_size >= 0, "Authorized values for chunk_size: int >= 0"
+            self.chunk_overlap = self._get_option(cp, "Blast", "chunk_overlap", 10000, cp.getint)
+            assert not self.chunk_size or 0 <= self.chunk_overlap < self.chunk_size, \
+                "Authorized values for chunk_overlap: int >= 0 and < chunk_size"
+            assert not self.distributed or (self.blast_mode == "pairwise" and not self.chunk_size), \
+                "The distributed mode requires the pairwise blast_mode without chunk_size"
+            self.progressive_masking = self._get_option(
+                cp, "Blast", "progressive_masking", False, cp.getboolean)
+            assert not self.progressive_masking or (self.blast_mode == "pairwise" and
+                not self.distributed), "Progressive masking requires the pairwise blast_mode " \
+                "and is not available in distributed mode"
+
+            print(" * Parse Prefilter options")
+            # Prefilter parameters section (optional)
+            self.min_shared_minimizers = self._get_option(
+                cp, "Prefilter", "min_shared_minimizers", 0, cp.getint)
+            assert self.min_shared_minimizers >= 0, \
+                "Authorized values for min_shared_minimizers: int >= 0"
+            self.kmer_size = self._get_option(cp, "Prefilter", "kmer_size", 15, cp.getint)
+            assert 0 < self.kmer_size <= 32, "Authorized values for kmer_size: 0 < int <= 32"
+            self.window_size = self._get_option(cp, "Prefilter", "window_size", 10, cp.getint)
+            assert self.window_size > 0, "Authorized values for window_size: int > 0"
+            self.sketch_dir = self._get_option(cp, "Prefilter", "sketch_dir", "")
+            assert not self.sketch_dir or path.isdir(self.sketch_dir), \
+                "{} is not a valid directory".format(self.sketch_dir)
+            self.sketch_with_fasta = self._get_option(
+                cp, "Prefilter", "sketch_with_fasta", False, cp.getboolean)
+            assert not (self.sketch_dir and self.sketch_with_fasta), \
+                "sketch_dir and sketch_with_fasta cannot be used together"
+
+            print(" * Parse Pipeline options")
+            # Pipeline parameters section (optional)
+            self.db_jobs = self._get_option(cp, "Pipeline", "db_jobs", 1, cp.getint)
+            assert self.db_jobs > 0, "Authorized values for db_jobs: int > 0"
+            self.blast_jobs = self._get_option(cp, "Pipeline", "blast_jobs", 1, cp.getint)
+            assert self.blast_jobs > 0, "Authorized values for blast_jobs: int > 0"
+            self.write_jobs = self._get_option(cp, "Pipeline", "write_jobs", 1, cp.getint)
+            assert self.write_jobs > 0, "Authorized values for write_jobs: int > 0"
+            self.compress_threads = self._get_option(
+                cp, "Pipeline", "compress_threads", 1, cp.getint)
+            assert self.compress_threads > 0, "Authorized values for compress_threads: int > 0"
+
+            print(" * Parse Cache options")
+            # Cache parameters section (optional)
+            self.result_cache_dir = self._get_option(cp, "Cache", "result_cache_dir", "")
+            self.result_cache_size = self._get_option(
+                cp, "Cache", "result_cache_size", 1024, cp.getfloat)
+            assert self.result_cache_size > 0, "Authorized values for result_cache_size: float > 0"
+            if self.result_cache_dir:
+                self.blast_cache = BlastCache(self.result_cache_dir, self.result_cache_size)
+            else:
+                self.blast_cache = None
+
+            self.db_cache_dir = self._get_option(cp, "Cache", "db_cache_dir", "")
+            self.db_cache_max_age = self._get_option(
+                cp, "Cache", "db_cache_max_age", 30, cp.getfloat)
+            assert self.db_cache_max_age > 0, "Authorized values for db_cache_max_age: float > 0"
+            if self.db_cache_dir:
+                self.db_cache = BlastDbCache(
+                    self.db_cache_dir, self.makeblastdb_exec, self.db_cache_max_age)
+            else:
+                self.db_cache = None
+
+            # Staged fasta files share the maximal age of the blast databases
+            self.stage_cache_dir = self._get_option(cp, "Cache", "stage_cache_dir", "")
+
+            # Aligner backend used to find the homologies and its options
+            self.aligner_params = {
+                "blastn_exec": self.blastn_exec,
+                "makeblastdb_exec": self.makeblastdb_exec,
+                "blast_task": self.blast_task,
+                "evalue": self.evalue,
+                "min_match_length": self.min_match_length,
+                "homology_file": path.abspath(self.homology_file) if self.homology_file else ""}
+            self.backend = get_aligner(self.aligner, db_cache=self.db_cache, **self.aligner_params)
+            if self.blast_cache:
+                self.aligner_version = self.backend.version()
 
             print(" * Parse Reference sequences")
+            # In distributed mode the References are staged in the run directory to be readable by
+            # the workers of all hosts
+            if self.distributed:
+                temp_root = path.join(self.run_dir, "references")
+                if not path.isdir(temp_root):
+                    makedirs(temp_root)
+            else:
+                temp_root = None
+
+            # The fasta files are staged once per run in a temporary directory if no stage cache
+            # directory is given, References pointing to the same file sharing the staged copy
+            if self.stage_cache_dir:
+                self.stage_temp_dir = None
+                self.stage_cache = StageCache(self.stage_cache_dir, self.db_cache_max_age)
+            else:
+                self.stage_temp_dir = mkdtemp(dir=temp_root)
+                self.stage_cache = StageCache(self.stage_temp_dir)
+
             # Iterate only on sections starting by "reference", create Reference objects
             # And store them in a list
             self.reference_list = []
@@ -127,7 +312,13 @@ class RefMasker(object):
                     Reference (
                         name = rm_blank(cp.get(reference, "name"), replace ='_'),
                         fasta = rm_blank(cp.get(reference, "fasta"), replace ='\ '),
-                        compress = self.compress_output))
+                        compress = self.compress_output,
+                        temp_root = temp_root,
+                        keep_hits = self.detailed_report,
+                        stage_cache = self.stage_cache,
+                        line_width = self.line_width,
+                        compress_threads = self.compress_threads,
+                        inplace = self.inplace_masking))
 
         # Handle the many possible errors occurring during conf file parsing or variable test
         except (ConfigParser.NoOptionError, ConfigParser.NoSectionError) as E:
@@ -164,44 +355,100 @@ class RefMasker(object):
         """
         start_time = time()
         print ("\nStart to process files")
-        # Iterate over index in Reference.instances staring by the last one until the 2nd one
+
+        # Temporary directory for the files shared by all References
+        self.temp_dir = mkdtemp()
+        self.journal = None
+        self.chunk_dict = {}
+        self.skip_dict = {}
+        self.progressive_dict = {}
+        self.pool = None
+        # Lock shared by the tasks of the pipeline to access the journal, the cache and the chunks
+        self.lock = Lock()
 
         try:
-            for i in range(len(self.reference_list)-1, 0, -1):
-                subject = self.reference_list[i]
-                query_list = self.reference_list[0:i]
+            # Checkpoint journal recording the completed steps in the run directory
+            if self.run_dir:
+                print ("{} the run journal in {}".format(
+                    "Resume" if self.resume else "Start", self.run_dir))
+                # The journal of the run directory is reused if it is the incremental directory
+                same_dir = (self.incremental and
+                    path.abspath(self.incremental) == path.abspath(self.run_dir))
+                self.journal = RunJournal(self.run_dir, self._run_params(), self.resume or same_dir)
+
+                # Import the results of a previous run processed with the first References
+                if self.incremental:
+                    n_prev = self.journal.import_run(self.incremental, self.reference_list)
+                    print ("Reuse the results of the {} first reference(s) from {}".format(
+                        n_prev, self.incremental))
+
+                self.journal.record_references(self.reference_list)
+
+            # Find the pairs of References sharing too few minimizers to be blasted
+            if self.min_shared_minimizers:
+                self._prefilter()
 
-                print ("\nProcessing Reference \"{}\"".format(subject.name))
+            # Mask the sequences identical to a sequence of a previous Reference without blast
+            self._mask_duplicates()
 
-                # Create a blast database for the current subject sequence
-                with Blastn(ref_path=subject.fasta, makeblastdb_exec=self.makeblastdb_exec) as blastn:
+            # Share the blast jobs with the workers and wait for their completion
+            if self.distributed:
+                self._run_distributed()
 
-                    # Blast each query file of the query list against the subject
-                    for query in query_list:
-                        print (" * Blast against \"{}\"".format(query.name))
+            # The blastn worker processes are forked once, before the threads of the pipeline, and
+            # shared by the subjects blasted at the same time. Streamed searches run in threads
+            if not self._can_stream():
+                self.pool = blast_pool(self.blast_workers*(
+                    1 if self.blast_mode == "all_vs_all" else self.blast_jobs))
 
-                        # Save the list of hit in a local variable
-                        hit_list = blastn (
-                            query_path = query.fasta,
-                            blastn_exec = self.blastn_exec,
-                            task = self.blast_task,
-                            evalue = self.evalue,
-                            best_query_hit = self.best_query_hit)
+            # In all_vs_all mode the hits of every pair of references are found at once
+            if self.blast_mode == "all_vs_all":
+                all_hit_lists = self._blast_all_vs_all()
 
-                        # Add the hit of list found to the subject
-                        if hit_list:
-                            print("   * {} hit(s) found".format(len(hit_list)))
-                            subject.add_hit_list(hit_list)
+            # Each subject Reference is processed by a pipeline of tasks: build its blast database,
+            # blast the query References listed before it and mask it. The queries are always the
+            # original References so the tasks of different subjects are independent and run at
+            # the same time, within the limits of each stage, starting by the largest References.
+            # A database is held until its blast task is completed, and at most db_jobs databases
+            # are prepared in advance of the blast tasks running
+            print ("\nProcess {} reference(s) with {} database, {} blast and {} write job(s)".format(
+                len(self.reference_list)-1, self.db_jobs, self.blast_jobs, self.write_jobs))
+            scheduler = TaskScheduler(
+                {"db": self.db_jobs, "blast": self.blast_jobs, "write": self.write_jobs},
+                {"db": self.db_jobs+self.blast_jobs})
 
-                        else:
-                            print ("   * No hit found")
+            # Hits are streamed into the subjects as they are parsed when they are not kept
+            streaming = self._can_stream()
+            if streaming:
+                print ("Stream the hits into the references as they are found")
 
-                # if hits were found output the new fasta file in the current folder
-                if subject.n_hit:
-                    print (" * Write a modified reference fasta file in the current directory")
-                    subject.output_reference ()
+            # Iterate over index in Reference.instances staring by the last one until the 2nd one
+            for i in range(len(self.reference_list)-1, 0, -1):
+                subject = self.reference_list[i]
+                query_list = self.reference_list[0:i]
+                subject_size = path.getsize(subject.fasta)
+                query_size = sum([path.getsize(query.fasta) for query in query_list])
+
+                # Collect a list of hits per query reference
+                if self.blast_mode == "all_vs_all":
+                    scheduler.add_task("blast_{}".format(i), "blast",
+                        partial(all_hit_lists.__getitem__, i))
                 else:
-                    print (" * Reference file unmodified")
+                    scheduler.add_task("db_{}".format(i), "db",
+                        partial(self._prepare_db, subject, query_list), cost=subject_size)
+                    scheduler.add_task("blast_{}".format(i), "blast",
+                        partial(self._stream_subject if streaming else
+                        self._progressive_subject if self.progressive_masking else
+                        self._blast_subject, subject, query_list), deps=["db_{}".format(i)],
+                        cost=subject_size*query_size)
+
+                # Streamed hits are already added to the subject by the blast task
+                scheduler.add_task("write_{}".format(i), "write",
+                    partial(self._write_subject, subject) if streaming else
+                    partial(self._mask_subject, subject, query_list),
+                    deps=["blast_{}".format(i)], cost=subject_size)
+
+            scheduler.run()
 
             # Write reports if requested
             if self.summary_report:
@@ -210,6 +457,8 @@ class RefMasker(object):
                     report.write ("Program {}\tDate {}\n\n".format(self.VERSION,str(datetime.today())))
                     for ref in self.reference_list:
                         report.write(self._dict_to_report(ref.get_report(full=False)))
+                        report.write(self._dict_to_report(self._skip_report(ref)))
+                        report.write(self._dict_to_report(self._progressive_report(ref)))
                         report.write("\n")
 
             if self.detailed_report:
@@ -218,24 +467,626 @@ class RefMasker(object):
                     report.write ("Program {}\tDate {}\n\n".format(self.VERSION,str(datetime.today())))
                     for ref in self.reference_list:
                         report.write(self._dict_to_report(ref.get_report(full=True)))
+                        report.write(self._dict_to_report(self._skip_report(ref)))
+                        report.write(self._dict_to_report(self._progressive_report(ref)))
                         report.write("\n")
 
         # Catch possible exceptions
         except Exception as E:
             print ("ERROR during execution of RefMasker")
             print (E.message)
+            if self.journal:
+                print ("Completed steps are saved in {}. Use --resume to continue the run".format(
+                    self.run_dir))
 
         # Even in case of exception this block will  be executed to remove temporary files
         finally:
             print ("\nCleanup temporary files")
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
             for ref in self.reference_list:
                 ref.clean()
+            rmtree(self.temp_dir)
+            if self.stage_temp_dir:
+                rmtree(self.stage_temp_dir)
 
             print ("\nDone in {}s".format(round(time()-start_time, 3)))
             return(0)
 
     #~~~~~~~PRIVATE METHODS~~~~~~~#
 
+    def _mask_subject(self, subject, query_list, hit_lists):
+        """
+        Add the hits found with each query Reference to the subject Reference and write the masked
+        subject fasta file if hits were found
+        """
+        print ("\nProcessing Reference \"{}\"".format(subject.name))
+
+        # Add the hit of list found to the subject in the order of the query list
+        for query, hit_list in zip(query_list, hit_lists):
+            print (" * Blast against \"{}\"".format(query.name))
+
+            if hit_list:
+                print("   * {} hit(s) found".format(len(hit_list)))
+                subject.add_hit_list(hit_list)
+
+            else:
+                print ("   * No hit found")
+
+        self._write_subject(subject)
+
+    def _write_subject(self, subject, *args):
+        """
+        Write the masked subject fasta file if hits were found
+        @param args Result of the blast task, ignored
+        """
+        # if hits were found output the new fasta file in the current folder
+        if subject.n_hit and self.dry_run:
+            print (" * Write the {} masked interval(s) in a bed file in the current directory".format(
+                sum([len(seq.interval_set) for seq in subject.seq_dict.values()])))
+            subject.output_mask_bed()
+        elif subject.n_hit and self.journal and self.journal.has_output(subject):
+            print (" * Modified reference fasta file already written by the previous run")
+        elif subject.n_hit:
+            print (" * Write a modified reference fasta file in the current directory")
+            modified_fasta = subject.output_reference ()
+            if self.journal:
+                with self.lock:
+                    self.journal.record_output(subject, modified_fasta)
+        else:
+            print (" * Reference file unmodified")
+
+    def _prepare_db(self, subject, query_list):
+        """
+        Create the blast database of the subject Reference if the hits of at least one query
+        Reference are neither in the journal nor in the blast cache
+        @return An AlignerDb object or None if no blast is required
+        """
+        if all([self._has_hits(subject, query) for query in query_list]):
+            return None
+
+        print ("\nPrepare the blast database of Reference \"{}\"".format(subject.name))
+        return self._blast_db(subject)
+
+    def _has_hits(self, subject, query):
+        """
+        True if the hits of a pair of References are available in the journal or the cache, or if
+        the pair is skipped by the prefilter
+        """
+        return bool(self._is_skipped(subject, query) or
+            (self.journal and self.journal.has_pair(subject, query)) or
+            (self.blast_cache and self.blast_cache.has(self._cache_key(subject, query))))
+
+    def _blast_subject(self, subject, query_list, blastn=None):
+        """
+        Find the hits of each query Reference against the subject Reference. Results of the
+        previous run (in resume mode) and results available in the blast cache are reused and the
+        remaining queries are blasted in pairwise or batch mode
+        @param blastn AlignerDb object of the subject, created if None and needed
+        @return A list of hit lists in the same order as query_list
+        """
+        print ("\nFind the homologies of Reference \"{}\"".format(subject.name))
+        hit_lists = [None]*len(query_list)
+
+        # Retrieve the hit lists of the pairs completed by the previous run
+        if self.journal:
+            for j, query in enumerate(query_list):
+                if self.journal.has_pair(subject, query):
+                    hit_lists[j] = self.journal.load_pair(subject, query)
+            n_done = sum([hit_list is not None for hit_list in hit_lists])
+            if n_done:
+                print (" * Reuse the blast results of {} reference(s) from the journal".format(
+                    n_done))
+
+        # Retrieve the hit lists already in the cache
+        if self.blast_cache:
+            n_cached = 0
+            for j, query in enumerate(query_list):
+                if hit_lists[j] is None:
+                    hit_lists[j] = self.blast_cache.get(self._cache_key(subject, query))
+                    if hit_lists[j] is not None:
+                        n_cached += 1
+                        if self.journal:
+                            self.journal.record_pair(subject, query, hit_lists[j])
+            if n_cached:
+                print (" * Reuse the cached blast results of {} reference(s)".format(n_cached))
+
+        # Pairs skipped by the prefilter or without sequence to search have no hits
+        n_skipped = 0
+        for j, query in enumerate(query_list):
+            if hit_lists[j] is None and self._is_skipped(subject, query):
+                hit_lists[j] = []
+                n_skipped += 1
+        if n_skipped:
+            print (" * Skip {} reference(s) sharing too few minimizers or sequences".format(n_skipped))
+
+        # Save the hit list of each new pair as soon as it is available
+        def save_pair(query, hit_list):
+            with self.lock:
+                if self.blast_cache:
+                    self.blast_cache.put(self._cache_key(subject, query), hit_list)
+                if self.journal:
+                    self.journal.record_pair(subject, query, hit_list)
+
+        # Blast the remaining queries. No database is created if all were found, and a database
+        # prepared in advance is removed by the context manager even if it is not used
+        todo_list = [j for j, hit_list in enumerate(hit_lists) if hit_list is None]
+        todo_query_list = [query_list[j] for j in todo_list]
+        new_hit_lists = []
+        if todo_list or blastn:
+            with (blastn or self._blast_db(subject)) as blastn:
+                if todo_query_list and self.blast_mode == "batch":
+                    new_hit_lists = self._blast_batch(subject, blastn, todo_query_list, save_pair)
+                elif todo_query_list:
+                    new_hit_lists = self._blast_pairwise(blastn, todo_query_list, save_pair)
+
+        for j, hit_list in zip(todo_list, new_hit_lists):
+            hit_lists[j] = hit_list
+
+        return hit_lists
+
+    def _can_stream(self):
+        """
+        True if the hits can be added to the subject References as soon as they are parsed instead
+        of being collected per pair of References. Hit lists have to be complete when they are saved
+        in the journal or the cache, filtered by best_query_hit or merged across chunks
+        """
+        return (self.blast_mode == "pairwise" and not self.distributed and not self.run_dir and
+            not self.blast_cache and not self.best_query_hit and not self.chunk_size and
+            not self.progressive_masking)
+
+    def _stream_subject(self, subject, query_list, blastn=None):
+        """
+        Search each query Reference against the subject Reference and add the hits to the subject
+        by batches as soon as they are parsed, in the order of query_list
+        @param blastn AlignerDb object of the subject, created if None and needed
+        @return The number of hits found for each query Reference
+        """
+        print ("\nFind the homologies of Reference \"{}\"".format(subject.name))
+
+        # Pairs skipped by the prefilter have no hits
+        todo_query_list = [query for query in query_list
+            if not self._is_skipped(subject, query)]
+        if len(todo_query_list) < len(query_list):
+            print (" * Skip {} reference(s) sharing too few minimizers".format(
+                len(query_list)-len(todo_query_list)))
+        if not todo_query_list:
+            if blastn:
+                blastn.__exit__(None, None, None)
+            return []
+
+        def add_batch(j, hit_list):
+            subject.add_hit_list(hit_list)
+
+        print (" * Blast against {} reference(s) with {} worker(s)".format(
+            len(todo_query_list), min(self.blast_workers, len(todo_query_list))))
+
+        with (blastn or self._blast_db(subject)) as blastn:
+            n_hit_list = stream_query_list (
+                db = blastn,
+                query_path_list = [query.fasta for query in todo_query_list],
+                n_workers = self.blast_workers,
+                callback = add_batch)
+
+        for query, n_hit in zip(todo_query_list, n_hit_list):
+            print (" * {} hit(s) found with \"{}\"".format(n_hit, query.name))
+
+        return n_hit_list
+
+    def _run_distributed(self):
+        """
+        Write the manifest of the pairs of References missing in the journal and in the cache,
+        run jobs until all are completed by this process or by the workers, then record the hit
+        files in the journal so that the masking steps find all the results there
+        """
+        ref_list = self.reference_list
+        job_list = []
+        pair_list = []
+        for i in range(len(ref_list)-1, 0, -1):
+            for j in range(i):
+                subject, query = ref_list[i], ref_list[j]
+                if self.journal.has_pair(subject, query) or self._is_skipped(subject, query):
+                    continue
+                if self.blast_cache:
+                    hit_list = self.blast_cache.get(self._cache_key(subject, query))
+                    if hit_list is not None:
+                        self.journal.record_pair(subject, query, hit_list)
+                        continue
+                pair_list.append((subject, query))
+                job_list.append({"subject": i, "query": j,
+                    "hit_file": path.basename(self.journal.hit_file(subject, query))})
+
+        print ("\nShare {} blast job(s) in {}. Start workers with \"RefMasker.py --worker {}\"".format(
+            len(job_list), self.run_dir, self.run_dir))
+        job_board = JobBoard(self.run_dir)
+        params = dict(self.aligner_params,
+            aligner = self.aligner,
+            best_query_hit = self.best_query_hit,
+            db_cache_dir = path.abspath(self.db_cache_dir) if self.db_cache_dir else "",
+            db_cache_max_age = self.db_cache_max_age)
+        job_board.write_manifest(params, ref_list, job_list)
+        job_board.wait()
+
+        for subject, query in pair_list:
+            self.journal.record_pair_file(subject, query)
+            if self.blast_cache:
+                self.blast_cache.put(self._cache_key(subject, query),
+                    self.journal.load_pair(subject, query))
+
+    def _prefilter(self):
+        """
+        Compute or load the minimizer sketch of each Reference and list the pairs of References
+        sharing less than min_shared_minimizers minimizers. Sketches are saved in sketch_dir, next
+        to the fasta files if sketch_with_fasta is True, or else in the database cache directory
+        to be reused by the next runs. Without database cache they only last for the run
+        """
+        if self.sketch_dir or self.sketch_with_fasta:
+            sketch_dir = self.sketch_dir
+        else:
+            sketch_dir = self.db_cache_dir or self.temp_dir
+
+        print ("\nCompute the minimizer sketches of the references")
+        sketch_dict = {}
+        for ref in self.reference_list:
+            sketch_file = sketch_path(ref.source_fasta, sketch_dir, self.kmer_size,
+                self.window_size)
+            sketch_dict[ref.name] = load_sketch(sketch_file, ref.checksum)
+            if sketch_dict[ref.name] is not None:
+                print (" * Reuse the sketch of \"{}\"".format(ref.name))
+                continue
+
+            print (" * Sketch \"{}\"".format(ref.name))
+            sketch_dict[ref.name] = reference_sketch(ref, self.kmer_size, self.window_size)
+            if not save_sketch(sketch_file, sketch_dict[ref.name], ref.checksum):
+                print ("   * The sketch cannot be saved in {}".format(sketch_file))
+
+        # Only the pairs where the query Reference is listed before the subject Reference are masked
+        for i in range(len(self.reference_list)-1, 0, -1):
+            for j in range(i):
+                subject, query = self.reference_list[i], self.reference_list[j]
+                n_shared = len(sketch_dict[subject.name] & sketch_dict[query.name])
+                if n_shared < self.min_shared_minimizers:
+                    self.skip_dict[(subject.name, query.name)] = n_shared
+
+        print (" * {} pair(s) of references will not be blasted".format(len(self.skip_dict)))
+
+    def _mask_duplicates(self):
+        """
+        Find the Sequences identical to a Sequence of a previous Reference, on either strand, from
+        their hashes, only computed for the Sequences of the same length. They are masked by a full
+        length hit and excluded from the searches
+        """
+        n_dup = 0
+        for i, subject in enumerate(self.reference_list):
+            dup_list = []
+            for seq in subject.seq_dict.values():
+                for query in self.reference_list[0:i]:
+                    query_seq = query.identical_sequence(seq)
+                    if query_seq:
+                        break
+                else:
+                    continue
+
+                # Full length hit in the orientation of the identical sequence
+                forward = seq.fwd_hash == query_seq.fwd_hash
+                seq.duplicate_of = "{}:{}({})".format(query.name, query_seq.name,
+                    "+" if forward else "-")
+                subject.add_hit_list([BlastHit(q_id=query_seq.name, s_id=seq.name,
+                    identity=100, length=seq.seq_len, mis=0, gap=0, q_start=1,
+                    q_end=seq.seq_len, s_start=1 if forward else seq.seq_len,
+                    s_end=seq.seq_len if forward else 1, evalue=0, bscore=seq.seq_len)])
+                dup_list.append(seq.name)
+
+            if dup_list:
+                subject.exclude_sequences(dup_list)
+                n_dup += len(dup_list)
+
+        if n_dup:
+            print ("\n{} sequence(s) identical to a sequence of a previous reference masked".format(
+                n_dup))
+
+    def _is_skipped(self, subject, query):
+        """
+        True if a pair of References is skipped by the prefilter or if all the Sequences of the
+        subject are excluded from the searches
+        """
+        return (subject.name, query.name) in self.skip_dict or not subject.search_fasta
+
+    def _progressive_subject(self, subject, query_list, blastn=None):
+        """
+        Find the hits of each query Reference against the subject Reference masked with the hits
+        of the queries listed before it. The database is rebuilt from a masked copy of the subject
+        before each query Reference if new bases were masked. Results of the previous run and of
+        the blast cache are reused, the cache key being computed from the masked copy searched
+        @param blastn AlignerDb object of the unmasked subject, created if None and needed
+        @return A list of hit lists in the same order as query_list
+        """
+        print ("\nFind the homologies of Reference \"{}\" with progressive masking".format(
+            subject.name))
+        interval_dict = OrderedDict([(name, IntervalSet()) for name in subject.seq_dict])
+        db_fasta, db_checksum, db_masked = subject.search_fasta, subject.search_checksum, 0
+        hit_lists = []
+        masked_list = []
+
+        try:
+            for j, query in enumerate(query_list):
+                # Mask the subject with the hits found so far and rebuild its database
+                n_masked = sum([interval_set.n_bases() for interval_set in interval_dict.values()])
+                if n_masked > db_masked:
+                    if blastn:
+                        blastn.__exit__(None, None, None)
+                        blastn = None
+                    if db_fasta != subject.search_fasta:
+                        remove(db_fasta)
+                    db_fasta = subject.write_masked(path.join(self.temp_dir,
+                        "progressive_{}_{}.fa".format(subject.name, j)), interval_dict)
+                    db_checksum = file_checksum(db_fasta)
+                    db_masked = n_masked
+                masked_list.append((query.name, n_masked))
+
+                if self.journal and self.journal.has_pair(subject, query):
+                    print (" * Reuse the blast results of \"{}\" from the journal".format(query.name))
+                    hit_list = self.journal.load_pair(subject, query)
+                elif self._is_skipped(subject, query):
+                    print (" * Skip \"{}\" sharing too few minimizers".format(query.name))
+                    hit_list = []
+                else:
+                    key = self._cache_key(subject, query, db_checksum) if self.blast_cache else None
+                    hit_list = self.blast_cache.get(key) if key else None
+                    if hit_list is not None:
+                        print (" * Reuse the cached blast results of \"{}\"".format(query.name))
+                    else:
+                        print (" * Blast \"{}\" against {:.2f}% of the subject not masked yet".format(
+                            query.name, 100.0-float(n_masked)/subject.length*100.0))
+                        if blastn is None:
+                            blastn = self.backend.database(db_fasta, db_checksum,
+                                subject.temp_dir).__enter__()
+                        hit_list = self._blast_pairwise(blastn, [query])[0]
+                        if key:
+                            with self.lock:
+                                self.blast_cache.put(key, hit_list)
+                    if self.journal:
+                        with self.lock:
+                            self.journal.record_pair(subject, query, hit_list)
+
+                # Add the intervals of the hits to the intervals to mask before the next query
+                hit_dict = {}
+                for hit in hit_list:
+                    hit_dict.setdefault(hit.s_id, []).append(hit)
+                for s_id, seq_hit_list in hit_dict.items():
+                    if s_id in subject.seq_dict:
+                        start_array, end_array, reverse_array = subject_intervals(seq_hit_list,
+                            s_id, subject.seq_dict[s_id].seq_len)
+                        interval_dict[s_id].add(start_array, end_array)
+                hit_lists.append(hit_list)
+
+        finally:
+            if blastn:
+                blastn.__exit__(None, None, None)
+
+        self.progressive_dict[subject.name] = masked_list
+        return hit_lists
+
+    def _progressive_report(self, reference):
+        """ Return a dict of the bases masked before the search of each query Reference """
+        if not self.progressive_dict.get(reference.name):
+            return {}
+        return {"Bases excluded from the search by progressive masking": OrderedDict([
+            (query_name, "{} ({:.2f}%)".format(n_masked, float(n_masked)/reference.length*100.0))
+            for query_name, n_masked in self.progressive_dict[reference.name]])}
+
+    def _skip_report(self, reference):
+        """ Return a dict listing the query References skipped by the prefilter for a Reference """
+        skipped = OrderedDict([(query.name, self.skip_dict[(reference.name, query.name)])
+            for query in self.reference_list if (reference.name, query.name) in self.skip_dict])
+        if not skipped:
+            return {}
+        return {"Query references skipped by the prefilter (shared minimizers)": skipped}
+
+    def _blast_db(self, subject):
+        """
+        Return the database of the subject Reference built by the aligner backend, to be used with
+        the context manager. Blast databases are taken from the database cache if it is enabled or
+        else created in the temporary directory of the subject
+        """
+        return self.backend.database(subject.search_fasta, subject.search_checksum,
+            subject.temp_dir)
+
+    def _run_params(self):
+        """ Parameters that may change the results, used to verify that a run can be resumed """
+        return {
+            "blast_task": self.blast_task,
+            "evalue": self.evalue,
+            "best_query_hit": self.best_query_hit,
+            "blast_mode": self.blast_mode,
+            "aligner": self.aligner,
+            "min_match_length": self.min_match_length,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "progressive_masking": self.progressive_masking}
+
+    def _cache_key(self, subject, query, subject_checksum=None):
+        """
+        Compute the key of a pair of References in the blast cache from the content of their fasta
+        files and from all the parameters that may change the blast results
+        @param subject_checksum Checksum of the fasta file searched instead of the subject fasta
+        file, masked by progressive masking
+        """
+        return self.blast_cache.key(query.checksum, subject_checksum or subject.search_checksum,
+            self.blast_task,
+            repr(self.evalue), self.best_query_hit, self.chunk_size, self.chunk_overlap,
+            self.aligner, self.min_match_length,
+            self.aligner_version)
+
+    def _blast_pairwise(self, blastn, query_list, callback=None):
+        """
+        Blast each query Reference against the database of the subject Reference. Large query
+        References are split in chunks blasted as independent jobs
+        @param blastn AlignerDb object of the subject Reference
+        @param callback Function called with each query Reference and its hit list once found
+        @return A list of hit lists in the same order as query_list
+        """
+        # List of (query index, query fasta file) jobs
+        job_list = [(j, query_path) for j, query in enumerate(query_list)
+            for query_path in self._query_chunks(query)]
+
+        hit_lists = [None]*len(query_list)
+        chunk_hit_lists = [[] for _ in query_list]
+        n_chunk = [len(self._query_chunks(query)) for query in query_list]
+
+        # Merge the hits of the chunks of a query Reference once they were all blasted
+        def job_callback(k, hit_list):
+            j = job_list[k][0]
+            chunk_hit_lists[j].append(hit_list)
+            if len(chunk_hit_lists[j]) == n_chunk[j]:
+                hit_lists[j] = self._merge_chunks(query_list[j], chunk_hit_lists[j])
+                if callback:
+                    callback(query_list[j], hit_lists[j])
+
+        print (" * Blast against {} reference(s) in {} job(s) with {} worker(s)".format(
+            len(query_list), len(job_list), min(self.blast_workers, len(job_list))))
+
+        blast_query_list (
+            blastn = blastn,
+            query_path_list = [query_path for j, query_path in job_list],
+            n_workers = self.blast_workers,
+            callback = job_callback,
+            pool = self.pool,
+            best_query_hit = self.best_query_hit)
+
+        return hit_lists
+
+    def _query_chunks(self, query):
+        """
+        Return the list of fasta files to blast for a query Reference. The chunks of large query
+        References are written once in the temporary directory and reused for all subjects
+        """
+        if not needs_chunking(query, self.chunk_size):
+            return [query.fasta]
+
+        with self.lock:
+            if query.name not in self.chunk_dict:
+                self.chunk_dict[query.name] = write_chunks(query,
+                    path.join(self.temp_dir, "chunks_{}".format(query.name)),
+                    self.chunk_size, self.chunk_overlap)
+            return self.chunk_dict[query.name]
+
+    def _merge_chunks(self, query, chunk_hit_lists):
+        """ Merge the hit lists found with the chunks of a query Reference in a single hit list """
+        if not needs_chunking(query, self.chunk_size):
+            return chunk_hit_lists[0]
+
+        hit_list = merge_chunk_hits(chunk_hit_lists, query, self.chunk_size)
+        # The best hit of each sequence is selected among the best hits of its chunks
+        return best_query_hits(hit_list) if self.best_query_hit else hit_list
+
+    def _blast_batch(self, subject, blastn, query_list, callback=None):
+        """
+        Blast all query References at once against the database of the subject Reference by
+        merging them in a single fasta file
+        @param blastn AlignerDb object of the subject Reference
+        @param callback Function called with each query Reference and its hit list once found
+        @return A list of hit lists in the same order as query_list
+        """
+        query_fasta = write_merged_fasta(query_list,
+            path.join(self.temp_dir, "queries_{}.fa".format(subject.name)))
+
+        print (" * Blast against {} reference(s) in a single batch".format(len(query_list)))
+
+        hit_list = blastn (
+            query_path = query_fasta,
+            best_query_hit = self.best_query_hit)
+
+        # Attribute each hit to its query Reference and restore the original query ids
+        hit_lists = demultiplex_query_hits(hit_list, range(len(query_list)))
+        if callback:
+            for query, hit_list in zip(query_list, hit_lists):
+                callback(query, hit_list)
+        return hit_lists
+
+    def _blast_all_vs_all(self):
+        """
+        Blast each query Reference against a single database merging all the subject References
+        listed after it, to follow the same masking order than in pairwise mode with a single
+        search per query Reference. The e-values are scaled to the size of each subject Reference,
+        so that the hits match the pairwise mode except close to the e-value cutoff
+        @return A dict of lists of hit lists. For each subject index i the list contains the hits
+        of query References 0 to i-1 in this order
+        """
+        ref_list = self.reference_list
+        n_ref = len(ref_list)
+        all_hit_lists = {i: [[] for _ in range(i)] for i in range(n_ref)}
+
+        print ("\nBlast each Reference against all the References listed after it")
+        for j, query in enumerate(ref_list[:-1]):
+            # Pairs skipped by the prefilter or without sequence to search have no hits
+            index_list = [i for i in range(j+1, n_ref) if not self._is_skipped(ref_list[i], query)]
+            n_skipped = n_ref-j-1-len(index_list)
+            if n_skipped:
+                print (" * Skip {} reference(s) sharing too few minimizers or sequences with "
+                    "\"{}\"".format(n_skipped, query.name))
+
+            # Reuse the results of the previous run if all the pairs of the query were completed
+            if self.journal and all([self.journal.has_pair(ref_list[i], query)
+                for i in index_list]):
+                if index_list:
+                    print (" * Reuse the blast results of \"{}\" from the journal".format(
+                        query.name))
+                for i in index_list:
+                    all_hit_lists[i][j] = self.journal.load_pair(ref_list[i], query)
+                continue
+
+            if index_list:
+                print (" * Blast \"{}\" against {} reference(s)".format(query.name, len(index_list)))
+                merged_fasta = write_merged_fasta([ref_list[i] for i in index_list],
+                    path.join(self.temp_dir, "subjects_{}.fa".format(j)), index_list, search=True)
+                subject_sizes = dict([(merged_id(i, seq.name), ref_list[i].search_length)
+                    for i in index_list for seq in ref_list[i].seq_dict.values()
+                    if seq.name not in ref_list[i].excluded_seqs])
+
+                # best_query_hit is applied per pair of References after the hit attribution
+                query_path_list = self._query_chunks(query)
+                with self.backend.database(merged_fasta, temp_root=self.temp_dir,
+                    subject_sizes=subject_sizes) as blastn:
+                    chunk_hit_lists = blast_query_list (
+                        blastn = blastn,
+                        query_path_list = query_path_list,
+                        n_workers = self.blast_workers,
+                        pool = self.pool,
+                        best_query_hit = False)
+                remove(merged_fasta)
+
+                if needs_chunking(query, self.chunk_size):
+                    hit_list = merge_chunk_hits(chunk_hit_lists, query, self.chunk_size)
+                else:
+                    hit_list = chunk_hit_lists[0]
+
+                # Attribute each hit to its subject Reference and restore the original sequence id
+                for hit in hit_list:
+                    i, hit.s_id = split_merged_id(hit.s_id)
+                    all_hit_lists[i][j].append(hit)
+
+            for i in index_list:
+                if self.best_query_hit:
+                    all_hit_lists[i][j] = best_query_hits(all_hit_lists[i][j])
+                if self.journal:
+                    self.journal.record_pair(ref_list[i], query, all_hit_lists[i][j])
+
+        return all_hit_lists
+
+    def _get_option(self, cp, section, option, default, getter=None):
+        """
+        Return the value of an option that is not mandatory in the configuration file, so that
+        configuration files generated by previous versions remain valid
+        @param cp ConfigParser object containing the parsed configuration file
+        @param getter ConfigParser method used to get and convert the value (default = cp.get)
+        @param default Value returned if the option is absent or empty
+        """
+        if not cp.has_option(section, option) or not cp.get(section, option):
+            return default
+        return getter(section, option) if getter else cp.get(section, option)
+
     def _dict_to_report(self, d, tab=""):
         """
         Recursive function to return a text report from nested dict or OrderedDict objects
@@ -13,14 +13,13 @@
 from os import path
 from shutil import rmtree
 from collections import OrderedDict
-from gzip import open as gopen
 from tempfile import mkdtemp
 
-# Specific Third party import
-import pyfasta # install with pip
-
 # Local imports
-from FileUtils import is_readable_file, is_gziped, gunzip, cp
+from FastaIndex import FastaStore, write_fai, fai_path
+from Bgzf import BgzfWriter
+from FileUtils import is_readable_file, is_gziped, gunzip, link_or_copy, file_checksum
+from FastaWriter import write_sequence, mask_fasta_copy
 from Sequence import Sequence
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
@@ -48,22 +47,46 @@ class Reference(object):
 
     #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
 
-    def __init__ (self, name, fasta, compress=True):
+    def __init__ (self, name, fasta, compress=True, temp_root=None, keep_hits=True,
+        stage_cache=None, line_width=0, compress_threads=1, inplace=False):
         """
         Create a reference object extract fasta ref if needed and create a sequence object per
         sequences found in the fasta file
         @param name     Name of the Reference
         @param fasta    Path to a fasta file (can be gzipped)
-        @param compress Fasta output will be gzipped if True
+        @param compress Fasta output will be compressed in BGZF format with .fai and .gzi indexes
+        if True
+        @param temp_root Directory where the temporary directory is created (default = system
+        temporary directory). Used to stage the fasta file in a directory shared by several hosts
+        @param keep_hits If False the Sequences only keep the intervals to mask, not the detail of
+        each hit required by the detailed report
+        @param stage_cache StageCache object where the fasta file is staged once and shared with
+        the other References pointing to the same file. If None it is staged in the temporary
+        directory of the Reference
+        @param line_width Number of bases per line of the fasta output. 0 to write each sequence on
+        a single line
+        @param compress_threads Number of threads compressing the fasta output
+        @param inplace If True and if compress is False, the fasta output is a copy of the fasta
+        file masked in place, keeping its headers and its line width
         """
         print ("Create {} object".format(name))
         # Create self variables
         self.name = name
-        self.temp_dir = mkdtemp()
+        self.source_fasta = fasta
+        self.temp_dir = mkdtemp(dir=temp_root)
         self.compress = compress
+        self.line_width = line_width
+        self.compress_threads = compress_threads
+        self.inplace = inplace
+        self._checksum = None
 
         # Create a name for the fasta file to be generated
         self.modified_fasta = "{}_masked.fa{}".format(self.name, ".gz" if self.compress else "")
+        # Bed file of the masked intervals, written instead of the masked fasta file in dry run
+        self.mask_bed = None
+        # Sequences excluded from the searches and fasta file of the remaining sequences
+        self.excluded_seqs = set()
+        self._search_checksum = None
 
         try:
             # Test values
@@ -71,19 +94,20 @@ class Reference(object):
             assert is_readable_file(fasta), "{} is not a valid file".format(fasta)
 
             # If gziped, ungzip the reference fasta file in the temporary folder. If not compress
-            # copy in the temporary folder
-
-            if is_gziped(fasta):
+            # link it in the temporary folder
+            if stage_cache:
+                self.fasta, self._checksum = stage_cache.stage(fasta)
+            elif is_gziped(fasta):
                 print (" * Unzip fasta file in a temporary directory")
                 self.fasta = gunzip(fasta, self.temp_dir)
             else:
-                print (" * Copy fasta file in a temporary directory")
-                self.fasta = cp(fasta, self.temp_dir)
+                print (" * Link fasta file in a temporary directory")
+                self.fasta = link_or_copy(fasta, self.temp_dir)
 
-            # Loading the fasta sequence in a pyfasta.Fasta (seq_record is a mapping)
-            print (" * Parsing the file with pyfasta")
+            # Index the fasta file and map it in memory (seq_record is a FastaRecord)
+            print (" * Indexing the file")
             seq_dict = {}
-            fasta_record = pyfasta.Fasta(self.fasta, flatten_inplace=True)
+            fasta_record = FastaStore(self.fasta)
             print (" * Found {} sequences in {}".format (len (fasta_record), self.name))
 
             for name, seq_record in fasta_record.items():
@@ -91,10 +115,19 @@ class Reference(object):
                 # Remove additional sequence descriptor in fasta header and create a Sequence object
                 short_name = name.partition(" ")[0]
                 assert short_name not in seq_dict, "Reference name <{}> is duplicated in <{}>".format(short_name,self.name)
-                seq_dict[short_name] = Sequence(name=short_name, seq_record=seq_record)
+                seq_dict[short_name] = Sequence(name=short_name, seq_record=seq_record,
+                    keep_hits=keep_hits)
 
             # Save to a name sorted ordered dict
             self.seq_dict = OrderedDict(sorted(seq_dict.items(), key=lambda x: x))
+            self.search_fasta = self.fasta
+
+            # Index the non empty sequences by length to find the identical sequences, so that
+            # only the sequences of the same length are hashed
+            self.length_dict = OrderedDict()
+            for seq in self.seq_dict.values():
+                if seq.seq_len:
+                    self.length_dict.setdefault(seq.seq_len, []).append(seq)
 
             # Add name to a class list
             self.ADD_TO_REFERENCE_NAMES(self.name)
@@ -121,7 +154,7 @@ class Reference(object):
         msg+= "  Number of hit(s) in sequences: {}\n".format(self.n_hit)
         for s in self.seq_dict.values():
             msg+= "    Name: {}\tSeq: {}...\tNumber of hits: {}\n".format(
-                s.name, s.seq_record[0:10], len(s.hit_list))
+                s.name, s.seq_record[0:10], s.n_hit)
         return (msg)
 
     def __repr__(self):
@@ -138,16 +171,81 @@ class Reference(object):
     def n_seq(self ):
         return len(self.seq_dict)
 
+    @property
+    def length (self):
+        return sum([seq.seq_len for seq in self.seq_dict.values()])
+
+    @property
+    def search_length (self):
+        """Number of bases of the Sequences that are not excluded from the searches"""
+        return sum([seq.seq_len for seq in self.seq_dict.values()
+            if seq.name not in self.excluded_seqs])
+
+    @property
+    def mod_bases (self):
+        """Count the bases masked in all the Sequences of the Reference from their intervals"""
+        return sum([seq.mod_bases for seq in self.seq_dict.values()])
+
+    @property
+    def checksum(self):
+        """SHA1 checksum of the content of the fasta file, computed only once when first needed"""
+        if not self._checksum:
+            self._checksum = file_checksum(self.fasta)
+        return self._checksum
+
+    @property
+    def search_checksum(self):
+        """SHA1 checksum of the fasta file searched, without the excluded sequences"""
+        if self.search_fasta == self.fasta:
+            return self.checksum
+        if not self._search_checksum:
+            self._search_checksum = file_checksum(self.search_fasta)
+        return self._search_checksum
+
     #~~~~~~~PUBLIC METHODS~~~~~~~#
 
+    def identical_sequence (self, seq):
+        """
+        Return the first Sequence of the Reference identical to a Sequence on either strand, or
+        None. The hashes are only computed for the Sequences of the same length
+        @param seq Sequence object, usually from another Reference
+        """
+        for candidate in self.length_dict.get(seq.seq_len, []):
+            if candidate.seq_hash == seq.seq_hash:
+                return candidate
+        return None
+
+    def exclude_sequences (self, name_list):
+        """
+        Exclude Sequences from the searches against the Reference, by writing a fasta file of the
+        remaining Sequences in the temporary directory. search_fasta is None if no Sequence remains
+        @param name_list List of the names of the Sequences to exclude
+        """
+        self.excluded_seqs.update(name_list)
+        self._search_checksum = None
+        if len(self.excluded_seqs) == self.n_seq:
+            self.search_fasta = None
+            return
+
+        self.search_fasta = path.join(self.temp_dir, "search.fa")
+        with open (self.search_fasta, "w") as fasta:
+            for seq in self.seq_dict.values():
+                if seq.name not in self.excluded_seqs:
+                    write_sequence(fasta, seq.name, seq.seq_record)
+
     def add_hit_list (self, hit_list):
         """
         Parse a list of BlastHit objects and attibute each of them to its matching Sequence
         @param hit_list A list of BlastHit objects
         """
+        # Group the hits by subject Sequence to add them by batches
+        hit_dict = OrderedDict()
         for hit in hit_list:
+            hit_dict.setdefault(hit.s_id, []).append(hit)
+
+        for s_id, seq_hit_list in hit_dict.items():
             try:
-                self.seq_dict[hit.s_id].add_hit(hit)
+                self.seq_dict[s_id].add_hit_list(seq_hit_list)
             except KeyError as E:
                 print ("No sequence matching with the hit subject id")
 
@@ -160,21 +258,60 @@ class Reference(object):
         if not self.n_hit:
             return None
 
-        # Write a new compressed reference in the current folder
-        elif self.compress:
-            with gopen (self.modified_fasta, "wb") as fasta:
-                for seq in self.seq_dict.values():
-                    # Write the sequence in the fasta file
-                    fasta.write(">{}\n{}\n".format(seq.name, seq.output_sequence()))
-            return self.modified_fasta
+        # Copy the reference in the current folder and only overwrite the masked bases
+        if self.inplace and not self.compress:
+            interval_list = [(seq.seq_record,)+seq.interval_set.intervals()
+                for seq in self.seq_dict.values() if seq.n_hit]
+            return mask_fasta_copy(self.fasta, self.modified_fasta, interval_list)
 
-        # Write a new uncompressed reference in the current folder
+        # Write a new reference in the current folder, compressed in BGZF blocks with its indexes
+        # or uncompressed
+        if self.compress:
+            fasta = BgzfWriter(self.modified_fasta, threads=self.compress_threads, gzi=True)
         else:
-            with open (self.modified_fasta, "w") as fasta:
-                for seq in self.seq_dict.values():
-                    # Write the sequence in the fasta file
-                    fasta.write(">{}\n{}\n".format(seq.name, seq.output_sequence()))
-            return self.modified_fasta
+            fasta = open (self.modified_fasta, "wb")
+
+        with fasta:
+            entry_list = []
+            for seq in self.seq_dict.values():
+                # Stream the masked sequence in the fasta file
+                start_array, end_array = seq.interval_set.intervals()
+                entry_list.append(write_sequence(fasta, seq.name, seq.seq_record, start_array,
+                    end_array, self.line_width))
+
+        if self.compress:
+            write_fai(fai_path(self.modified_fasta), entry_list)
+        return self.modified_fasta
+
+    def write_masked (self, fasta_path, interval_dict):
+        """
+        Write the sequences of the Reference masked with a set of intervals per sequence, for
+        searches restricted to the regions not masked yet
+        @param fasta_path Path of the fasta file to write
+        @param interval_dict Dict of IntervalSet objects by sequence name
+        """
+        with open (fasta_path, "w") as fasta:
+            for seq in self.seq_dict.values():
+                if seq.name in self.excluded_seqs:
+                    continue
+                start_array, end_array = interval_dict[seq.name].intervals()
+                write_sequence(fasta, seq.name, seq.seq_record, start_array, end_array)
+        return fasta_path
+
+    def output_mask_bed (self):
+        """
+        Output the intervals to mask of all Sequences in a bed file in the current folder, without
+        generating the masked sequences
+        """
+        if not self.n_hit:
+            return None
+
+        self.mask_bed = "{}_mask.bed".format(self.name)
+        with open (self.mask_bed, "w") as bed:
+            for seq in self.seq_dict.values():
+                for start, end in seq.mask_intervals():
+                    bed.write("{}\t{}\t{}\n".format(seq.name, start, end))
+        return self.mask_bed
 
     def get_report (self, full=False):
         """
@@ -188,11 +325,15 @@ class Reference(object):
 
         # Include in report only if hit where found in the reference
         if self.n_hit:
-            report["Number of base(s) modified"] = sum([seq.mod_bases for seq in self.seq_dict.values()])
-            report["Modified fasta"] = self.modified_fasta
+            report["Number of base(s) modified"] = self.mod_bases
+            report["Percent of base(s) modified"] = float(self.mod_bases)/self.length*100.0
+            if self.mask_bed:
+                report["Masked intervals"] = self.mask_bed
+            else:
+                report["Modified fasta"] = self.modified_fasta
             report["Modified Sequences"] = OrderedDict ()
             for seq in self.seq_dict.values():
-                if seq.hit_list:
+                if seq.n_hit:
                     report["Modified Sequences"][seq.name] = seq.get_report(full=full)
 
         return report
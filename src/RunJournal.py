@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to checkpoint the progress of a run and to resume it
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import cPickle
+import json
+from os import path, makedirs, rename, remove, fsync, getpid
+from shutil import rmtree, copyfile
+from socket import gethostname
+from hashlib import sha1
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class RunJournal(object):
+    """
+    Checkpoint journal of a RefMasker run stored in a run directory. The hit list of each completed
+    pair of References is saved in a pickle file and each masked fasta file written is recorded,
+    with one JSON record per line appended to the journal file. Pairs are identified by the name
+    and the checksum of both References so that a modified fasta file is never resumed. Records
+    are only appended once the corresponding file is complete, so a journal interrupted at any
+    time remains valid.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    JOURNAL = "journal.json"
+    HIT_DIR = "hits"
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, run_dir, params, resume=False):
+        """
+        @param run_dir Path to the run directory. Created if needed
+        @param params Dict of the parameters that may change the results. A run can only be
+        resumed with the same parameters
+        @param resume If True the records of the previous run are loaded, else they are erased
+        """
+        self.run_dir = run_dir
+        self.journal = path.join(run_dir, self.JOURNAL)
+        self.hit_dir = path.join(run_dir, self.HIT_DIR)
+        self.params = params
+        self.pair_dict = {}
+        self.output_dict = {}
+        self.reference_records = []
+
+        if not path.isdir(self.run_dir):
+            makedirs(self.run_dir)
+
+        if resume:
+            assert path.isfile(self.journal), "No journal to resume in {}".format(run_dir)
+            self._load()
+        else:
+            if path.isdir(self.hit_dir):
+                rmtree(self.hit_dir)
+            if path.isfile(self.journal):
+                remove(self.journal)
+            self._append({"type": "params", "params": self.params})
+
+        if not path.isdir(self.hit_dir):
+            makedirs(self.hit_dir)
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PROPERTIES AND MAGIC~~~~~~~#
+
+    @property
+    def n_pair (self):
+        return len(self.pair_dict)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def pair_key (self, subject, query):
+        """ Return the identifier of a pair of References """
+        return "{}:{}__{}:{}".format(subject.name, subject.checksum, query.name, query.checksum)
+
+    def has_pair (self, subject, query):
+        return self.pair_key(subject, query) in self.pair_dict
+
+    def load_pair (self, subject, query):
+        """ Return the hit list saved for a pair of References """
+        with open(self.pair_dict[self.pair_key(subject, query)], "rb") as fp:
+            return cPickle.load(fp)
+
+    def hit_file (self, subject, query):
+        """
+        Return the path of the file where the hit list of a pair of References is saved. The file
+        is named after a hash of both names, encoded so that different pairs of names never give
+        the same file whatever the characters of the names
+        """
+        return path.join(self.hit_dir, "{}.pkl".format(
+            sha1(json.dumps([subject.name, query.name])).hexdigest()))
+
+    def record_pair (self, subject, query, hit_list):
+        """ Save the hit list of a completed pair of References and record it in the journal """
+        self.dump_hits(self.hit_file(subject, query), hit_list)
+        self.record_pair_file(subject, query)
+
+    def record_pair_file (self, subject, query):
+        """ Record in the journal a hit file of a pair of References written by another process """
+        key = self.pair_key(subject, query)
+        hit_file = self.hit_file(subject, query)
+        self._append({"type": "pair", "key": key, "file": path.basename(hit_file)})
+        self.pair_dict[key] = hit_file
+
+    def has_output (self, reference):
+        """ True if the masked fasta file of a Reference was completely written and is unchanged """
+        try:
+            fasta, size = self.output_dict[reference.name]
+            return fasta == path.abspath(reference.modified_fasta) and path.getsize(fasta) == size
+        except (KeyError, OSError):
+            return False
+
+    def record_output (self, reference, fasta):
+        """ Record a completely written masked fasta file in the journal """
+        fasta = path.abspath(fasta)
+        size = path.getsize(fasta)
+        self._append({"type": "output", "reference": reference.name, "file": fasta, "size": size})
+        self.output_dict[reference.name] = (fasta, size)
+
+    def record_references (self, reference_list):
+        """ Record the ordered list of References of the run with their checksums """
+        self.reference_records = [[ref.name, ref.checksum] for ref in reference_list]
+        self._append({"type": "references", "references": self.reference_records})
+
+    def import_run (self, prev_run_dir, reference_list):
+        """
+        Import the blast results and the masked fasta files of a previous run whose References are
+        the first References of reference_list, unchanged and in the same order. Since a Reference
+        is only masked by the References listed before it, these results are still valid and only
+        the References appended after them remain to be processed
+        @param prev_run_dir Path to the run directory of the previous run
+        @param reference_list List of all the References of the current run
+        @return The number of References imported from the previous run
+        """
+        prev = RunJournal(prev_run_dir, self.params, resume=True)
+        n_prev = len(prev.reference_records)
+        current_records = [[ref.name, ref.checksum] for ref in reference_list]
+        assert n_prev and prev.reference_records == current_records[:n_prev], \
+            "The references of {} are not the first references of the current run".format(
+            prev_run_dir)
+
+        # Copy the hit files in the current run directory
+        for key, hit_file in prev.pair_dict.items():
+            if key not in self.pair_dict:
+                new_hit_file = path.join(self.hit_dir, path.basename(hit_file))
+                if path.abspath(hit_file) != path.abspath(new_hit_file):
+                    copyfile(hit_file, new_hit_file)
+                self._append({"type": "pair", "key": key, "file": path.basename(new_hit_file)})
+                self.pair_dict[key] = new_hit_file
+
+        # Copy the masked fasta files in the current output location
+        for reference in reference_list[:n_prev]:
+            if reference.name not in prev.output_dict:
+                continue
+            fasta, size = prev.output_dict[reference.name]
+            if not path.isfile(fasta) or path.getsize(fasta) != size:
+                continue
+            if fasta != path.abspath(reference.modified_fasta):
+                copyfile(fasta, reference.modified_fasta)
+            self.record_output(reference, reference.modified_fasta)
+
+        return n_prev
+
+    @staticmethod
+    def dump_hits (hit_file, hit_list):
+        """
+        Save a hit list in a file. The file is first written with a temporary name unique to the
+        host and the process, then renamed so that it is never seen partially written
+        """
+        temp_file = "{}.{}.{}.tmp".format(hit_file, gethostname(), getpid())
+        with open(temp_file, "wb") as fp:
+            cPickle.dump(hit_list, fp, cPickle.HIGHEST_PROTOCOL)
+        rename(temp_file, hit_file)
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _append (self, record):
+        """ Append a record to the journal and force it to disk """
+        with open(self.journal, "a") as fp:
+            fp.write(json.dumps(record)+"\n")
+            fp.flush()
+            fsync(fp.fileno())
+
+    def _load (self):
+        """ Load the records of the journal. A truncated last line is ignored """
+        with open(self.journal, "r") as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                if record["type"] == "params":
+                    assert record["params"] == self.params, \
+                        "The run in {} was started with different parameters".format(self.run_dir)
+                elif record["type"] == "pair":
+                    # Hit files are recorded relative to the hit directory of the run
+                    hit_file = path.join(self.hit_dir, record["file"])
+                    if path.isfile(hit_file):
+                        self.pair_dict[record["key"]] = hit_file
+                elif record["type"] == "output":
+                    self.output_dict[record["reference"]] = (record["file"], record["size"])
+                elif record["type"] == "references":
+                    self.reference_records = record["references"]
@@ -12,6 +12,30 @@
 
 # Standard library imports
 from collections import OrderedDict
+from hashlib import sha1
+
+# Local imports
+from HitTable import HitTable, subject_intervals
+from MaskEngine import IntervalSet, mask_sequence
+from ExactMatcher import reverse_complement
+
+# Number of bases read at once to hash the sequences
+HASH_BLOCK = 1048576
+
+#~~~~~~~ HELPER FUNCTIONS ~~~~~~~#
+
+def sequence_hashes (seq_record):
+    """
+    Hash a sequence and its reverse complement in uppercase, by blocks of HASH_BLOCK bases
+    @return The SHA1 hex digests of the forward and of the reverse complement sequence
+    """
+    fwd_hash, rc_hash = sha1(), sha1()
+    seq_len = len(seq_record)
+    for start in xrange(0, seq_len, HASH_BLOCK):
+        fwd_hash.update(str(seq_record[start:start+HASH_BLOCK]).upper())
+    for end in xrange(seq_len, 0, -HASH_BLOCK):
+        rc_hash.update(reverse_complement(str(seq_record[max(0, end-HASH_BLOCK):end]).upper()))
+    return fwd_hash.hexdigest(), rc_hash.hexdigest()
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class Sequence(object):
@@ -23,18 +47,26 @@ class Sequence(object):
 
     #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
 
-    def __init__ (self, name, seq_record):
+    def __init__ (self, name, seq_record, keep_hits=True):
         """
         Create a Sequence object that will store
+        @param keep_hits If False only the intervals to mask are kept, not the detail of each hit
         """
         # Create self variables
         self.name = name
         self.seq_record = seq_record
         self.seq_len = len(self.seq_record)
 
-        # Will be used later to store blast hits
-        self.hit_list = []
-        self.mod_bases = 0
+        # Hashes used to find the sequences identical to a sequence of another Reference
+        self._hashes = None
+        # Name of the identical sequence found in a previous Reference, if any
+        self.duplicate_of = None
+
+        # Will be used later to store blast hits and the merged intervals they cover
+        self.keep_hits = keep_hits
+        self.hit_list = HitTable(self.name, self.seq_len)
+        self.interval_set = IntervalSet()
+        self._n_hit = 0
 
     def __str__(self):
         msg = "SEQUENCE CLASS\tParameters list\n"
@@ -52,7 +84,35 @@ class Sequence(object):
 
     @property
     def n_hit (self):
-        return len(self.hit_list)
+        return self._n_hit
+
+    @property
+    def fwd_hash (self):
+        """ Hash of the sequence, computed only once when first needed """
+        if not self._hashes:
+            self._hashes = sequence_hashes(self.seq_record)
+        return self._hashes[0]
+
+    @property
+    def rc_hash (self):
+        """ Hash of the reverse complement sequence, computed with the hash of the sequence """
+        if not self._hashes:
+            self._hashes = sequence_hashes(self.seq_record)
+        return self._hashes[1]
+
+    @property
+    def seq_hash (self):
+        """ Canonical hash, identical for a sequence and its reverse complement """
+        return min(self.fwd_hash, self.rc_hash)
+
+    @property
+    def mod_bases (self):
+        """ Number of bases masked, computed from the merged intervals of the hits """
+        return self.interval_set.n_bases() if self._n_hit else 0
+
+    @property
+    def mod_percent (self):
+        return float(self.mod_bases)/self.seq_len*100.0 if self.seq_len else 0.0
 
     def __len__ (self):
         """Support for len method"""
@@ -62,28 +122,37 @@ class Sequence(object):
 
     def add_hit (self, hit):
         """
-        Add a hit to hit_list after verification and eventual modifications depending of the
+        Add a hit to hit_list after verification. The coordinates are normalized depending of the
         subject and query orientation
         """
-        # Hit cannot have borders outside the sequence size
-        if hit.s_start > self.seq_len or hit.s_end > self.seq_len:
-            raise ValueError, ("Invalid hit: Outside of sequence borders")
-        if hit.s_id != self.name:
-            print hit.s_id
-            print self.name
-            raise ValueError, ("Invalid hit: hit subject name does not match Sequence name")
-
-        # Reverse coordinates of the subject if the orientation of read is negative
-        if hit.s_orient == "-":
-            hit.s_start, hit.s_end = hit.s_end, hit.s_start
+        self.add_hit_list([hit])
 
-        # Reverse coordinates of the query if the orientation of read is negative
-        if hit.q_orient == "-":
-            hit.q_start, hit.q_end = hit.q_end, hit.q_start
-
-        # Finally append the modified hit to the list
-        self.hit_list.append(hit)
+    def add_hit_list (self, hit_list):
+        """
+        Add a batch of hits to hit_list if the hits are kept and merge their intervals with the
+        intervals to mask. The verification and the normalization of the coordinates are done for
+        the whole batch at once
+        """
+        if not hit_list:
+            return
+        if self.keep_hits:
+            start_array, end_array = self.hit_list.append(hit_list)
+        else:
+            start_array, end_array, reverse_array = subject_intervals(hit_list, self.name,
+                self.seq_len)
+        self.interval_set.add(start_array, end_array)
+        self._n_hit += len(hit_list)
+
+    def mask_intervals (self):
+        """
+        Return the list of (start, end) intervals of the sequence to mask, sorted by start position.
+        Hits overlapping or separated by a single base are merged in the same interval
+        """
+        if not self.n_hit:
+            return []
 
+        start_array, end_array = self.interval_set.intervals()
+        return zip(start_array.tolist(), end_array.tolist())
 
     # TODO : Create an option for soft masking
     def output_sequence (self):
@@ -91,42 +160,13 @@ class Sequence(object):
         Output a sequence corresponding to the original seq record sequence but masked with
         a masking character for bases overlapped by a BlastHit
         """
-        if not self.hit_list:
+        if not self.n_hit:
             # No need to modify the sequence
             return str(self.seq_record)
 
-        # init a STR buffer to create the masked sequence
-        masked_seq = ""
-        # Sort list by hit subject start position
-        self.hit_list.sort(key=lambda x: x.s_start)
-
-        # Head of the hit_list. If the first hit do not start at the beginning of the subject
-        # keep the original sequence until the first hit and save start and end of the first hit
-        first_hit = self.hit_list[0]
-        start_mask, end_mask = first_hit.s_start, first_hit.s_end
-        if first_hit.s_start > 0:
-            masked_seq += str(self.seq_record[0:first_hit.s_start])
-
-        for hit in self.hit_list[1:self.n_hit]:
-            if hit.s_start <= end_mask+1:
-                if hit.s_end > end_mask:
-                    end_mask = hit.s_end
-
-            else:
-                # Write previous masked interval and update the counter of masked bases
-                masked_seq += "N"*(end_mask-start_mask)
-                self.mod_bases += end_mask-start_mask
-                # Write current sequence interval
-                masked_seq += str(self.seq_record[end_mask:hit.s_start])
-                # Update start_mask and end_mask borders
-                start_mask, end_mask = hit.s_start, hit.s_end
-
-        # Tail of the list. Write previous masked interval and update the counter of masked bases
-        masked_seq += "N"*(end_mask-start_mask)
-        self.mod_bases += end_mask-start_mask
-        # Write the end of sequence if there is something left to write
-        masked_seq += str(self.seq_record[end_mask:self.seq_len])
-
+        # Mask the merged intervals of the hits in a copy of the sequence
+        start_array, end_array = self.interval_set.intervals()
+        masked_seq, n_masked = mask_sequence(str(self.seq_record), start_array, end_array)
         return masked_seq
 
     def get_report (self, full=False):
@@ -139,12 +179,16 @@ class Sequence(object):
 
         # Include in report only if hit where found in the sequence
         if self.n_hit:
+            if self.duplicate_of:
+                report["Exact duplicate of"] = self.duplicate_of
             report["Number of base modified"] = self.mod_bases
             if full:
                 report["Sequence length"] = self.seq_len
-                report["Percent of modified bases"] = float(self.mod_bases)/self.seq_len*100.0
+                report["Percent of modified bases"] = self.mod_percent
+                report["Number of masked intervals"] = len(self.interval_set)
 
-                # Details of blast hits
+            # Details of blast hits if they were kept
+            if full and self.keep_hits:
                 report["Blast Hits"] = OrderedDict ()
 
                 # Sort the hit list according to the name and start coordinate of the query
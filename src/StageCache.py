@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to stage and index the reference fasta files once and share
+            the staged copies between References and across runs
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import json
+from os import path, makedirs, rename, utime, getpid
+from shutil import rmtree
+from hashlib import sha1
+from socket import gethostname
+
+# Local imports
+from FileUtils import is_gziped, gunzip, link_or_copy, file_checksum
+from FastaIndex import build_fai, is_current
+from BlastDbCache import BlastDbCache
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class StageCache(BlastDbCache):
+    """
+    Cache of staged reference fasta files, decompressed and indexed in the samtools .fai format,
+    stored in a directory. Each staged file is created in its own entry directory named after the
+    checksum of the input file, so that References pointing to the same file share a single copy.
+    Uncompressed files are hard linked rather than copied, and gzipped files are decompressed by
+    blocks. The entries are managed as the entries of the blast database cache.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    FASTA_NAME = "ref.fa"
+    # Version of the staging format, part of the entry names
+    VERSION = "staged-2"
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, cache_dir, max_age=30):
+        """
+        @param cache_dir Path to the directory where staged files are stored. Created if needed
+        @param max_age Number of days after which an unused staged file is removed
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.version = self.VERSION
+
+        if not path.isdir(self.cache_dir):
+            makedirs(self.cache_dir)
+
+        self.clean_stale()
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def stage (self, fasta):
+        """
+        Return the staged copy of a fasta file, created and added to the cache if needed
+        @param fasta Path to the fasta file, gzipped or not
+        @return The path of the staged fasta file and the checksum of its content
+        """
+        checksum = file_checksum(fasta)
+        entry = path.join(self.cache_dir, sha1("{}\t{}".format(checksum, self.version)).hexdigest())
+        staged = path.join(entry, self.FASTA_NAME)
+
+        # A linked file modified in place after its indexation is staged again
+        if self._is_valid(entry) and is_current(staged):
+            print (" * Reuse the staged fasta file")
+            utime(entry, None)
+            return staged, self._checksum(entry)
+
+        if path.isdir(entry):
+            rmtree(entry)
+
+        # Stage and index the file in a temporary directory renamed once complete
+        temp_entry = "{}{}{}.{}".format(entry, self.TMP, gethostname(), getpid())
+        makedirs(temp_entry)
+        try:
+            temp_fasta = path.join(temp_entry, self.FASTA_NAME)
+            if is_gziped(fasta):
+                print (" * Unzip fasta file in the stage cache")
+                gunzip(fasta, temp_fasta)
+                checksum = file_checksum(temp_fasta)
+            else:
+                print (" * Link fasta file in the stage cache")
+                link_or_copy(fasta, temp_fasta)
+
+            print (" * Index fasta file")
+            build_fai(temp_fasta)
+            self._write_manifest(temp_entry, checksum)
+            rename(temp_entry, entry)
+        except OSError:
+            # The same file may have been staged by another process in the meantime
+            rmtree(temp_entry, ignore_errors=True)
+            if not self._is_valid(entry):
+                raise
+        except:
+            rmtree(temp_entry, ignore_errors=True)
+            raise
+
+        return staged, self._checksum(entry)
+
+    #~~~~~~~PRIVATE METHODS~~~~~~~#
+
+    def _checksum (self, entry):
+        """ Checksum of the staged fasta file, recorded in the manifest of the entry """
+        with open(path.join(entry, self.MANIFEST), "r") as fp:
+            return json.load(fp)["checksum"]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+@package    RefMasker
+@brief      Helper class for RefMasker to run a graph of dependent tasks in threads with a bounded
+            concurrency per stage
+@copyright  [GNU General Public License v2](http://www.gnu.org/licenses/gpl-2.0.html)
+@author     Adrien Leger - 2015
+* <adrien.leger@gmail.com> <adrien.leger@inserm.fr> <adrien.leger@univ-nantes.fr>
+* [Github](https://github.com/a-slide)
+* [Atlantic Gene Therapies - INSERM 1089] (http://www.atlantic-gene-therapies.fr/)
+"""
+
+# Standard library imports
+import sys
+from threading import Thread, Condition
+from collections import OrderedDict
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class TaskScheduler(object):
+    """
+    Run a graph of tasks in threads. Each task belongs to a stage and at most a given number of
+    tasks of the same stage run at the same time, so that CPU-bound and IO-bound stages can be
+    bounded independently. A stage can also bound the number of its tasks started whose result
+    is still needed by a task not completed yet, so that a fast stage does not produce results
+    far ahead of the stage consuming them. A task starts as soon as all the tasks it depends on
+    are completed, and among the tasks ready to start in a stage the most expensive one is
+    started first. If a task fails no new task is started and the error is raised once the
+    running tasks are done.
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~CLASS FIELDS~~~~~~~#
+
+    # Maximal time in seconds between checks of the running tasks, to keep the main thread
+    # responsive to keyboard interrupts
+    POLL_TIME = 0.5
+
+    #~~~~~~~FUNDAMENTAL METHODS~~~~~~~#
+
+    def __init__ (self, stage_limits, hold_limits={}):
+        """
+        @param stage_limits Dict of the maximal number of tasks running at the same time per stage
+        @param hold_limits Dict of the maximal number of tasks per stage running or completed whose
+        result is not yet consumed by all the tasks depending on them. Stages not listed are not
+        limited
+        """
+        assert all([limit > 0 for limit in stage_limits.values()]), \
+            "The number of tasks per stage should be > 0"
+        assert all([stage in stage_limits and limit > 0 for stage, limit in hold_limits.items()]), \
+            "The number of held results per stage should be > 0"
+        self.stage_limits = stage_limits
+        self.hold_limits = hold_limits
+        self.task_dict = OrderedDict()
+        self.result_dict = {}
+
+    def __repr__(self):
+        return "<Instance of {} from {} >\n".format(self.__class__.__name__, self.__module__)
+
+    #~~~~~~~PROPERTIES AND MAGIC~~~~~~~#
+
+    @property
+    def n_task (self):
+        return len(self.task_dict)
+
+    #~~~~~~~PUBLIC METHODS~~~~~~~#
+
+    def add_task (self, name, stage, func, deps=[], cost=0):
+        """
+        Add a task to the graph
+        @param name Unique name of the task
+        @param stage Stage of the task, one of the keys of stage_limits
+        @param func Function called with the results of the tasks listed in deps, in this order
+        @param deps List of names of tasks previously added that must be completed before
+        @param cost Estimation of the duration of the task used to start the longest jobs first
+        """
+        assert name not in self.task_dict, "Task <{}> is duplicated".format(name)
+        assert stage in self.stage_limits, "Unknown stage <{}>".format(stage)
+        assert all([dep in self.task_dict for dep in deps]), \
+            "Unknown dependency of task <{}>".format(name)
+        self.task_dict[name] = {"stage": stage, "func": func, "deps": list(deps), "cost": cost}
+
+    def run (self):
+        """
+        Run all the tasks of the graph and wait for their completion
+        @return A dict of the results of the tasks by name
+        """
+        self.result_dict = {}
+        cond = Condition()
+        pending = OrderedDict(self.task_dict)
+        running = {stage: 0 for stage in self.stage_limits}
+        error_list = []
+
+        # Number of results held per stage and number of tasks still needing each result
+        held = {stage: 0 for stage in self.stage_limits}
+        n_consumer = {name: 0 for name in self.task_dict}
+        for task in self.task_dict.values():
+            for dep in task["deps"]:
+                n_consumer[dep] += 1
+
+        def release(name):
+            if not n_consumer[name]:
+                held[self.task_dict[name]["stage"]] -= 1
+
+        def run_task(name, task, args):
+            try:
+                result = task["func"](*args)
+                error = None
+            except Exception:
+                result = None
+                error = sys.exc_info()
+            with cond:
+                if error:
+                    error_list.append(error)
+                else:
+                    self.result_dict[name] = result
+                    release(name)
+                    for dep in task["deps"]:
+                        n_consumer[dep] -= 1
+                        release(dep)
+                running[task["stage"]] -= 1
+                cond.notify()
+
+        with cond:
+            while True:
+                # Start the ready tasks, the most expensive first, if no error occurred
+                if not error_list:
+                    ready_list = [(name, task) for name, task in pending.items()
+                        if all([dep in self.result_dict for dep in task["deps"]])]
+                    for name, task in sorted(ready_list, key=lambda x: -x[1]["cost"]):
+                        stage = task["stage"]
+                        if running[stage] < self.stage_limits[stage] and \
+                            held[stage] < self.hold_limits.get(stage, self.n_task):
+                            del pending[name]
+                            running[stage] += 1
+                            held[stage] += 1
+                            args = [self.result_dict[dep] for dep in task["deps"]]
+                            thread = Thread(target=run_task, args=(name, task, args))
+                            thread.daemon = True
+                            thread.start()
+
+                if not any(running.values()):
+                    break
+                cond.wait(self.POLL_TIME)
+
+        if error_list:
+            raise error_list[0][0], error_list[0][1], error_list[0][2]
+
+        return self.result_dict
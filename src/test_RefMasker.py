@@ -13,19 +13,21 @@
 # IMPORTS #########################################################################################
 
 # Standard library packages import
-import sys, string, filecmp
-from os import getcwd, path, remove
+import sys, string, filecmp, struct, zlib
+from os import getcwd, path, remove, chmod
 from random import randint as ri
 from random import uniform as rf
 from random import choice as rc
 from shutil import rmtree
+from socket import gethostname
+from time import sleep
+from functools import partial
 from tempfile import mkdtemp
 from gzip import open as gopen
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
 # Third party packages import
 import pytest
-import pyfasta
 
 # Import the current working dir in the python path to allow local package imports
 sys.path.append(getcwd())
@@ -33,6 +35,27 @@ sys.path.append(getcwd())
 # local package imports
 from Sequence import Sequence
 from Reference import Reference
+from FastaIndex import FastaStore, build_fai, read_fai
+from HitTable import HitTable
+from MaskEngine import merge_intervals, mask_sequence, IntervalSet
+import FastaWriter
+from Bgzf import BgzfWriter
+from BlastCache import BlastCache
+from StageCache import StageCache
+from RunJournal import RunJournal
+from MergedFasta import (write_merged_fasta, split_merged_id, demultiplex_query_hits,
+    best_query_hits)
+from QueryChunker import chunk_windows, write_chunks, merge_chunk_hits
+from TaskScheduler import TaskScheduler
+from JobBoard import JobBoard
+import MinimizerSketch
+from MinimizerSketch import sequence_minimizers, save_sketch, load_sketch
+from ExactMatcher import ExactMatcher, reverse_complement
+import Aligner
+from Aligner import get_aligner, AlignerDb
+from BlastPool import blast_query_list, blast_pool
+import HitStream
+from BlastPlus import blastn_cmd, run_blastn
 from pyBlast.BlastHit import BlastHit
 from pyBlast.Blastn import Blastn
 
@@ -98,9 +121,9 @@ class defined_fasta (object):
 @pytest.yield_fixture
 def yield_sequence(len_seq=500, n_seq=1):
     with rand_fasta(len_seq, n_seq) as r:
-        print ("Create a pyfasta record")
-        pyfasta_Fasta = pyfasta.Fasta(r.fasta_path, flatten_inplace=True)
-        for name, seq_record in pyfasta_Fasta.items():
+        print ("Create a fasta record")
+        fasta_store = FastaStore(r.fasta_path)
+        for name, seq_record in fasta_store.items():
             yield Sequence(name = name, seq_record = seq_record)
 
 @pytest.yield_fixture
@@ -117,8 +140,8 @@ def yield_sequence_and_BlastHit(len_seq=500, n_query=10, min_len_hit=20, max_len
 
     # Generate a random subject sequence
     with rand_fasta(len_seq=len_seq, n_seq=1) as subject:
-        pyfasta_gen = pyfasta.Fasta(subject.fasta_path, flatten_inplace=True)
-        seq_record = pyfasta_gen["seq_0"]
+        fasta_store = FastaStore(subject.fasta_path)
+        seq_record = fasta_store["seq_0"]
         sequence = Sequence(name = "seq_0", seq_record = seq_record)
 
         seq_dict = {}
@@ -142,6 +165,37 @@ def yield_reference(n_ref=1, len_seq=500, n_seq=1, gziped=False):
             with Reference(name="ref_{}".format(i), fasta=fasta.fasta_path) as ref:
                 yield ref
 
+# TESTS FASTA INDEX ###############################################################################
+
+def test_FastaIndex_wrapped_sequences():
+    """Test the samtools compatible index and the reading of wrapped and unwrapped sequences"""
+    seq = rDNA(103)
+    temp_dir = mkdtemp()
+    try:
+        fasta = path.join(temp_dir, "wrapped.fa")
+        with open (fasta, "w") as fp:
+            fp.write(">s0 description\n")
+            fp.write("".join(["{}\n".format(seq[i:i+10]) for i in range(0, 103, 10)]))
+            fp.write(">s1\n>s2\r\nACGT\r\nAC")
+
+        assert build_fai(fasta) == [("s0", 103, 16, 10, 11), ("s1", 0, 134, 0, 0),
+            ("s2", 6, 139, 4, 6)]
+        store = FastaStore(fasta)
+        assert store.keys() == ["s0", "s1", "s2"]
+        assert str(store["s0"]) == seq and store["s0"][15:47] == seq[15:47]
+        assert store["s0"][-1] == seq[-1] and store["s0"][::-3] == seq[::-3]
+        assert [view.tobytes() for view in store["s0"].views(5, 25)] == [seq[5:10], seq[10:20],
+            seq[20:25]]
+        assert str(store["s1"]) == "" and str(store["s2"]) == "ACGTAC"
+
+        # All the lines of a sequence except the last one must have the same length
+        with open (fasta, "w") as fp:
+            fp.write(">s0\nACGT\nAC\nACGT\n")
+        with pytest.raises(ValueError):
+            FastaStore(fasta)
+    finally:
+        rmtree(temp_dir)
+
 # TESTS SEQUENCE CLASS ############################################################################
 
 def test_Sequence_create():
@@ -226,6 +280,191 @@ def test_Sequence_output_sequence_2 ():
                 if hit.s_start <= position < hit.s_end:
                     assert base == 'N', "The base in position {} of {} should be masked".format(position,sequence.name)
 
+def test_Sequence_mask_stats():
+    """Test that the masked base counts are computed from the intervals and do not change"""
+    sequence = Sequence("seq_0", rDNA(100))
+    sequence.add_hit_list([BlastHit(s_id="seq_0", s_start=11, s_end=20),
+        BlastHit(s_id="seq_0", s_start=30, s_end=21), BlastHit(s_id="seq_0", s_start=51, s_end=60)])
+    assert sequence.mask_intervals() == [(10, 30), (50, 60)]
+    assert (sequence.mod_bases, sequence.mod_percent) == (30, 30.0)
+
+    report = sequence.get_report(full=True)
+    assert sequence.output_sequence().count("N") >= 30
+    sequence.output_sequence()
+    assert sequence.get_report(full=True) == report
+    assert report["Number of masked intervals"] == 2
+
+# TESTS HIT TABLE #################################################################################
+
+def test_HitTable_append():
+    """Test the normalization of the coordinates and the validation of batches of hits"""
+    table = HitTable("seq_0", 100)
+    table.append([
+        BlastHit(q_id="q0", s_id="seq_0", s_start=80, s_end=90, q_start=20, q_end=30, identity=98.5),
+        BlastHit(q_id="q1", s_id="seq_0", s_start=90, s_end=80, q_start=30, q_end=20, evalue=1e-5)])
+    table.append([BlastHit(q_id="q0", s_id="seq_0", s_start=1, s_end=10, q_start=1, q_end=10)])
+    assert len(table) == 3
+    assert table.q_names == ["q0", "q1"]
+    assert table.columns()["s_start"].tolist() == [79, 79, 0]
+    assert table.columns()["s_end"].tolist() == [90, 90, 10]
+
+    hit = table[1]
+    assert (hit.q_id, hit.q_start, hit.q_end, hit.s_orient, hit.evalue) == ("q1", 19, 30, "-", 1e-5)
+    assert [record.identity for record in table] == [98.5, 0.0, 0.0]
+
+    # The report of a record is the one of the equivalent normalized BlastHit
+    blast_hit = BlastHit(q_id="q1", s_id="seq_0", s_start=90, s_end=80, q_start=30, q_end=20, evalue=1e-5)
+    blast_hit.s_start, blast_hit.s_end = blast_hit.s_end, blast_hit.s_start
+    blast_hit.q_start, blast_hit.q_end = blast_hit.q_end, blast_hit.q_start
+    assert hit.get_report(full=True) == blast_hit.get_report(full=True)
+
+    # Invalid batches are rejected as a whole
+    for hit_list in ([BlastHit(s_id="seq_0", s_start=90, s_end=110)],
+        [BlastHit(s_id="seq_0", s_start=1, s_end=10), BlastHit(s_id="seq_1", s_start=1, s_end=10)]):
+        with pytest.raises(ValueError):
+            table.append(hit_list)
+    assert len(table) == 3
+
+# TESTS MASK ENGINE ###############################################################################
+
+def test_MaskEngine_random_intervals():
+    """Test the vectorized interval union and masking against the iterative merge of intervals"""
+    for _ in range(50):
+        seq = rDNA(200)
+        interval_list = sorted([(start, start+ri(1, 20)) for start in [ri(0, 180) for _ in range(ri(1, 15))]])
+
+        # Intervals overlapping or separated by a single base are merged
+        merged_list = [list(interval_list[0])]
+        for start, end in interval_list[1:]:
+            if start <= merged_list[-1][1]+1:
+                merged_list[-1][1] = max(merged_list[-1][1], end)
+            else:
+                merged_list.append([start, end])
+
+        start_array, end_array = merge_intervals([i[0] for i in interval_list[::-1]], [i[1] for i in interval_list[::-1]])
+        assert zip(start_array.tolist(), end_array.tolist()) == [tuple(i) for i in merged_list]
+
+        masked = list(seq)
+        for start, end in merged_list:
+            masked[start:end] = "N"*(end-start)
+        assert mask_sequence(seq, start_array, end_array) == ("".join(masked), masked.count("N"))
+
+    start_array, end_array = merge_intervals([10, 0, 22, 5], [20, 8, 30, 9])
+    assert zip(start_array.tolist(), end_array.tolist()) == [(0, 20), (22, 30)]
+
+def test_MaskEngine_interval_set():
+    """Test that the intervals added by small batches are merged as in a single batch"""
+    interval_set = IntervalSet()
+    interval_set.MIN_BUFFER = 3
+    start_list = [ri(0, 1000) for _ in range(200)]
+    end_list = [start+ri(1, 10) for start in start_list]
+    for i in range(0, 200, 2):
+        interval_set.add(start_list[i:i+2], end_list[i:i+2])
+    assert len(interval_set) <= 200
+    merged = merge_intervals(start_list, end_list)
+    assert [array.tolist() for array in interval_set.intervals()] == [array.tolist() for array in merged]
+
+    # Sequences not keeping the hits mask the same intervals
+    for keep_hits in (True, False):
+        sequence = Sequence("seq_0", rDNA(1100), keep_hits=keep_hits)
+        sequence.add_hit_list([BlastHit(s_id="seq_0", s_start=start+1, s_end=end)
+            for start, end in zip(start_list, end_list)])
+        assert sequence.n_hit == 200
+        assert len(sequence.hit_list) == (200 if keep_hits else 0)
+        assert sequence.mask_intervals() == zip(*[array.tolist() for array in merged])
+        assert ("Blast Hits" in sequence.get_report(full=True)) == keep_hits
+
+# TESTS FASTA WRITER ##############################################################################
+
+def test_FastaWriter_write_sequence(monkeypatch):
+    """Test the writing of masked sequences by small blocks in wrapped and unwrapped lines"""
+    monkeypatch.setattr(FastaWriter, "WRITE_BLOCK", 7)
+    monkeypatch.setattr(FastaWriter, "MASK_BLOCK", "N"*7)
+    seq = rDNA(100)
+    start_array, end_array = [3, 10, 50, 95], [9, 31, 60, 100]
+    masked_seq, n_masked = mask_sequence(seq, start_array, end_array)
+    temp_dir = mkdtemp()
+    try:
+        for line_width in [0, 1, 10, 11, 100, 150]:
+            fasta = path.join(temp_dir, "masked_{}.fa".format(line_width))
+            with open(fasta, "w") as fp:
+                FastaWriter.write_sequence(fp, "s0", seq, start_array, end_array, line_width)
+                FastaWriter.write_sequence(fp, "s1", "", line_width=line_width)
+            step = line_width or 100
+            with open(fasta) as fp:
+                assert fp.read() == ">s0\n{}\n>s1\n\n".format("\n".join(
+                    [masked_seq[i:i+step] for i in range(0, 100, step)]))
+            assert str(FastaStore(fasta)["s0"]) == masked_seq
+    finally:
+        rmtree(temp_dir)
+
+def test_FastaWriter_mask_fasta_copy():
+    """Test the masking in place of a copy of a wrapped fasta file"""
+    seq_dict = OrderedDict([("s0", rDNA(103)), ("s1", ""), ("s2", rDNA(9))])
+    interval_dict = {"s0": ([0, 8, 25, 99], [3, 12, 71, 103]), "s2": ([4], [5])}
+    temp_dir = mkdtemp()
+    try:
+        fasta = path.join(temp_dir, "wrapped.fa")
+        with open (fasta, "w") as fp:
+            for name, seq in seq_dict.items():
+                fp.write(">{} description\n".format(name))
+                fp.write("".join(["{}\n".format(seq[i:i+10]) for i in range(0, len(seq), 10)]))
+
+        store = FastaStore(fasta)
+        interval_list = [(store[name],)+interval_dict[name] for name in interval_dict]
+        masked = FastaWriter.mask_fasta_copy(fasta, path.join(temp_dir, "masked.fa"), interval_list)
+
+        # Same layout as the source and same bases as the masked sequences
+        assert build_fai(masked) == read_fai(fasta+".fai")
+        masked_store = FastaStore(masked)
+        for name, seq in seq_dict.items():
+            start_array, end_array = interval_dict.get(name, ([], []))
+            assert str(masked_store[name]) == mask_sequence(seq, start_array, end_array)[0]
+    finally:
+        rmtree(temp_dir)
+
+# TESTS BGZF ######################################################################################
+
+def test_Bgzf_blocks_and_indexes():
+    """Test the BGZF blocks, the .gzi index and the .fai index of a compressed masked Reference"""
+    data = rDNA(200000)
+    temp_dir = mkdtemp()
+    try:
+        bgzf = path.join(temp_dir, "data.gz")
+        with BgzfWriter(bgzf, threads=3, gzi=True) as fp:
+            for i in range(0, len(data), 7000):
+                fp.write(data[i:i+7000])
+            assert fp.tell() == len(data)
+        with gopen(bgzf, "rb") as fp:
+            assert fp.read() == data
+
+        # Each block indexed is a gzip member starting at the given uncompressed offset
+        with open(bgzf+".gzi", "rb") as fp:
+            n_block = struct.unpack("<Q", fp.read(8))[0]
+            offset_list = [struct.unpack("<QQ", fp.read(16)) for _ in range(n_block)]
+        assert n_block == 3 and offset_list[0][1] == 65280
+        with open(bgzf, "rb") as fp:
+            raw = fp.read()
+        for c_offset, u_offset in offset_list:
+            assert raw[c_offset+12:c_offset+14] == "BC"
+            block = zlib.decompressobj(31).decompress(raw[c_offset:])
+            assert block == data[u_offset:u_offset+len(block)]
+
+        with defined_fasta(seq_dict=OrderedDict([("s0", data[:1000]), ("s1", "")])) as fasta:
+            with Reference(name="ref_bgzf", fasta=fasta.fasta_path, line_width=60) as ref:
+                ref.add_hit_list([BlastHit(q_id="q0", s_id="s0", s_start=11, s_end=20)])
+                masked = ref.output_reference()
+                try:
+                    with gopen(masked, "rb") as fp, open(path.join(temp_dir, "masked.fa"), "w") as out:
+                        out.write(fp.read())
+                    assert read_fai(masked+".fai") == build_fai(path.join(temp_dir, "masked.fa"))
+                    assert path.isfile(masked+".gzi")
+                finally:
+                    for file_path in [masked, masked+".fai", masked+".gzi"]:
+                        remove(file_path)
+    finally:
+        rmtree(temp_dir)
+
 # TESTS REFERENCE CLASS ############################################################################
 
 @pytest.mark.parametrize("n_ref, len_seq, n_seq, gziped", [
@@ -266,6 +505,38 @@ def test_Reference_add_hit_list(n_ref, len_seq, n_seq):
     Reference.RESET_REFERENCE_NAMES()
 
 
+def test_Reference_write_masked():
+    """Test the masked copy of a Reference searched with progressive masking"""
+    with defined_fasta(seq_dict=OrderedDict([("s0", "ACGT"*10), ("s1", "TTGCA"*4)])) as fasta:
+        with Reference(name="ref_masked", fasta=fasta.fasta_path) as ref:
+            interval_dict = {"s0": IntervalSet(), "s1": IntervalSet()}
+            interval_dict["s0"].add([0, 10], [4, 12])
+            masked_fasta = ref.write_masked(path.join(ref.temp_dir, "masked.fa"), interval_dict)
+            with open(masked_fasta) as fp:
+                assert fp.read() == ">s0\nNNNN{}NN{}\n>s1\n{}\n".format(
+                    ("ACGT"*10)[4:10], ("ACGT"*10)[12:], "TTGCA"*4)
+
+def test_Reference_hash_and_exclude():
+    """Test the canonical hashes of the sequences and the exclusion of sequences from searches"""
+    seq = rDNA(300)
+    with defined_fasta(seq_dict=OrderedDict([("s0", seq), ("s1", rDNA(50))])) as fasta1:
+        with defined_fasta(seq_dict=OrderedDict([("r0", reverse_complement(seq).lower())])) as fasta2:
+            with Reference(name="ref_hash1", fasta=fasta1.fasta_path) as ref1:
+                with Reference(name="ref_hash2", fasta=fasta2.fasta_path) as ref2:
+                    s0, r0 = ref1.seq_dict["s0"], ref2.seq_dict["r0"]
+                    assert ref1.identical_sequence(r0) is s0
+                    # The sequences of another length are never hashed
+                    assert ref1.seq_dict["s1"]._hashes is None
+                    assert (s0.fwd_hash, s0.rc_hash) == (r0.rc_hash, r0.fwd_hash)
+                    assert ref2.identical_sequence(ref1.seq_dict["s1"]) is None
+
+                    ref1.exclude_sequences(["s0"])
+                    with open(ref1.search_fasta) as fp:
+                        assert fp.read().count(">") == 1
+                    assert ref1.search_checksum != ref1.checksum
+                    ref2.exclude_sequences(["r0"])
+                    assert ref2.search_fasta is None
+
 def test_Reference_output_masked_reference():
     """Test the all Reference methods with predetermined ref and hits"""
 
@@ -317,3 +588,514 @@ def test_Reference_output_masked_reference():
             remove (masked_obtained)
 
     Reference.RESET_REFERENCE_NAMES()
+
+# TESTS MERGED FASTA ##############################################################################
+
+def test_MergedFasta_write_and_split():
+    """Test the merging of several References in a single fasta file with prefixed sequence ids"""
+    with defined_fasta(seq_dict={"s0":"ATCGATCG", "s1":"CGTATCGA"}) as fasta1:
+        with defined_fasta(seq_dict={"s0":"GGGGCCCC"}) as fasta2:
+            with Reference(name="ref0", fasta=fasta1.fasta_path) as ref0:
+                with Reference(name="ref1", fasta=fasta2.fasta_path) as ref1:
+                    merged = write_merged_fasta([ref0, ref1], path.join(ref0.temp_dir, "all.fa"))
+                    merged_record = FastaStore(merged)
+                    assert sorted(merged_record.keys()) == ["0__s0", "0__s1", "1__s0"]
+                    assert str(merged_record["1__s0"]) == "GGGGCCCC"
+                    assert split_merged_id("1__s0") == (1, "s0")
+
+    Reference.RESET_REFERENCE_NAMES()
+
+def test_MergedFasta_demultiplex_query_hits():
+    """Test the attribution of hits found with a merged query file to their query Reference"""
+    hit_list = [
+        BlastHit(q_id="1__q0", s_id="s0", s_start=10, s_end=20),
+        BlastHit(q_id="0__q0", s_id="s0", s_start=30, s_end=40),
+        BlastHit(q_id="1__q1", s_id="s0", s_start=50, s_end=60)]
+
+    hit_lists = demultiplex_query_hits(hit_list, [0, 1, 2])
+
+    assert [len(l) for l in hit_lists] == [1, 2, 0]
+    assert [hit.q_id for hit in hit_lists[1]] == ["q0", "q1"]
+
+def test_MergedFasta_best_query_hits():
+    """Test the selection of the hit with the highest bit score per query sequence, the first
+    one being kept in case of tie"""
+    hit_list = [
+        BlastHit(q_id="q0", s_id="s0", s_start=1, s_end=10, bscore=50, evalue=1e-5),
+        BlastHit(q_id="q1", s_id="s0", s_start=20, s_end=30, bscore=40, evalue=1e-3),
+        BlastHit(q_id="q0", s_id="s1", s_start=1, s_end=10, bscore=50, evalue=1e-7),
+        BlastHit(q_id="q1", s_id="s1", s_start=40, s_end=50, bscore=60, evalue=1e-2),
+        BlastHit(q_id="q0", s_id="s2", s_start=1, s_end=10, bscore=9.5, evalue=1e-9)]
+
+    # Ties are not broken by the e-value and the order of hit_list is preserved
+    assert [(hit.q_id, hit.s_id) for hit in best_query_hits(hit_list)] == [
+        ("q0", "s0"), ("q1", "s1")]
+    assert best_query_hits([]) == []
+
+# TESTS QUERY CHUNKER #############################################################################
+
+def test_QueryChunker_write_and_merge():
+    """Test the splitting of a Reference in overlapping chunks and the merging of their hits"""
+    assert chunk_windows(100, 40, 10) == [(0, 40), (30, 70), (60, 100)]
+    seq = "".join([rc("ATCG") for _ in range(100)])
+
+    with defined_fasta(seq_dict={"s0":seq, "s1":"ATCGATCG"}) as fasta:
+        with Reference(name="ref0", fasta=fasta.fasta_path) as query:
+            chunk_list = write_chunks(query, path.join(fasta.temp_dir, "chunks"), 40, 10)
+            assert len(chunk_list) == 4
+            chunk_dict = FastaStore(chunk_list[1])
+            assert str(chunk_dict["s0__chunk30"]) == seq[30:70]
+
+            hit_lists = [
+                # Hit truncated by the end of the first chunk and found entirely in the second
+                [BlastHit(q_id="s0__chunk0", s_id="x", q_start=36, q_end=40, s_start=6, s_end=10)],
+                [BlastHit(q_id="s0__chunk30", s_id="x", q_start=6, q_end=15, s_start=6, s_end=15),
+                # Hit found with both chunks in their overlap zone
+                BlastHit(q_id="s0__chunk30", s_id="x", q_start=31, q_end=40, s_start=51, s_end=60)],
+                [BlastHit(q_id="s0__chunk60", s_id="x", q_start=1, q_end=10, s_start=51, s_end=60)],
+                [BlastHit(q_id="s1__chunk0", s_id="x", q_start=1, q_end=5, s_start=1, s_end=5)]]
+
+            hit_list = merge_chunk_hits(hit_lists, query, 40)
+            assert [(hit.q_id, hit.q_start, hit.q_end) for hit in hit_list] == [
+                ("s0", 35, 45), ("s0", 60, 70), ("s1", 0, 5)]
+    Reference.RESET_REFERENCE_NAMES()
+
+# TESTS TASK SCHEDULER ############################################################################
+
+def test_TaskScheduler_run():
+    """Test the order of execution of dependent tasks and the propagation of errors"""
+    order = []
+    def task(name, *args):
+        order.append(name)
+        return name + "".join(args)
+
+    scheduler = TaskScheduler({"cpu":1, "io":2})
+    scheduler.add_task("small", "cpu", lambda: task("small"), cost=1)
+    scheduler.add_task("large", "cpu", lambda: task("large"), cost=10)
+    scheduler.add_task("write", "io", lambda *args: task("write", *args), deps=["small", "large"])
+    result_dict = scheduler.run()
+
+    # The most expensive task is started first and the dependencies are passed in order
+    assert order == ["large", "small", "write"]
+    assert result_dict["write"] == "writesmalllarge"
+
+    # A task cannot depend on an unknown task
+    with pytest.raises(AssertionError):
+        scheduler.add_task("other", "cpu", lambda: None, deps=["unknown"])
+
+    # The error of a failed task is raised and its dependent tasks are not started
+    scheduler = TaskScheduler({"cpu":1})
+    scheduler.add_task("fail", "cpu", lambda: 1/0)
+    scheduler.add_task("next", "cpu", lambda x: task("next"), deps=["fail"])
+    with pytest.raises(ZeroDivisionError):
+        scheduler.run()
+    assert "next" not in order
+
+    # A db result is held until its blast task is completed, so at most 2 db tasks are started
+    # ahead of the completed blast tasks
+    events = []
+    def db(i):
+        events.append("db")
+        return i
+    def blast(i):
+        sleep(0.05)
+        events.append("blast")
+    scheduler = TaskScheduler({"db":2, "blast":1}, {"db":2})
+    for i in range(5):
+        scheduler.add_task("db_{}".format(i), "db", partial(db, i), cost=i)
+        scheduler.add_task("blast_{}".format(i), "blast", blast, deps=["db_{}".format(i)])
+    scheduler.run()
+    assert sorted(events) == ["blast"]*5+["db"]*5
+    assert max([events[:k].count("db")-events[:k].count("blast")
+        for k in range(len(events)+1)]) == 2
+
+# TESTS JOB BOARD #################################################################################
+
+def test_JobBoard_claim():
+    """Test the claim of the jobs of a distributed run by several workers"""
+    run_dir = mkdtemp()
+    try:
+        with defined_fasta(seq_dict={"s0":"ATCGATCG"}) as fasta:
+            with Reference(name="ref0", fasta=fasta.fasta_path, temp_root=run_dir) as ref:
+                assert path.dirname(ref.temp_dir) == run_dir
+
+                job = {"subject": 0, "query": 0, "hit_file": "ref0__ref0.pkl"}
+                job_board = JobBoard(run_dir)
+                job_board.write_manifest({}, [ref], [job])
+                assert job_board.load_manifest()["references"][0]["checksum"] == ref.checksum
+
+                # A job can only be claimed once until it is released
+                assert job_board.claim(job)
+                assert not JobBoard(run_dir).claim(job)
+                job_board.release(job)
+
+                # The lock of a dead process of the current host is removed
+                with open(job_board._lock_path(job), "w") as fp:
+                    fp.write("{}\t{}\n".format(gethostname(), 2**22+1))
+                assert job_board.claim(job)
+                job_board.release(job)
+
+                # A completed job cannot be claimed
+                RunJournal(run_dir, {})
+                RunJournal.dump_hits(path.join(job_board.hit_dir, job["hit_file"]), [])
+                assert job_board.is_done(job) and job_board.n_left() == 0
+                assert not job_board.claim(job)
+
+            # A fasta file staged in a cache the worker cannot read is staged again by the worker
+            stage_dir = mkdtemp()
+            with Reference(name="ref1", fasta=fasta.fasta_path, stage_cache=StageCache(stage_dir)) as ref:
+                job_board.write_manifest({}, [ref], [job])
+                rmtree(stage_dir)
+                record = job_board.load_manifest()["references"][0]
+                staged = job_board._local_fasta(record, "search_fasta")
+                assert staged != record["fasta"]
+                with open(staged) as fp:
+                    assert fp.read() == ">s0\nATCGATCG\n"
+                rmtree(job_board.stage_cache.cache_dir)
+    finally:
+        rmtree(run_dir)
+        Reference.RESET_REFERENCE_NAMES()
+
+# TESTS MINIMIZER SKETCH ##########################################################################
+
+def test_MinimizerSketch(monkeypatch):
+    """Test the strand independence of sketches, the effect of shared sequences and sketch files"""
+    seq1 = rDNA(2000)
+    seq2 = rDNA(2000)
+    rc_seq1 = seq1[::-1].translate(string.maketrans("ACGT", "TGCA"))
+
+    sketch1 = sequence_minimizers(seq1)
+    assert sketch1 == sequence_minimizers(rc_seq1)
+    assert not sequence_minimizers("N"*100)
+    assert len(sketch1 & sequence_minimizers(seq2)) < len(sketch1 & sequence_minimizers(seq2+seq1[500:1500]))
+
+    # Windows never overlap ambiguous bases nor depend on the blocks of k-mers
+    assert sequence_minimizers(seq1+"N"+seq2) == sketch1 | sequence_minimizers(seq2)
+    monkeypatch.setattr(MinimizerSketch, "KMER_BLOCK", 7)
+    assert sequence_minimizers(seq1) == sketch1
+
+    temp_dir = mkdtemp()
+    try:
+        sketch_file = path.join(temp_dir, "seq.sketch")
+        assert save_sketch(sketch_file, sketch1, "checksum")
+        assert load_sketch(sketch_file, "checksum") == sketch1
+        assert load_sketch(sketch_file, "other_checksum") is None
+    finally:
+        rmtree(temp_dir)
+
+# TESTS EXACT MATCHER #############################################################################
+
+def test_ExactMatcher():
+    """Test the search of exact matches on both strands and the coordinates of the hits"""
+    shared1 = rDNA(60)
+    shared2 = rDNA(80)
+    subject_seq = rDNA(100)+shared1+rDNA(100)+reverse_complement(shared2)+rDNA(50)
+    query_seq = rDNA(30)+shared2+rDNA(30)+shared1+rDNA(20)+shared1[:30]
+
+    with defined_fasta(seq_dict={"s0":subject_seq}) as subject:
+        with defined_fasta(seq_dict={"q0":query_seq}) as query:
+            with ExactMatcher(subject.fasta_path, min_length=50) as matcher:
+                hit_list = matcher(query.fasta_path)
+
+    # Random flanking bases may extend the matches by a few bases
+    assert len(hit_list) == 2
+    hit_dict = {hit.s_orient: hit for hit in hit_list}
+    plus, minus = hit_dict["+"], hit_dict["-"]
+    assert plus.q_id == "q0" and plus.s_id == "s0"
+    assert plus.q_start <= 140 and plus.q_end >= 200 and plus.s_start <= 100 and plus.s_end >= 160
+    assert query_seq[plus.q_start:plus.q_end] == subject_seq[plus.s_start:plus.s_end]
+    assert minus.q_start <= 30 and minus.q_end >= 110
+    assert query_seq[minus.q_start:minus.q_end] == reverse_complement(subject_seq[minus.s_end:minus.s_start])
+
+# TESTS ALIGNER ###################################################################################
+
+def test_Aligner_fake():
+    """Test the selection of the homologies planted in the sidecar file of the fake aligner"""
+    with defined_fasta(seq_dict={"s0":rDNA(100), "s1":rDNA(100)}) as subject:
+        with defined_fasta(seq_dict={"q0":rDNA(100)}) as query:
+            homology_file = path.join(query.temp_dir, "homologies.tsv")
+            with open(homology_file, "w") as fp:
+                fp.write("# Planted homologies\n")
+                fp.write("q0\ts1\t100\t20\t0\t0\t1\t20\t41\t60\t1e-10\t40\n")
+                fp.write("q1\ts0\t100\t20\t0\t0\t1\t20\t41\t60\t1e-10\t40\n")
+                fp.write("q0\ts0\t90\t30\t3\t0\t51\t80\t90\t61\t1e-5\t30\n")
+
+            aligner = get_aligner("fake", homology_file=homology_file, evalue=0.1)
+            with aligner.database(subject.fasta_path) as db:
+                hit_list = db(query.fasta_path)
+                assert [(hit.q_id, hit.s_id, hit.s_orient) for hit in hit_list] == [
+                    ("q0", "s1", "+"), ("q0", "s0", "-")]
+                assert [hit.s_id for hit in db(query.fasta_path, best_query_hit=True)] == ["s1"]
+
+            # The version changes with the planted homologies to invalidate cached results
+            version = aligner.version()
+            with open(homology_file, "a") as fp:
+                fp.write("q0\ts1\t100\t20\t0\t0\t1\t20\t41\t60\t1e-10\t40\n")
+            assert get_aligner("fake", homology_file=homology_file).version() != version
+
+    with pytest.raises(AssertionError):
+        get_aligner("unknown")
+
+def test_Aligner_blast_merged_evalues(monkeypatch):
+    """Test the scaling of the e-values of the hits found in a database merging several subjects"""
+    call_list = []
+    def fake_run_blastn(query_path, db_path, blastn_exec, task, evalue, dbsize=0,
+        max_target_seqs=0):
+        call_list.append((dbsize, max_target_seqs))
+        return iter([
+            BlastHit(q_id="q0", s_id="1__s1", evalue=0.02, s_start=1, s_end=10),
+            BlastHit(q_id="q0", s_id="1__s1", evalue=0.03, s_start=20, s_end=30),
+            BlastHit(q_id="q0", s_id="0__s0", evalue=0.09, s_start=1, s_end=10)])
+    monkeypatch.setattr(Aligner, "run_blastn", fake_run_blastn)
+
+    aligner = get_aligner("blastn", evalue=0.1)
+    db = Aligner.BlastDb(aligner, "db", subject_sizes={"0__s0":1000, "1__s1":4000, "1__s2":4000})
+    hit_list = db("query.fa")
+
+    # E-values computed for the smallest subject are scaled to the size of the subject of each hit
+    assert call_list == [(1000, 3)]
+    assert [(hit.s_id, hit.evalue) for hit in hit_list] == [("1__s1", 0.08), ("0__s0", 0.09)]
+
+def test_BlastPlus_recorded_output():
+    """Test the blastn command line and the parsing of a recorded blastn tabular output, compared
+    with the BlastHit objects created from the same fields"""
+    recorded = [
+        "ref0_s0\tref1_s2\t98.77\t81\t1\t0\t12\t92\t1001\t1081\t2e-36\t144\tACGTTGCAAC",
+        "ref0_s0\tref1_s2\t91.30\t46\t2\t2\t150\t193\t5040\t4995\t4.1e-08\t52.8\tAC-GTA",
+        "ref0_s1\tref1_s0\t100.00\t250\t0\t0\t1\t250\t250\t1\t0.0\t462\tTTGACA"]
+    temp_dir = mkdtemp()
+    try:
+        blastn_exec = path.join(temp_dir, "blastn")
+        with open(path.join(temp_dir, "recorded.tsv"), "w") as fp:
+            fp.write("\n".join(recorded)+"\n")
+        with open(blastn_exec, "w") as fp:
+            fp.write("#!/bin/sh\nprintf '%s\\n' \"$@\" > {0}/args.txt\n"
+                "cat {0}/recorded.tsv\n".format(temp_dir))
+        chmod(blastn_exec, 0755)
+
+        hit_list = list(run_blastn("query.fa", "db", blastn_exec, "blastn", 0.1))
+        with open(path.join(temp_dir, "args.txt")) as fp:
+            args = fp.read().splitlines()
+
+        # No -strand option so that both strands are searched, and the query sequence follows
+        # the 12 standard columns
+        assert args == ["-task", "blastn", "-evalue", "0.1", "-outfmt", "6 std qseq",
+            "-query", "query.fa", "-db", "db"]
+        assert [vars(hit) for hit in hit_list] == [vars(BlastHit(*line.split("\t")))
+            for line in recorded]
+        assert [(hit.q_id, hit.s_id, hit.s_orient) for hit in hit_list] == [
+            ("ref0_s0", "ref1_s2", "+"), ("ref0_s0", "ref1_s2", "-"), ("ref0_s1", "ref1_s0", "-")]
+        assert [float(hit.evalue) for hit in hit_list] == [2e-36, 4.1e-08, 0.0]
+
+        # The options of merged databases are added at the end of the command line
+        assert blastn_cmd("query.fa", "db", dbsize=1000, max_target_seqs=3)[-4:] == [
+            "-dbsize", "1000", "-max_target_seqs", "3"]
+    finally:
+        rmtree(temp_dir)
+
+# TESTS HIT STREAM ################################################################################
+
+class ListDb(AlignerDb):
+    """Database returning the hits listed for each query, failing at the hit error and pausing at
+    the hit slow"""
+    def __init__(self, hit_dict):
+        self.hit_dict = hit_dict
+    def search(self, query_path):
+        for hit in self.hit_dict[query_path]:
+            if hit == "error":
+                raise ValueError("search failed")
+            if hit == "slow":
+                sleep(0.2)
+                continue
+            yield hit
+
+def test_HitStream_order_and_errors():
+    """Test that the streamed batches follow the query order and that search errors are raised"""
+    hit_dict = {"q0":range(25), "q1":[], "q2":range(100, 107)}
+    for n_workers in (1, 3):
+        batch_list = []
+        old_size, HitStream.BATCH_SIZE = HitStream.BATCH_SIZE, 10
+        try:
+            n_hit_list = HitStream.stream_query_list(ListDb(hit_dict), ["q0", "q1", "q2"],
+                n_workers=n_workers, callback=lambda j, batch: batch_list.append((j, batch)))
+        finally:
+            HitStream.BATCH_SIZE = old_size
+        assert n_hit_list == [25, 0, 7]
+        assert [(j, len(batch)) for j, batch in batch_list] == [(0, 10), (0, 10), (0, 5), (2, 7)]
+        assert sum([batch for j, batch in batch_list], []) == range(25)+range(100, 107)
+
+    hit_dict["q1"] = [1, "error"]
+    with pytest.raises(ValueError):
+        HitStream.stream_query_list(ListDb(hit_dict), ["q0", "q1", "q2"], n_workers=2)
+
+# TESTS BLAST POOL ################################################################################
+
+def test_BlastPool_order_and_errors():
+    """Test the order of the results with several workers and the propagation of worker errors"""
+    hit_dict = {"q0":["slow", 1, 2], "q1":[], "q2":range(100, 107), "q3":[3]}
+    query_list = ["q0", "q1", "q2", "q3"]
+    for n_workers in (1, 3):
+        callback_list = []
+        hit_lists = blast_query_list(ListDb(hit_dict), query_list, n_workers=n_workers,
+            callback=lambda j, hit_list: callback_list.append((j, hit_list)))
+        assert hit_lists == [[1, 2], [], range(100, 107), [3]]
+        assert callback_list == list(enumerate(hit_lists))
+
+    # A pool shared by several databases is left open after each call, even after an error
+    pool = blast_pool(2)
+    try:
+        for db_hit_dict in (hit_dict, {"q0":[4], "q1":[5], "q2":[], "q3":[6, 7]}):
+            hit_lists = blast_query_list(ListDb(db_hit_dict), query_list, n_workers=2, pool=pool)
+            assert hit_lists == [ListDb(db_hit_dict)(query) for query in query_list]
+        with pytest.raises(ValueError):
+            blast_query_list(ListDb({"q0":["error"], "q1":[]}), ["q0", "q1"], n_workers=2,
+                pool=pool)
+        assert blast_query_list(ListDb(hit_dict), ["q3"], n_workers=2, pool=pool) == [[3]]
+    finally:
+        pool.terminate()
+        pool.join()
+
+    hit_dict["q2"] = [1, "error"]
+    with pytest.raises(ValueError):
+        blast_query_list(ListDb(hit_dict), query_list, n_workers=2)
+
+# TESTS STAGE CACHE ###############################################################################
+
+def test_StageCache_stage():
+    """Test the sharing of the staged fasta files and the staging of gzipped files"""
+    seq_dict = OrderedDict([("s0", "ACGT"*10), ("s1", "TTGCA"*4)])
+    cache_dir = mkdtemp()
+    try:
+        with defined_fasta(seq_dict=seq_dict) as fasta:
+            with open(fasta.fasta_path) as fp:
+                source = fp.read()
+            cache = StageCache(cache_dir)
+            staged, checksum = cache.stage(fasta.fasta_path)
+            assert cache.stage(fasta.fasta_path) == (staged, checksum)
+
+            # The input file is unchanged and a gzipped copy is staged in its own entry
+            with open(fasta.fasta_path) as fp:
+                assert fp.read() == source
+            with gopen(fasta.fasta_path+".gz", "wb") as fp:
+                fp.write(source)
+            assert cache.stage(fasta.fasta_path+".gz")[0] != staged
+            assert read_fai(staged+".fai")[1] == ("s1", 20, 49, 20, 21)
+
+            with Reference(name="ref_staged", fasta=fasta.fasta_path, stage_cache=cache) as ref:
+                assert ref.fasta == staged and ref.checksum == checksum
+                assert str(ref.seq_dict["s1"].seq_record) == "TTGCA"*4
+    finally:
+        rmtree(cache_dir)
+
+# TESTS BLAST CACHE ###############################################################################
+
+def test_BlastCache_get_put_evict():
+    """Test the storage, the retrieval and the LRU eviction of hit lists in the blast cache"""
+    cache_dir = mkdtemp()
+    try:
+        cache = BlastCache(cache_dir, max_size=1)
+        key1 = cache.key("query_checksum", "subject_checksum", "blastn", 0.1)
+        key2 = cache.key("query_checksum", "subject_checksum", "blastn", 0.01)
+        assert key1 != key2
+
+        # Unknown keys return None while empty hit lists are valid cached results
+        assert cache.get(key1) is None
+        cache.put(key1, [])
+        assert cache.get(key1) == []
+
+        cache.put(key2, [BlastHit(q_id="q0", s_id="s0", s_start=10, s_end=20)])
+        assert cache.get(key2)[0].s_id == "s0"
+
+        # A large entry should evict all other entries
+        cache.put(cache.key("large"), ["N"*2000000])
+        assert cache.get(key1) is None and cache.get(key2) is None
+    finally:
+        rmtree(cache_dir)
+
+# TESTS RUN JOURNAL ###############################################################################
+
+def test_RunJournal_resume():
+    """Test that pairs and outputs recorded in a journal are found again when resuming the run"""
+    run_dir = mkdtemp()
+    params = {"blast_task":"blastn", "evalue":0.1}
+    try:
+        with defined_fasta(seq_dict={"s0":"ATCGATCG"}) as fasta1:
+            with defined_fasta(seq_dict={"s0":"GGGGCCCC"}) as fasta2:
+                with Reference(name="ref0", fasta=fasta1.fasta_path) as query:
+                    with Reference(name="ref1", fasta=fasta2.fasta_path, compress=False) as subject:
+
+                        journal = RunJournal(run_dir, params)
+                        assert not journal.has_pair(subject, query)
+                        journal.record_pair(subject, query, [BlastHit(q_id="s0", s_id="s0", s_start=1, s_end=4)])
+
+                        with open(subject.modified_fasta, "w") as fp:
+                            fp.write(">s0\nNNNNCCCC\n")
+                        journal.record_output(subject, subject.modified_fasta)
+
+                        # Resume the run with the same parameters
+                        journal = RunJournal(run_dir, params, resume=True)
+                        assert journal.has_pair(subject, query)
+                        assert journal.load_pair(subject, query)[0].s_id == "s0"
+                        assert journal.has_output(subject)
+                        remove(subject.modified_fasta)
+                        assert not journal.has_output(subject)
+
+                        # A run cannot be resumed with different parameters
+                        with pytest.raises(AssertionError):
+                            RunJournal(run_dir, {"blast_task":"megablast", "evalue":0.1}, resume=True)
+
+                        # A new run erases the previous records
+                        journal = RunJournal(run_dir, params)
+                        assert not journal.has_pair(subject, query)
+
+        # Hit files never collide whatever the names of the References
+        Ref = namedtuple("Ref", "name")
+        assert journal.hit_file(Ref("a__b"), Ref("c")) != journal.hit_file(Ref("a"), Ref("b__c"))
+    finally:
+        rmtree(run_dir)
+        Reference.RESET_REFERENCE_NAMES()
+
+# TESTS REFMASKER #################################################################################
+
+def test_RefMasker_all_vs_all_as_pairwise(monkeypatch):
+    """Test that the all_vs_all mode masks the same bases as the pairwise mode with an aligner
+    without e-values"""
+    from RefMasker import RefMasker
+
+    block_list = [rDNA(80) for _ in range(4)]
+    seq_dict_list = [
+        {"s0":rDNA(50)+block_list[0]+rDNA(50)+block_list[1], "s1":rDNA(100)},
+        {"s0":rDNA(30)+block_list[1]+rDNA(30), "s1":block_list[2]+rDNA(40)+block_list[0]},
+        {"s0":rDNA(20)+reverse_complement(block_list[2])+rDNA(20)+block_list[3]},
+        {"s0":block_list[3]+rDNA(60)+block_list[0], "s1":block_list[1]}]
+
+    run_dir = mkdtemp()
+    fasta_list = [defined_fasta(seq_dict=seq_dict) for seq_dict in seq_dict_list]
+    try:
+        bed_dict = {}
+        for blast_mode in ("pairwise", "all_vs_all"):
+            monkeypatch.chdir(mkdtemp(dir=run_dir))
+            with open("conf.txt", "w") as fp:
+                fp.write("[Output]\nsummary_report : False\ndetailed_report : False\n"
+                    "compress_output : False\n[Blast]\nblastn_exec : \nmakeblastdb_exec : \n"
+                    "blast_task : blastn\nbest_query_hit : False\nevalue : 0.1\n"
+                    "blast_mode : {}\naligner : exact\nmin_match_length : 30\n".format(blast_mode))
+                for i, fasta in enumerate(fasta_list):
+                    fp.write("[reference{}]\nname : ref{}\nfasta : {}\n".format(i, i,
+                        fasta.fasta_path))
+
+            RefMasker("conf.txt", dry_run=True)()
+            Reference.RESET_REFERENCE_NAMES()
+
+            for i in range(1, len(fasta_list)):
+                with open("ref{}_mask.bed".format(i)) as fp:
+                    bed_dict[(blast_mode, i)] = sorted(fp.readlines())
+
+        for i in range(1, len(fasta_list)):
+            assert bed_dict[("pairwise", i)]
+            assert bed_dict[("all_vs_all", i)] == bed_dict[("pairwise", i)]
+    finally:
+        for fasta in fasta_list:
+            rmtree(fasta.temp_dir)
+        rmtree(run_dir)
+        Reference.RESET_REFERENCE_NAMES()